@@ -1,16 +1,149 @@
 from django.contrib import admin
+from django.contrib import messages
+from django.contrib.admin.views.main import ChangeList
+from django.db import connections
+from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import ungettext
 
+from change_email.conf import settings
+from change_email.managers import EmailChangeQuerySet
 from change_email.models import EmailChange
+from change_email.throttle import allow
+from change_email.utils import normalize_email
+
+
+def estimate_count(model, using):
+    """
+Returns the number of rows of a model's table estimated from the statistics
+of the database, or ``None`` if the database backend provides none.
+
+Only PostgreSQL and MySQL are supported.
+"""
+    connection = connections[using]
+    table = model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = "SELECT reltuples FROM pg_class WHERE relname = %s"
+    elif connection.vendor == 'mysql':
+        sql = ("SELECT table_rows FROM information_schema.tables"
+               " WHERE table_schema = DATABASE() AND table_name = %s")
+    else:
+        return None
+    cursor = connection.cursor()
+    cursor.execute(sql, [table])
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountQuerySet(EmailChangeQuerySet):
+    """
+A queryset counting all rows of a large table from the statistics of the
+database instead of with ``COUNT(*)``.
+
+The estimate is only used for unfiltered querysets and if it exceeds
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_ADMIN_ESTIMATED_COUNT_THRESHOLD`,
+so that the admin paginator does not scan the table to count it.
+"""
+
+    def count(self):
+        query = self.query
+        if not query.where and not query.low_mark and query.high_mark is None:
+            estimate = estimate_count(self.model, self.db)
+            threshold = settings.EMAIL_CHANGE_ADMIN_ESTIMATED_COUNT_THRESHOLD
+            if estimate is not None and estimate >= threshold:
+                return estimate
+        return super(EstimatedCountQuerySet, self).count()
+
+
+class ExpirationListFilter(admin.SimpleListFilter):
+    """
+A list filter showing either pending or expired requests, as returned by the
+:class:`~change_email.managers.EmailChangeQuerySet` methods.
+"""
+    title = _('status')
+    parameter_name = 'status'
+
+    def lookups(self, request, model_admin):
+        return (('pending', _('Pending')),
+                ('expired', _('Expired')))
+
+    def queryset(self, request, queryset):
+        if self.value() == 'pending':
+            return queryset.pending()
+        if self.value() == 'expired':
+            return queryset.expired()
+
+
+class EmailChangeChangeList(ChangeList):
+    """
+A changelist searching requests with indexed lookups only, instead of
+``icontains`` lookups on several columns.
+"""
+
+    def get_query_set(self, request):
+        query = self.query
+        self.query = ''
+        try:
+            queryset = super(EmailChangeChangeList, self).get_query_set(request)
+        finally:
+            self.query = query
+        return self.search(queryset, query.strip())
+
+    def search(self, queryset, query):
+        """
+Filters requests by the prefix of their normalized email address, the exact
+normalized email address, the exact username of their user or, for numbers,
+their primary key or the primary key of their user.
+"""
+        if not query:
+            return queryset
+        lookups = (Q(normalized_email__startswith=query.lower()) |
+                   Q(user__username=query))
+        if '@' in query:
+            lookups |= Q(normalized_email=normalize_email(query))
+        if query.isdigit():
+            lookups |= Q(pk=query) | Q(user=query)
+        return queryset.filter(lookups)
 
 
 def resend_confirmation(modeladmin, request, queryset):
     """
 An admin action function to resend confirmation mails to
 pending change request addresses.
+
+All mails are sent through a single connection by calling
+:func:`~change_email.models.EmailChange.send_confirmation_mails`. Addresses
+exceeding the ``resend`` rates set by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_THROTTLE_RATES` are
+skipped.
 """
-    for object in queryset:
-        object.send_confirmation_mail()
+    throttled = []
+
+    def allowed(objects):
+        for obj in objects:
+            if allow('resend', request, email=obj.new_email):
+                yield obj
+            else:
+                throttled.append(obj)
+    queryset = allowed(queryset.select_related('user').iterator())
+    sent, failures = EmailChange.send_confirmation_mails(queryset, request)
+    if sent:
+        msg = ungettext("Resent %(count)d confirmation email.",
+                        "Resent %(count)d confirmation emails.",
+                        sent) % {'count': sent}
+        modeladmin.message_user(request, msg)
+    if failures:
+        addresses = ', '.join(obj.new_email for obj, e in failures)
+        msg = _("Could not resend confirmation emails to: %(addresses)s") % {
+            'addresses': addresses}
+        modeladmin.message_user(request, msg, level=messages.ERROR)
+    if throttled:
+        addresses = ', '.join(obj.new_email for obj in throttled)
+        msg = _("Too many confirmation emails have been sent to: "
+                "%(addresses)s") % {'addresses': addresses}
+        modeladmin.message_user(request, msg, level=messages.WARNING)
 resend_confirmation.short_description = _("Resend confirmation email"
                                           " to selected addresses")
 
@@ -21,12 +154,25 @@ A ModelAdmin class to represent an :model:`EmailChange` model in the
 admin interface.
 """
     actions = [resend_confirmation]
-    date_hierarchy = 'date'
-    list_display = ('id', 'user', 'new_email', 'date')
+    list_display = ('id', 'user', 'new_email', 'date', 'expires_at')
     list_display_links = ('id', 'user',)
-    list_editable = ('new_email',)
-    search_fields = ('new_email', 'id', 'user__id', 'user__username',
-                     'user__first_name', 'user__last_name', 'user__email',)
+    list_filter = (ExpirationListFilter, ('date', admin.DateFieldListFilter))
+    search_fields = ('normalized_email',)
+
+    def get_changelist(self, request, **kwargs):
+        """
+Returns :class:`EmailChangeChangeList`.
+"""
+        return EmailChangeChangeList
+
+    def queryset(self, request):
+        """
+Returns the requests together with their users, counted by
+:class:`EstimatedCountQuerySet`.
+"""
+        queryset = super(EmailChangeAdmin, self).queryset(request)
+        queryset = queryset._clone(klass=EstimatedCountQuerySet)
+        return queryset.select_related('user')
 
     def get_readonly_fields(self, request, obj=None):
         """
@@ -0,0 +1,198 @@
+import datetime
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.urlresolvers import reverse
+from django.db import connections
+from django.test.client import Client
+from django.test.signals import template_rendered
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from change_email.conf import settings
+from change_email.models import EmailChange
+from change_email.utils import normalize_email
+
+
+#: The maximum number of queries per step of the email address change flow.
+THRESHOLDS = {
+    'index': {'queries': 3},
+    'create': {'queries': 6},
+    'detail': {'queries': 3},
+    'confirm': {'queries': 7},
+    'delete': {'queries': 5},
+}
+
+#: The steps of the email address change flow, in the order they are run.
+STEPS = ('index', 'create', 'detail', 'confirm', 'delete')
+
+
+class TimingEmailBackend(EmailBackend):
+    """
+An in-memory email backend that records the time spent sending mails.
+"""
+    elapsed = 0.0
+
+    def send_messages(self, messages):
+        started = time.time()
+        try:
+            return super(TimingEmailBackend, self).send_messages(messages)
+        finally:
+            TimingEmailBackend.elapsed += time.time() - started
+
+
+class EmailChangeBenchmark(object):
+    """
+Drives the email address change flow through the test client and records
+the number of queries, the wall time, the number of rendered templates and
+the time spent sending mails of every step.
+
+The benchmark must be run against a test database, as it creates users and
+email address change requests. The numbers of rendered templates are only
+recorded if the test environment has been set up with
+:func:`django.test.utils.setup_test_environment`.
+
+:kwarg int users: The number of users to seed the database with. Users that
+    do not take part in the flow are given a pending email address change
+    request.
+:kwarg int iterations: The number of times the flow is run, each time by a
+    different user.
+"""
+    password = 'benchmark'
+
+    def __init__(self, users=100, iterations=10):
+        self.users = max(users, iterations)
+        self.iterations = iterations
+        self.templates = 0
+
+    def seed(self):
+        """
+Creates the users and the pending email address change requests.
+"""
+        UserModel = get_user_model()
+        password = make_password(self.password, None, 'md5')
+        field = settings.EMAIL_CHANGE_FIELD
+        users = []
+        for i in range(self.users):
+            user = UserModel(username='benchmark%d' % i, password=password)
+            setattr(user, field, 'benchmark%d@example.com' % i)
+            users.append(user)
+        UserModel._default_manager.bulk_create(users, batch_size=500)
+        queryset = UserModel._default_manager.filter(username__startswith='benchmark')
+        queryset = queryset.order_by('pk').values_list('pk', 'username')
+        self.usernames = []
+        requests = []
+        expires_at = timezone.now() + datetime.timedelta(
+            seconds=settings.EMAIL_CHANGE_TIMEOUT)
+        for pk, username in queryset:
+            if len(self.usernames) < self.iterations:
+                self.usernames.append(username)
+                continue
+            new_email = '%s-pending@example.com' % username
+            requests.append(EmailChange(user_id=pk, new_email=new_email,
+                                        normalized_email=normalize_email(new_email),
+                                        expires_at=expires_at))
+        EmailChange.objects.bulk_create(requests, batch_size=500)
+
+    def run(self):
+        """
+Seeds the database and runs the flow.
+
+:returns: A dictionary mapping every step to a dictionary with the mean,
+    maximum and total numbers of queries, seconds, rendered templates and
+    seconds spent sending mails.
+:rtype: dict
+"""
+        self.seed()
+        samples = dict((step, []) for step in STEPS)
+        template_rendered.connect(self.count_template)
+        debug_cursors = [(connection, connection.use_debug_cursor)
+                         for connection in connections.all()]
+        for connection, use_debug_cursor in debug_cursors:
+            connection.use_debug_cursor = True
+        try:
+            with override_settings(EMAIL_BACKEND='change_email.benchmarks.TimingEmailBackend'):
+                for username in self.usernames:
+                    for step, sample in self.run_flow(username):
+                        samples[step].append(sample)
+        finally:
+            template_rendered.disconnect(self.count_template)
+            for connection, use_debug_cursor in debug_cursors:
+                connection.use_debug_cursor = use_debug_cursor
+        return self.summarize(samples)
+
+    def run_flow(self, username):
+        client = Client()
+        client.login(username=username, password=self.password)
+        new_email = '%s-new@example.com' % username
+        yield 'index', self.measure(client.get, reverse('change_email_index'))
+        yield 'create', self.measure(client.post, reverse('change_email_create'),
+                                     data={'new_email': new_email})
+        object = EmailChange.objects.get(user__username=username)
+        yield 'detail', self.measure(client.get, reverse('change_email_detail',
+                                                         args=[object.pk]))
+        url = reverse('change_email_confirm',
+                      kwargs={'signature': object.make_signature()})
+        yield 'confirm', self.measure(client.get, url)
+        # Only unconfirmed requests can be deleted.
+        client.post(reverse('change_email_create'),
+                    data={'new_email': '%s-other@example.com' % username})
+        object = EmailChange.objects.get(user__username=username)
+        yield 'delete', self.measure(client.post, reverse('change_email_delete',
+                                                          args=[object.pk]))
+
+    def count_template(self, sender, **kwargs):
+        self.templates += 1
+
+    def measure(self, method, *args, **kwargs):
+        for connection in connections.all():
+            connection.queries = []
+        self.templates = 0
+        mail_started = TimingEmailBackend.elapsed
+        started = time.time()
+        method(*args, **kwargs)
+        elapsed = time.time() - started
+        return {
+            'queries': sum(len(connection.queries)
+                           for connection in connections.all()),
+            'time': elapsed,
+            'templates': self.templates,
+            'mail_time': TimingEmailBackend.elapsed - mail_started,
+        }
+
+    def summarize(self, samples):
+        results = {}
+        for step, step_samples in samples.items():
+            results[step] = {}
+            for key in ('queries', 'time', 'templates', 'mail_time'):
+                values = [sample[key] for sample in step_samples]
+                results[step][key] = {
+                    'mean': float(sum(values)) / len(values),
+                    'max': max(values),
+                    'total': sum(values),
+                }
+        return results
+
+
+def check_thresholds(results, thresholds=None):
+    """
+Compares benchmark results against thresholds.
+
+:arg dict results: The results returned by :func:`EmailChangeBenchmark.run`.
+:kwarg dict thresholds: A dictionary mapping steps to the maximum values of
+    their measurements. Defaults to :data:`THRESHOLDS`.
+:returns: A list of messages describing every exceeded threshold.
+:rtype: list
+"""
+    if thresholds is None:
+        thresholds = THRESHOLDS
+    errors = []
+    for step, limits in sorted(thresholds.items()):
+        for key, limit in sorted(limits.items()):
+            value = results[step][key]['max']
+            if value > limit:
+                errors.append('%s: %s is %s, expected at most %s' %
+                              (step, key, value, limit))
+    return errors
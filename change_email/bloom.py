@@ -0,0 +1,318 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import post_save
+from django.utils.encoding import force_bytes
+
+from change_email.conf import settings
+from change_email.utils import normalize_email
+
+
+#: The header of filter files: a magic string, the number of hash functions
+#: and the number of cells.
+HEADER = struct.Struct('<4sIQ')
+MAGIC = b'CEBF'
+SET = b'\x01'
+
+#: The number of cells compared at once when merging filters.
+CHUNK_SIZE = 4096
+
+_filter = None
+_lock = threading.Lock()
+
+
+def get_dimensions(capacity, error_rate):
+    """
+Returns the number of cells and hash functions of a Bloom filter holding
+``capacity`` values with the given rate of false positives.
+
+:arg int capacity: The expected number of values.
+:arg float error_rate: The rate of false positives, e.g. ``0.01``.
+:rtype: tuple
+"""
+    size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    hashes = max(int(round(float(size) / capacity * math.log(2))), 1)
+    return size, hashes
+
+
+class BloomFilter(object):
+    """
+A Bloom filter of normalized email addresses.
+
+Every cell of the filter is a byte rather than a bit, so that processes
+setting cells of a shared memory-mapped file at the same time never overwrite
+each other's changes, at the cost of eight times the memory.
+
+:arg int size: The number of cells.
+:arg int hashes: The number of hash functions.
+:kwarg cells: A writable buffer holding the cells, e.g. a
+    :class:`mmap.mmap`. Defaults to a new in-memory buffer.
+:kwarg int offset: The position of the first cell in ``cells``.
+"""
+    identity = None
+    """The device and inode of the file the filter is mapped from, if any."""
+
+    def __init__(self, size, hashes, cells=None, offset=0):
+        self.size = size
+        self.hashes = hashes
+        if cells is None:
+            cells = bytearray(size)
+        self.cells = cells
+        self.offset = offset
+
+    @classmethod
+    def create(cls, path, size, hashes):
+        """
+Creates a file holding an empty filter and maps it into memory.
+"""
+        with open(path, 'w+b') as f:
+            f.write(HEADER.pack(MAGIC, hashes, size))
+            f.truncate(HEADER.size + size)
+            f.flush()
+            return cls.map(f, size, hashes)
+
+    @classmethod
+    def open(cls, path):
+        """
+Maps a file created by :func:`create` into memory.
+
+:returns: The filter, or ``None`` if the file does not exist or is not a
+    valid filter file.
+"""
+        try:
+            f = open(path, 'r+b')
+        except IOError:
+            return None
+        with f:
+            try:
+                magic, hashes, size = HEADER.unpack(f.read(HEADER.size))
+            except struct.error:
+                return None
+            if magic != MAGIC or os.fstat(f.fileno()).st_size != HEADER.size + size:
+                return None
+            return cls.map(f, size, hashes)
+
+    @classmethod
+    def map(cls, f, size, hashes):
+        cells = mmap.mmap(f.fileno(), HEADER.size + size)
+        instance = cls(size, hashes, cells=cells, offset=HEADER.size)
+        stat = os.fstat(f.fileno())
+        instance.identity = (stat.st_dev, stat.st_ino)
+        return instance
+
+    def get_positions(self, value):
+        digest = hashlib.md5(force_bytes(value)).digest()
+        a, b = struct.unpack('<QQ', digest)
+        return [self.offset + (a + i * b) % self.size
+                for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.get_positions(value):
+            self.cells[position] = SET
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def __contains__(self, value):
+        for position in self.get_positions(value):
+            if self.cells[position:position + 1] != SET:
+                return False
+        return True
+
+    def read(self, start=0, end=None):
+        """
+Returns a copy of the cells from ``start`` to ``end``.
+
+:rtype: str
+"""
+        if end is None:
+            end = self.size
+        return bytes(self.cells[self.offset + start:self.offset + end])
+
+    def merge(self, other, snapshot):
+        """
+Sets the cells that have been set in another filter of the same size since
+``snapshot`` was read from it.
+
+:arg obj other: A :class:`BloomFilter`.
+:arg str snapshot: The cells of ``other`` as returned by :func:`read`.
+"""
+        for start in range(0, self.size, CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, self.size)
+            current = other.read(start, end)
+            previous = snapshot[start:end]
+            if current == previous:
+                continue
+            for i in range(end - start):
+                if current[i] != previous[i]:
+                    self.cells[self.offset + start + i] = SET
+
+    def flush(self):
+        if isinstance(self.cells, mmap.mmap):
+            self.cells.flush()
+
+
+def get_filter():
+    """
+Returns the Bloom filter mapped from the file set by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_BLOOM_FILTER_PATH`, or
+``None`` if :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_BLOOM_FILTER`
+is ``False``, no path is set or the file has not been built yet.
+
+The file is shared by all processes, so that addresses added by one process
+are seen by all others. It is mapped again once it has been replaced by
+:func:`rebuild`.
+
+:rtype: :class:`BloomFilter`
+"""
+    global _filter
+    if not settings.EMAIL_CHANGE_BLOOM_FILTER:
+        return None
+    path = settings.EMAIL_CHANGE_BLOOM_FILTER_PATH
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    identity = (stat.st_dev, stat.st_ino)
+    current = _filter
+    if current is None or current.identity != identity:
+        with _lock:
+            current = _filter
+            if current is None or current.identity != identity:
+                current = _filter = BloomFilter.open(path)
+    return current
+
+
+def iter_emails():
+    """
+Iterates over the normalized email addresses of all users and of all
+requests in the :model:`EmailChange` table.
+"""
+    from change_email.models import EmailChange
+    UserModel = get_user_model()
+    queryset = UserModel._default_manager.values_list(settings.EMAIL_CHANGE_FIELD,
+                                                      flat=True)
+    for email in queryset.iterator():
+        if email:
+            yield normalize_email(email)
+    queryset = EmailChange.objects.values_list('normalized_email', flat=True)
+    for email in queryset.iterator():
+        yield email
+
+
+def rebuild():
+    """
+Builds a new Bloom filter from :func:`iter_emails` and replaces the file set
+by :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_BLOOM_FILTER_PATH`.
+
+The filter is sized by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_BLOOM_FILTER_CAPACITY` and
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_BLOOM_FILTER_ERROR_RATE`.
+A new file is written next to the current one and renamed over it. Addresses
+added to the current filter while the new one is built are carried over, so
+that addresses of deleted users and requests are dropped without dropping
+concurrently saved ones.
+
+:raises: :py:exc:`django.core.exceptions.ImproperlyConfigured` if no path
+    is set.
+:rtype: :class:`BloomFilter`
+"""
+    global _filter
+    path = settings.EMAIL_CHANGE_BLOOM_FILTER_PATH
+    if path is None:
+        raise ImproperlyConfigured("EMAIL_CHANGE_BLOOM_FILTER_PATH is not set.")
+    size, hashes = get_dimensions(settings.EMAIL_CHANGE_BLOOM_FILTER_CAPACITY,
+                                  settings.EMAIL_CHANGE_BLOOM_FILTER_ERROR_RATE)
+    old = BloomFilter.open(path)
+    if old is not None and (old.size, old.hashes) != (size, hashes):
+        old = None
+    snapshot = old is not None and old.read() or None
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    new = BloomFilter.create(tmp, size, hashes)
+    try:
+        new.update(iter_emails())
+        if old is not None:
+            new.merge(old, snapshot)
+        new.flush()
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+    if old is not None:
+        # Catch addresses added by processes that have not seen the new file
+        # yet.
+        new.merge(old, snapshot)
+        new.flush()
+    with _lock:
+        _filter = new
+    return new
+
+
+def clear_filter():
+    """
+Discards the Bloom filter of this process.
+"""
+    global _filter
+    with _lock:
+        _filter = None
+
+
+def add(email):
+    """
+Adds an email address to the Bloom filter, if enabled.
+
+Called for the addresses of saved users and requests by
+:func:`add_saved_email`, and by the code saving requests without sending a
+``post_save`` signal. Addresses are never removed, as Bloom filters do not
+support removals; :func:`rebuild` drops the addresses of deleted users and
+requests.
+
+:arg str email: An email address.
+"""
+    if not settings.EMAIL_CHANGE_BLOOM_FILTER or not email:
+        return
+    bloom = get_filter()
+    if bloom is not None:
+        bloom.add(normalize_email(email))
+
+
+def might_be_used(email):
+    """
+Checks if an email address might be used by a user or a request in the
+:model:`EmailChange` table.
+
+:arg str email: An email address.
+:returns: ``False`` if the address is certainly not used, ``True`` if it
+    might be or the Bloom filter is disabled or not ready.
+:rtype: bool
+"""
+    bloom = get_filter()
+    if bloom is None:
+        return True
+    return normalize_email(email) in bloom
+
+
+def add_saved_email(sender, instance, update_fields=None, **kwargs):
+    """
+Adds the email address of a saved user or :model:`EmailChange` object to
+the Bloom filter. Connected to the ``post_save`` signal.
+"""
+    if not settings.EMAIL_CHANGE_BLOOM_FILTER:
+        return
+    from change_email.models import EmailChange
+    if sender is EmailChange:
+        add(instance.new_email)
+    elif sender is get_user_model():
+        field = settings.EMAIL_CHANGE_FIELD
+        if update_fields is None or field in update_fields:
+            add(getattr(instance, field))
+post_save.connect(add_saved_email)
@@ -7,6 +7,39 @@ class Settings(AppSettings):
     """
 Default settings for django-change-email.
 """
+    #: Determines the number of rows from which the admin changelist uses the
+    #: row count estimated by PostgreSQL or MySQL instead of counting all
+    #: email address change requests.
+    EMAIL_CHANGE_ADMIN_ESTIMATED_COUNT_THRESHOLD = 100000
+    #: Determines the cache used by :view:`EmailChangeAvailabilityView` to
+    #: store whether email addresses are used.
+    EMAIL_CHANGE_AVAILABILITY_CACHE = 'default'
+    #: Determines the number of seconds :view:`EmailChangeAvailabilityView`
+    #: caches whether an email address is used. ``0`` disables caching.
+    EMAIL_CHANGE_AVAILABILITY_CACHE_TIMEOUT = 10
+    #: Determines wether to check email addresses against a Bloom filter of
+    #: the addresses of all users and requests before querying the database
+    #: in :validator:`EmailNotUsedValidator`. See :ref:`api-bloom`.
+    EMAIL_CHANGE_BLOOM_FILTER = False
+    #: Determines the number of email addresses the Bloom filter is sized for.
+    EMAIL_CHANGE_BLOOM_FILTER_CAPACITY = 1000000
+    #: Determines the rate of false positives of the Bloom filter when it holds
+    #: :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_BLOOM_FILTER_CAPACITY`
+    #: addresses.
+    EMAIL_CHANGE_BLOOM_FILTER_ERROR_RATE = 0.01
+    #: Determines the path of a file holding the Bloom filter, shared by all
+    #: processes as a memory-mapped file and built by the
+    #: :command:`rebuildemailbloomfilter` management command. The Bloom filter
+    #: is not used unless it is set.
+    EMAIL_CHANGE_BLOOM_FILTER_PATH = None
+    #: Determines wether to cache the compiled templates of confirmation
+    #: emails for the lifetime of the process.
+    EMAIL_CHANGE_CACHE_TEMPLATES = True
+    #: Determines a dotted path to a callable that canonicalizes normalized
+    #: email addresses, e.g. ``'change_email.utils.canonicalize_gmail_address'``.
+    #: Addresses with the same canonical form are treated as the same address
+    #: when checking if an address is already used by a pending request.
+    EMAIL_CHANGE_CANONICALIZE_EMAIL = None
     #: Determines the URL to redirect to after an email change request has been
     #: deleted.
     EMAIL_CHANGE_DELETE_SUCCESS_REDIRECT_URL = '/account/email/change/'
@@ -19,12 +52,109 @@ Default settings for django-change-email.
     #: Determines the template used to render the HTML text of the
     #: confirmation email.
     EMAIL_CHANGE_HTML_EMAIL_TEMPLATE = 'change_email/mail/body.html'
+    #: Determines the maximum number of confirmation mails rendered and sent
+    #: at once through a single connection when sending mails in bulk.
+    EMAIL_CHANGE_MAIL_BATCH_SIZE = 100
+    #: Determines the backend recording metrics, as a dotted path to a
+    #: :class:`~change_email.metrics.BaseMetricsBackend` subclass, e.g.
+    #: ``'change_email.metrics.StatsdMetricsBackend'``. Set to ``None`` to
+    #: disable metrics.
+    EMAIL_CHANGE_METRICS_BACKEND = 'change_email.metrics.InMemoryMetricsBackend'
+    #: Determines the prefix of the names of all metrics.
+    EMAIL_CHANGE_METRICS_PREFIX = 'change_email'
+    #: Determines the queue used to send confirmation mails, as a dotted path
+    #: to a :class:`~change_email.queues.BaseMailQueue` subclass. The default
+    #: sends mails synchronously while processing the request. Use
+    #: ``'change_email.queues.ThreadPoolMailQueue'`` to send them from
+    #: background threads or ``'change_email.queues.DatabaseMailQueue'`` to
+    #: store them and send them with the :command:`processemailchangequeue`
+    #: management command.
+    EMAIL_CHANGE_MAIL_QUEUE = 'change_email.queues.SynchronousMailQueue'
+    #: Determines the number of seconds a mail claimed by a worker of the
+    #: database mail queue is kept from other workers. Mails that could not be
+    #: sent are retried once their claim has expired.
+    EMAIL_CHANGE_MAIL_QUEUE_CLAIM_TIMEOUT = 300
+    #: Determines how often the database mail queue tries to send a mail
+    #: before giving up.
+    EMAIL_CHANGE_MAIL_QUEUE_MAX_ATTEMPTS = 5
+    #: Determines the number of threads used by the thread pool mail queue.
+    EMAIL_CHANGE_MAIL_QUEUE_THREADS = 2
+    #: Determines the alias of the primary database that
+    #: :class:`~change_email.routers.EmailChangeRouter` sends writes and pinned
+    #: reads to.
+    EMAIL_CHANGE_PRIMARY_DATABASE = 'default'
+    #: Determines the aliases of the read-only replicas of the primary database
+    #: that :class:`~change_email.routers.EmailChangeRouter` sends reads to.
+    EMAIL_CHANGE_REPLICA_DATABASES = ()
+    #: Determines the number of seconds
+    #: :class:`~change_email.middleware.PinPrimaryDatabaseMiddleware` pins the
+    #: requests of a user to the primary database after a write.
+    EMAIL_CHANGE_REPLICATION_LAG = 5
+    #: Determines the secret key used to sign confirmation links. Defaults to
+    #: the ``SECRET_KEY`` setting.
+    EMAIL_CHANGE_SECRET_KEY = None
+    #: Determines previously used secret keys that are still accepted when
+    #: checking confirmation links, e.g. after rotating
+    #: :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_SECRET_KEY`.
+    EMAIL_CHANGE_SECRET_KEY_FALLBACKS = ()
+    #: Determines the salt used to sign confirmation links.
+    EMAIL_CHANGE_SIGNING_SALT = 'change_email'
+    #: Determines previously used salts that are still accepted when checking
+    #: confirmation links. Includes the salt used by earlier versions of
+    #: django-change-email, which can be removed once links sent by them
+    #: have expired.
+    EMAIL_CHANGE_SIGNING_SALT_FALLBACKS = ('django.core.signing.Signer',)
+    #: Determines wether to look up the current site by the requested host
+    #: instead of the ``SITE_ID`` setting, e.g. to serve several sites from a
+    #: single project. Falls back to ``SITE_ID`` if no site matches the host.
+    EMAIL_CHANGE_SITE_FROM_REQUEST = False
+    #: Determines the host of the statsd server used by the statsd metrics
+    #: backend.
+    EMAIL_CHANGE_STATSD_HOST = 'localhost'
+    #: Determines the port of the statsd server used by the statsd metrics
+    #: backend.
+    EMAIL_CHANGE_STATSD_PORT = 8125
+    #: Determines the storage of pending requests, as a dotted path to a
+    #: :class:`~change_email.storage.BaseStorage` subclass. Use
+    #: ``'change_email.storage.CacheStorage'`` to keep pending requests in a
+    #: cache instead of the database.
+    EMAIL_CHANGE_STORAGE = 'change_email.storage.DatabaseStorage'
+    #: Determines the alias of the cache used by the cache storage.
+    EMAIL_CHANGE_STORAGE_CACHE = 'default'
     #: Determines the template used to render the subject of the
     #: confirmation email.
     EMAIL_CHANGE_SUBJECT_EMAIL_TEMPLATE = 'change_email/mail/subject.txt'
+    #: Determines the alias of the cache used to count requests for
+    #: throttling. An in-memory cache private to every process is used if
+    #: set to ``None`` or if the alias is not configured in the ``CACHES``
+    #: setting.
+    EMAIL_CHANGE_THROTTLE_CACHE = 'default'
+    #: Determines the maximum number of counters kept by the in-memory
+    #: throttling cache.
+    EMAIL_CHANGE_THROTTLE_LRU_SIZE = 10000
+    #: Determines the rates requests are throttled at, as a dictionary
+    #: mapping ``'<scope>.<kind>'`` to rates like ``'5/hour'``. Scopes are
+    #: ``create``, ``confirm`` and ``resend``, kinds are ``user``, ``ip`` and
+    #: ``email``, the latter counting requests per target address, e.g.
+    #: ``{'create.user': '5/day', 'create.email': '3/day',
+    #: 'confirm.ip': '30/minute'}``. Throttling is disabled by default.
+    EMAIL_CHANGE_THROTTLE_RATES = {}
     #: Determines the expiration time of an e-mail address change requests.
-    #: Defaults to 7 days.
+    #: Defaults to 7 days. The expiration date is stored with every request
+    #: when it is created, so changing this setting does not affect pending
+    #: requests.
     EMAIL_CHANGE_TIMEOUT = 60*60*24*7
+    #: Determines a dotted path to a callable returning the number of seconds
+    #: after which a request expires, e.g. depending on its user or site. The
+    #: callable receives the :model:`EmailChange` object and is called once
+    #: when the request is created. Defaults to
+    #: :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_TIMEOUT`.
+    EMAIL_CHANGE_TIMEOUT_CALLABLE = None
+    #: Determines wether confirmation links contain a timestamped token
+    #: instead of a signature. Tokens can be checked for expiration and
+    #: tampering without querying the database. Confirmation mail templates
+    #: need to use the ``confirmation_path`` context variable.
+    EMAIL_CHANGE_TIMESTAMPED_TOKENS = False
     #: Determines the template used to render the plain text body of the
     #: confirmation email.
     EMAIL_CHANGE_TXT_EMAIL_TEMPLATE = 'change_email/mail/body.txt'
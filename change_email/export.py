@@ -0,0 +1,125 @@
+import csv
+import json
+
+from django.utils.encoding import force_bytes
+
+from change_email.models import EmailChange
+
+
+#: The exported fields of every request, in order.
+FIELDS = ('id', 'user', 'new_email', 'normalized_email', 'date', 'expires_at',
+          'site')
+
+#: The states requests can be exported by, mapped to the names of the
+#: managers returning them.
+STATES = {
+    'all': 'objects',
+    'expired': 'expired_objects',
+    'pending': 'pending_objects',
+}
+
+#: The content types of the export formats.
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def iter_rows(state='all', chunk_size=1000, using=None):
+    """
+Iterates over the values of :data:`FIELDS` of email address change requests,
+ordered by their primary key.
+
+The requests are fetched in chunks of ``chunk_size`` rows with keyset
+pagination, so that memory use and query time do not grow with the number of
+exported requests. The expiration cutoff of ``pending`` and ``expired``
+requests is determined once, when the iteration starts.
+
+:kwarg str state: One of ``all``, ``pending`` and ``expired``.
+:kwarg int chunk_size: The number of rows fetched per query.
+:kwarg str using: The database alias to read from.
+:returns: A generator of tuples.
+"""
+    queryset = getattr(EmailChange, STATES[state]).all()
+    if using is not None:
+        queryset = queryset.using(using)
+    queryset = queryset.order_by('pk').values_list(*FIELDS)
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        count = 0
+        for row in chunk[:chunk_size].iterator():
+            count += 1
+            last_pk = row[0]
+            yield row
+        if count < chunk_size:
+            break
+
+
+class Echo(object):
+    """
+A file-like object returning what is written to it, to let
+:func:`csv.writer` produce single lines.
+"""
+
+    def write(self, value):
+        return value
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return force_bytes(value)
+
+
+def format_csv(rows):
+    """
+Formats rows as CSV lines, preceded by a header line.
+
+:arg rows: An iterable of tuples of the values of :data:`FIELDS`.
+:returns: A generator of byte strings.
+"""
+    writer = csv.writer(Echo())
+    yield writer.writerow(FIELDS)
+    for row in rows:
+        yield writer.writerow([format_value(value) for value in row])
+
+
+def format_jsonl(rows):
+    """
+Formats rows as JSON Lines.
+
+:arg rows: An iterable of tuples of the values of :data:`FIELDS`.
+:returns: A generator of byte strings.
+"""
+    for row in rows:
+        data = dict(zip(FIELDS, row))
+        for key in ('date', 'expires_at'):
+            if data[key] is not None:
+                data[key] = data[key].isoformat()
+        yield force_bytes(json.dumps(data, sort_keys=True)) + b'\n'
+
+
+#: The functions formatting rows, by export format.
+FORMATTERS = {
+    'csv': format_csv,
+    'jsonl': format_jsonl,
+}
+
+
+def export(state='all', format='csv', chunk_size=1000, using=None):
+    """
+Exports email address change requests in constant memory.
+
+:kwarg str state: One of ``all``, ``pending`` and ``expired``.
+:kwarg str format: Either ``csv`` or ``jsonl``.
+:kwarg int chunk_size: The number of rows fetched per query.
+:kwarg str using: The database alias to read from.
+:returns: A generator of byte strings.
+"""
+    rows = iter_rows(state=state, chunk_size=chunk_size, using=using)
+    return FORMATTERS[format](rows)
@@ -1,7 +1,9 @@
 from django import forms
 from django.utils.translation import ugettext_lazy as _
 
+from change_email.conf import settings
 from change_email.models import EmailChange
+from change_email.sites import get_current_site
 from change_email.validators import validate_email_not_used
 
 
@@ -10,15 +12,30 @@ class EmailChangeForm(forms.ModelForm):
 A form to allow users to change the email address they have
 registered with.
 
-Just consists of an ``forms.EmailField`` with a
-:validator:`validate_email_not_used` validator to check if a
-given email address is not already used.
+Just consists of an ``forms.EmailField`` checked by
+:validator:`validate_email_not_used` to see if a given email address is not
+already used, on the site of the request if one is given.
+
+:kwarg obj request: The request object, used to find the current site if
+    :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_SITE_FROM_REQUEST` is
+    ``True``.
 """
     new_email = forms.EmailField(help_text=_('Please enter your'
                                              ' new email address.'),
-                                 label=_('new email address'),
-                                 validators=[validate_email_not_used])
+                                 label=_('new email address'))
 
     class Meta:
         model = EmailChange
         exclude = ('user', 'site')
+
+    def __init__(self, *args, **kwargs):
+        self.request = kwargs.pop('request', None)
+        super(EmailChangeForm, self).__init__(*args, **kwargs)
+
+    def clean_new_email(self):
+        new_email = self.cleaned_data['new_email']
+        site = None
+        if settings.EMAIL_CHANGE_VALIDATE_SITE:
+            site = get_current_site(self.request)
+        validate_email_not_used(new_email, site=site)
+        return new_email
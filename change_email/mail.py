@@ -0,0 +1,125 @@
+import threading
+
+from django.core.mail import get_connection
+from django.template import Context
+from django.template.loader import get_template
+from django.test.signals import setting_changed
+
+from change_email.conf import settings
+from change_email.metrics import increment
+from change_email.metrics import timer
+
+
+def send_messages(messages, connection=None):
+    """
+Sends the given messages through a single connection.
+
+Every message is handed to the connection separately so that a failing
+recipient does not prevent the remaining messages from being sent.
+
+:arg list messages: A list of
+    :py:class:`django.core.mail.EmailMessage` instances.
+:kwarg obj connection: An email backend instance, defaults to the one returned
+    by :py:func:`django.core.mail.get_connection`.
+:returns: A list of ``(message, exception)`` tuples for every message that
+    could not be sent.
+:rtype: list
+"""
+    failures = []
+    if connection is None:
+        connection = get_connection()
+    opened = connection.open()
+    try:
+        for message in messages:
+            try:
+                with timer('mail_send_seconds'):
+                    connection.send_messages([message])
+            except Exception, e:
+                increment('mail_failed')
+                failures.append((message, e))
+    finally:
+        if opened:
+            connection.close()
+    return failures
+
+
+class ConfirmationMailRenderer(object):
+    """
+Renders the subject and the bodies of confirmation mails.
+
+The templates set by
+
+* :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_SUBJECT_EMAIL_TEMPLATE`
+* :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_TXT_EMAIL_TEMPLATE`
+* :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_HTML_EMAIL_TEMPLATE`
+
+are loaded and compiled once per process and cached by their names unless
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_CACHE_TEMPLATES` is set
+to ``False``. The cache is cleared whenever a setting is changed with
+:func:`django.test.utils.override_settings`.
+"""
+
+    def __init__(self):
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """
+Clears the template cache.
+"""
+        with self.lock:
+            self.templates = {}
+
+    def get_templates(self):
+        """
+Returns the compiled subject, plain text and HTML templates. The HTML
+template is ``None`` unless
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_HTML_EMAIL` is set to
+``True``.
+
+:rtype: tuple
+"""
+        names = (settings.EMAIL_CHANGE_SUBJECT_EMAIL_TEMPLATE,
+                 settings.EMAIL_CHANGE_TXT_EMAIL_TEMPLATE,
+                 settings.EMAIL_CHANGE_HTML_EMAIL and
+                 settings.EMAIL_CHANGE_HTML_EMAIL_TEMPLATE or None)
+        templates = self.templates.get(names)
+        if templates is None:
+            templates = tuple(name and get_template(name) for name in names)
+            if settings.EMAIL_CHANGE_CACHE_TEMPLATES:
+                with self.lock:
+                    self.templates[names] = templates
+        return templates
+
+    def render_confirmation(self, email_change, current_site):
+        """
+Renders a confirmation mail in one pass.
+
+:arg obj email_change: An instance of :model:`EmailChange`.
+:arg obj current_site: An instance of either
+    ``django.contrib.sites.models.Site`` or
+    ``django.contrib.sites.models.RequestSite``.
+:returns: A tuple of the subject, the plain text body and the HTML body.
+    The HTML body is ``None`` unless
+    :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_HTML_EMAIL` is set
+    to ``True``.
+:rtype: tuple
+"""
+        with timer('mail_render_seconds'):
+            subject, body_txt, body_htm = self.get_templates()
+            context = Context(email_change.get_confirmation_context(current_site))
+            # Email subject *must not* contain newlines
+            subject = ''.join(subject.render(context).splitlines())
+            text_message = body_txt.render(context)
+            html_message = None
+            if body_htm is not None:
+                html_message = body_htm.render(context)
+        return subject, text_message, html_message
+
+
+renderer = ConfirmationMailRenderer()
+
+
+def clear_templates(sender, **kwargs):
+    renderer.clear()
+setting_changed.connect(clear_templates)
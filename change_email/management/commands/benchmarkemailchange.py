@@ -0,0 +1,72 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import CommandError
+from django.core.management.base import NoArgsCommand
+from django.test.simple import DjangoTestSuiteRunner
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+
+from change_email.benchmarks import EmailChangeBenchmark
+from change_email.benchmarks import check_thresholds
+
+
+class Command(NoArgsCommand):
+    """
+The ``benchmarkemailchange`` command runs
+:class:`~change_email.benchmarks.EmailChangeBenchmark` against a test
+database that is created and destroyed by the command, and writes the results
+as JSON.
+
+Usage::
+
+    $ python manage.py benchmarkemailchange [--users=100] [--iterations=10] [--output=results.json] [--check]
+"""
+    help = "Benchmark the email change flow against a test database"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--users',
+                    action='store',
+                    dest='users',
+                    type='int',
+                    default=100,
+                    help='Number of users to seed the database with.'),
+        make_option('--iterations',
+                    action='store',
+                    dest='iterations',
+                    type='int',
+                    default=10,
+                    help='Number of times the flow is run.'),
+        make_option('--output',
+                    action='store',
+                    dest='output',
+                    default=None,
+                    help='File to write the JSON results to. Defaults to'
+                         ' standard output.'),
+        make_option('--check',
+                    action='store_true',
+                    dest='check',
+                    default=False,
+                    help='Fail if a step exceeds its thresholds.'),
+    )
+
+    def handle_noargs(self, **options):
+        setup_test_environment()
+        runner = DjangoTestSuiteRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            benchmark = EmailChangeBenchmark(users=options['users'],
+                                             iterations=options['iterations'])
+            results = benchmark.run()
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+        if options['check']:
+            errors = check_thresholds(results)
+            if errors:
+                raise CommandError('Thresholds exceeded:\n%s' % '\n'.join(errors))
@@ -0,0 +1,115 @@
+import codecs
+import csv
+import json
+import sys
+from optparse import make_option
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from change_email.models import EmailChange
+from change_email.queues import get_mail_queue
+
+
+class Command(BaseCommand):
+    """
+The ``bulkemailchange`` command creates email address change requests for
+many users from a CSV or JSON Lines file and sends their confirmation mails
+through the configured mail queue.
+
+Every CSV row or JSON object holds a user, identified by the field given by
+``--lookup`` (the username field by default), and the new email address. A
+CSV header row ``user,new_email`` is skipped. The file is read as a stream
+and processed in batches by
+:func:`~change_email.managers.EmailChangeManager.bulk_request`, so that large
+files are never loaded into memory. Use ``-`` to read from standard input.
+
+Usage::
+
+    $ python manage.py bulkemailchange <file> [--format=csv|jsonl] [--lookup=username] [--batch-size=1000] [--no-mail]
+"""
+    args = '<file>'
+    help = "Create email change requests in bulk from a CSV or JSON Lines file"
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+                    action='store',
+                    dest='format',
+                    default=None,
+                    choices=['csv', 'jsonl'],
+                    help='Format of the file. Defaults to the file extension.'),
+        make_option('--lookup',
+                    action='store',
+                    dest='lookup',
+                    default=None,
+                    help='Field of the user model identifying users.'),
+        make_option('--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=1000,
+                    help='Number of rows checked and inserted at once.'),
+        make_option('--no-mail',
+                    action='store_false',
+                    dest='mail',
+                    default=True,
+                    help='Do not send confirmation mails.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Expected the path of a single file.")
+        path = args[0]
+        format = options['format']
+        if format is None:
+            format = path.endswith('.jsonl') and 'jsonl' or 'csv'
+        lookup = options['lookup'] or get_user_model().USERNAME_FIELD
+        verbosity = int(options.get('verbosity', 1))
+        mail_queue = options['mail'] and get_mail_queue() or None
+        if path == '-':
+            stream = sys.stdin
+        else:
+            stream = open(path, 'rb')
+        try:
+            rows = getattr(self, 'read_%s' % format)(stream)
+            results = EmailChange.objects.bulk_request(
+                rows, lookup=lookup, batch_size=options['batch_size'],
+                mail_queue=mail_queue)
+            created = rejected = 0
+            for user, new_email, error in results:
+                if error is None:
+                    created += 1
+                    continue
+                rejected += 1
+                if verbosity > 1:
+                    self.stderr.write("Rejected %s for %s: %s" %
+                                      (new_email, user, error))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        if verbosity > 0:
+            self.stdout.write("Created %d email change requests, rejected %d." %
+                              (created, rejected))
+
+    def read_csv(self, stream):
+        for number, row in enumerate(csv.reader(stream)):
+            if not row:
+                continue
+            if len(row) != 2:
+                raise CommandError("Line %d: expected 2 columns." % (number + 1))
+            user, new_email = [value.decode('utf-8') for value in row]
+            if number == 0 and (user, new_email) == ('user', 'new_email'):
+                continue
+            yield user, new_email
+
+    def read_jsonl(self, stream):
+        for number, line in enumerate(codecs.getreader('utf-8')(stream)):
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+                row = data['user'], data['new_email']
+            except (ValueError, KeyError, TypeError):
+                raise CommandError("Line %d: expected an object with user and"
+                                   " new_email." % (number + 1))
+            yield row
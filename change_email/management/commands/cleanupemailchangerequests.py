@@ -1,6 +1,17 @@
+import time
+from optparse import make_option
+
 from django.core.management.base import NoArgsCommand
+from django.db import router
+from django.db import transaction
+from django.db.models import DO_NOTHING
+from django.db.models import signals
+from django.db.models.deletion import Collector
 
+from change_email.metrics import Timer
+from change_email.metrics import increment
 from change_email.models import EmailChange
+from change_email.signals import email_change_expired
 
 
 class Command(NoArgsCommand):
@@ -8,11 +19,109 @@ class Command(NoArgsCommand):
 The ``cleanupemailchangerequests`` command deletes expired email
 address change requests from the database.
 
+Expired requests are deleted in chunks ordered by their primary key, so that
+neither all expired requests have to be loaded into memory nor a single
+transaction has to lock the whole table. If no receivers are connected to the
+``pre_delete`` or ``post_delete`` signals of :model:`EmailChange` each chunk
+is deleted with a single ``DELETE`` query per table, without loading the
+requests.
+
 Usage::
 
-    $ python manage.py cleanupemailchangerequests
+    $ python manage.py cleanupemailchangerequests [--batch-size=1000] [--sleep=0] [--max-runtime=0]
 """
     help = "Delete expired email change requests from the database"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=1000,
+                    help='Number of requests deleted at once.'),
+        make_option('--sleep',
+                    action='store',
+                    dest='sleep',
+                    type='float',
+                    default=0,
+                    help='Seconds to wait between two chunks.'),
+        make_option('--max-runtime',
+                    action='store',
+                    dest='max_runtime',
+                    type='float',
+                    default=0,
+                    help='Seconds after which no further chunk is deleted.'
+                         ' Defaults to no limit.'),
+    )
 
     def handle_noargs(self, **options):
-        EmailChange.expired_objects.all().delete()
+        batch_size = options['batch_size']
+        verbosity = int(options.get('verbosity', 1))
+        using = router.db_for_write(EmailChange)
+        started = time.time()
+        deleted = 0
+        last_pk = 0
+        while True:
+            queryset = EmailChange.expired_objects.using(using)
+            queryset = queryset.filter(pk__gt=last_pk).order_by('pk')
+            pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            self.delete(pks, using)
+            deleted += len(pks)
+            last_pk = pks[-1]
+            if len(pks) < batch_size:
+                break
+            elapsed = time.time() - started
+            if options['max_runtime'] and elapsed >= options['max_runtime']:
+                break
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        if verbosity > 0:
+            elapsed = time.time() - started
+            rate = elapsed and deleted / elapsed or 0
+            self.stdout.write("Deleted %d expired email change requests in"
+                              " %.2f seconds (%.1f requests/second)." %
+                              (deleted, elapsed, rate))
+
+    def delete(self, pks, using):
+        """
+Deletes the requests with the given primary keys and their related objects
+and sends an :signal:`email_change_expired` signal.
+"""
+        measured = Timer()
+        queryset = EmailChange.objects.using(using).filter(pk__in=pks)
+        related = self.get_related_querysets(pks, using)
+        if related is None:
+            queryset.delete()
+        else:
+            with transaction.commit_on_success(using=using):
+                for related_queryset in related:
+                    related_queryset._raw_delete(using)
+                queryset._raw_delete(using)
+        increment('expired', len(pks))
+        email_change_expired.send(sender=EmailChange, pks=pks,
+                                  duration=measured.stop())
+
+    def get_related_querysets(self, pks, using):
+        """
+Returns the querysets of objects that need to be deleted together with the
+requests, or ``None`` if the requests can not be deleted without loading them
+because of connected signal receivers or non-cascading relations.
+"""
+        for signal in (signals.pre_delete, signals.post_delete):
+            if signal.has_listeners(EmailChange):
+                return None
+        collector = Collector(using=using)
+        querysets = []
+        opts = EmailChange._meta
+        for related in opts.get_all_related_objects(include_hidden=True):
+            if related.field.rel.on_delete is DO_NOTHING:
+                continue
+            manager = related.model._base_manager.using(using)
+            lookup = '%s__in' % related.field.name
+            related_queryset = manager.filter(**{lookup: pks})
+            if not collector.can_fast_delete(related_queryset,
+                                             from_field=related.field):
+                return None
+            querysets.append(related_queryset)
+        return querysets
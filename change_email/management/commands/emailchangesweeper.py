@@ -0,0 +1,140 @@
+import datetime
+import heapq
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import router
+from django.utils import timezone
+
+from change_email.management.commands.cleanupemailchangerequests import Command as CleanupCommand
+from change_email.models import EmailChange
+
+
+class Command(CleanupCommand):
+    """
+The ``emailchangesweeper`` command keeps running and deletes email address
+change requests shortly after they have expired, in small chunks, instead of
+deleting all requests that expired since the last run at once.
+
+The stored expiration dates of the requests expiring within the next
+``--lookahead`` seconds are kept in a min-heap. The command sleeps until the
+earliest of them is due or until the lookahead window has passed, whichever
+comes first, then
+deletes the due requests in chunks of ``--batch-size`` and sends an
+:signal:`email_change_expired` signal per chunk. When the lookahead window has
+passed, the heap is refilled from the database with a range scan on the
+indexed ``expires_at`` column. Requests created with a timeout shorter than
+the lookahead window may be deleted up to ``--lookahead`` seconds late.
+
+Usage::
+
+    $ python manage.py emailchangesweeper [--batch-size=100] [--lookahead=300] [--max-sleep=60] [--once]
+"""
+    help = "Continuously delete expired email change requests"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=100,
+                    help='Number of requests deleted at once.'),
+        make_option('--lookahead',
+                    action='store',
+                    dest='lookahead',
+                    type='float',
+                    default=300,
+                    help='Seconds ahead for which expiring requests are'
+                         ' scheduled.'),
+        make_option('--max-scheduled',
+                    action='store',
+                    dest='max_scheduled',
+                    type='int',
+                    default=10000,
+                    help='Maximum number of requests scheduled at once.'),
+        make_option('--max-sleep',
+                    action='store',
+                    dest='max_sleep',
+                    type='float',
+                    default=60,
+                    help='Maximum number of seconds to sleep.'),
+        make_option('--once',
+                    action='store_true',
+                    dest='once',
+                    default=False,
+                    help='Delete all due requests once and exit.'),
+    )
+
+    def handle_noargs(self, **options):
+        self.batch_size = options['batch_size']
+        self.lookahead = datetime.timedelta(seconds=options['lookahead'])
+        self.max_scheduled = options['max_scheduled']
+        self.using = router.db_for_write(EmailChange)
+        self.heap = []
+        self.scheduled = set()
+        self.watermark = None
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            now = timezone.now()
+            if self.watermark is None or now >= self.watermark:
+                self.refill(now)
+            deleted = self.sweep(now)
+            if verbosity > 1 and deleted:
+                self.stdout.write("Deleted %d expired email change requests." %
+                                  deleted)
+            if options['once']:
+                break
+            time.sleep(min(self.get_delay(timezone.now()), options['max_sleep']))
+
+    def refill(self, now):
+        """
+Schedules the requests expiring until ``now`` plus the lookahead window and
+moves the watermark, up to which the schedule is complete, to the end of the
+window or to the last scheduled request if there are more than
+``--max-scheduled`` of them.
+"""
+        end = now + self.lookahead
+        queryset = EmailChange.objects.using(self.using)
+        queryset = queryset.filter(expires_at__lte=end).order_by('expires_at')
+        rows = list(queryset.values_list('pk', 'expires_at')[:self.max_scheduled])
+        for pk, expires_at in rows:
+            if pk not in self.scheduled:
+                self.scheduled.add(pk)
+                heapq.heappush(self.heap, (expires_at, pk))
+        if len(rows) == self.max_scheduled:
+            end = rows[-1][1]
+        self.watermark = end
+
+    def sweep(self, now):
+        """
+Deletes all scheduled requests that are due in chunks.
+
+:returns: The number of deleted requests.
+:rtype: int
+"""
+        deleted = 0
+        while self.heap and self.heap[0][0] <= now:
+            pks = []
+            while (self.heap and self.heap[0][0] <= now and
+                   len(pks) < self.batch_size):
+                expires, pk = heapq.heappop(self.heap)
+                self.scheduled.discard(pk)
+                pks.append(pk)
+            # Requests may have been deleted or renewed in the meantime.
+            queryset = EmailChange.objects.using(self.using)
+            queryset = queryset.filter(pk__in=pks, expires_at__lte=now)
+            pks = list(queryset.values_list('pk', flat=True))
+            if pks:
+                self.delete(pks, self.using)
+                deleted += len(pks)
+        return deleted
+
+    def get_delay(self, now):
+        """
+Returns the number of seconds until the next request is due or the
+watermark is reached.
+"""
+        due = self.watermark
+        if self.heap and self.heap[0][0] < due:
+            due = self.heap[0][0]
+        return max((due - now).total_seconds(), 0)
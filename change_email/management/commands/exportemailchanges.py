@@ -0,0 +1,58 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from change_email.export import STATES
+from change_email.export import export
+
+
+class Command(NoArgsCommand):
+    """
+The ``exportemailchanges`` command writes email address change requests as
+CSV or JSON Lines, e.g. for audits.
+
+Requests are read in chunks with keyset pagination by
+:func:`~change_email.export.export`, so that exports of millions of requests
+run in constant memory.
+
+Usage::
+
+    $ python manage.py exportemailchanges [--state=all|pending|expired] [--format=csv|jsonl] [--chunk-size=1000] [--output=requests.csv]
+"""
+    help = "Export email change requests as CSV or JSON Lines"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--state',
+                    action='store',
+                    dest='state',
+                    default='all',
+                    choices=sorted(STATES),
+                    help='Export all, pending or expired requests.'),
+        make_option('--format',
+                    action='store',
+                    dest='format',
+                    default='csv',
+                    choices=['csv', 'jsonl'],
+                    help='Format of the export.'),
+        make_option('--chunk-size',
+                    action='store',
+                    dest='chunk_size',
+                    type='int',
+                    default=1000,
+                    help='Number of requests fetched per query.'),
+        make_option('--output',
+                    action='store',
+                    dest='output',
+                    default=None,
+                    help='File to write the export to. Defaults to standard'
+                         ' output.'),
+    )
+
+    def handle_noargs(self, **options):
+        lines = export(state=options['state'], format=options['format'],
+                       chunk_size=options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,56 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from change_email.conf import settings
+from change_email.queues import DatabaseMailQueue
+
+
+class Command(NoArgsCommand):
+    """
+The ``processemailchangequeue`` command sends the confirmation mails stored
+by :class:`~change_email.queues.DatabaseMailQueue`.
+
+By default queued mails are sent in batches until a batch is not full, which
+means the queue is empty or its remaining mails are claimed by other workers.
+Use ``--loop`` to keep polling the queue. Several workers can process the
+queue at the same time.
+
+Usage::
+
+    $ python manage.py processemailchangequeue [--batch-size=100] [--loop] [--sleep=5]
+"""
+    help = "Send queued email change confirmation mails"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=None,
+                    help='Number of mails sent through a single connection.'),
+        make_option('--loop',
+                    action='store_true',
+                    dest='loop',
+                    default=False,
+                    help='Keep polling the queue for new mails.'),
+        make_option('--sleep',
+                    action='store',
+                    dest='sleep',
+                    type='float',
+                    default=5,
+                    help='Seconds to wait for new mails when polling.'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size'] or settings.EMAIL_CHANGE_MAIL_BATCH_SIZE
+        verbosity = int(options.get('verbosity', 1))
+        queue = DatabaseMailQueue()
+        while True:
+            sent, failed = queue.process(batch_size=batch_size)
+            if verbosity > 1 and (sent or failed):
+                self.stdout.write("Sent %d mails, %d failed." % (sent, failed))
+            if sent + failed < batch_size:
+                if not options['loop']:
+                    break
+                time.sleep(options['sleep'])
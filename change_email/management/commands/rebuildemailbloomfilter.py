@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import CommandError
+from django.core.management.base import NoArgsCommand
+
+from change_email.bloom import rebuild
+from change_email.conf import settings
+
+
+class Command(NoArgsCommand):
+    """
+The ``rebuildemailbloomfilter`` command builds the Bloom filter of the email
+addresses of all users and requests and replaces the file set by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_BLOOM_FILTER_PATH`, which
+running processes map again on their next check.
+
+Addresses of deleted users and requests are only dropped from the filter by
+a rebuild, so the command should run periodically, e.g. daily.
+
+Usage::
+
+    $ python manage.py rebuildemailbloomfilter
+"""
+    help = "Rebuild the Bloom filter of used email addresses"
+
+    def handle_noargs(self, **options):
+        if settings.EMAIL_CHANGE_BLOOM_FILTER_PATH is None:
+            raise CommandError("EMAIL_CHANGE_BLOOM_FILTER_PATH is not set.")
+        verbosity = int(options.get('verbosity', 1))
+        started = time.time()
+        bloom = rebuild()
+        if verbosity > 0:
+            self.stdout.write("Rebuilt the Bloom filter with %d cells and %d"
+                              " hash functions in %.2f seconds." %
+                              (bloom.size, bloom.hashes, time.time() - started))
@@ -1,31 +1,248 @@
 import datetime
+from itertools import islice
 
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError
+from django.db import connections
 from django.db import models
+from django.db import router
+from django.db import transaction
+from django.db.models.query import QuerySet
+from django.utils import timezone
+from django.utils.encoding import force_text
 
+from change_email import bloom
 from change_email.conf import settings
+from change_email.metrics import increment
+from change_email.sites import filter_users_by_site
+from change_email.utils import normalize_email
 
 
-class ExpiredEmailChangeManager(models.Manager):
+def get_expiration_cutoff(seconds=None):
+    """
+Returns the date and time up to which email address change requests have
+expired.
+
+The returned value is timezone aware if ``USE_TZ`` is ``True``, so that it
+can be passed to queries without any conversion.
+
+:kwarg int seconds: The number of seconds after which a request expires.
+    Defaults to :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_TIMEOUT`.
+:rtype: :py:obj:`.datetime`
+"""
+    if not seconds:
+        seconds = settings.EMAIL_CHANGE_TIMEOUT
+    return timezone.now() - datetime.timedelta(seconds=seconds)
+
+
+class EmailChangeQuerySet(QuerySet):
+    """
+A :class:`django.db.models.query.QuerySet` with chainable methods to filter
+email address change requests by their expiration.
+"""
+
+    def expired(self, seconds=None):
+        """
+Returns all instances whose stored expiration date has passed.
+
+:kwarg int seconds: The number of seconds after which a request expires,
+    instead of the stored expiration date.
+"""
+        if seconds:
+            return self.filter(date__lte=get_expiration_cutoff(seconds))
+        return self.filter(expires_at__lte=timezone.now())
+
+    def expiring_within(self, seconds):
+        """
+Returns all pending instances that will expire within the given number of
+seconds.
+
+:arg int seconds: The number of seconds.
+"""
+        now = timezone.now()
+        delta = datetime.timedelta(seconds=seconds)
+        return self.filter(expires_at__gt=now, expires_at__lte=now + delta)
+
+    def pending(self, seconds=None):
+        """
+Returns all instances whose stored expiration date has not passed yet.
+
+:kwarg int seconds: The number of seconds after which a request expires,
+    instead of the stored expiration date.
+"""
+        if seconds:
+            return self.filter(date__gt=get_expiration_cutoff(seconds))
+        return self.filter(expires_at__gt=timezone.now())
+
+
+class EmailChangeManager(models.Manager):
+    """
+A manager returning :class:`EmailChangeQuerySet` instances.
+"""
+
     def get_query_set(self):
+        return EmailChangeQuerySet(self.model, using=self._db)
+
+    def expired(self, seconds=None):
+        return self.get_query_set().expired(seconds)
+
+    def expiring_within(self, seconds):
+        return self.get_query_set().expiring_within(seconds)
+
+    def pending(self, seconds=None):
+        return self.get_query_set().pending(seconds)
+
+    def bulk_request(self, rows, lookup='pk', batch_size=1000, site=None,
+                     mail_queue=None):
         """
-Returns all instances that are older
-than :py:attr:`~password_policies.conf.Settings.EMAIL_CHANGE_TIMEOUT`.
+Creates email address change requests for many users.
+
+The rows are consumed in batches of ``batch_size`` rows, so that an iterator
+over a large file is never loaded into memory at once. Every batch is checked
+with a few set-based queries instead of calling
+:validator:`EmailNotUsedValidator` for every row and the valid rows are
+inserted with a single ``bulk_create``. Rows are rejected if the address is
+invalid, if the user does not exist, if the user already has a pending
+request or if the address is used by a user or a pending request, including
+an earlier row.
+
+This method returns a generator, nothing is created until it is consumed.
+
+:arg rows: An iterable of ``(user, new_email)`` tuples, ``user`` being the
+    value of the field given by ``lookup``.
+:kwarg str lookup: The field of the user model identifying users.
+:kwarg int batch_size: The number of rows checked and inserted at once.
+:kwarg obj site: The site the requests are created on. Defaults to the site
+    set by ``SITE_ID``.
+:kwarg obj mail_queue: A :class:`~change_email.queues.BaseMailQueue` the
+    confirmation mails of every batch are passed to. No mails are sent if
+    ``None``.
+:returns: A generator of ``(user, new_email, error)`` tuples for every row,
+    in input order. ``error`` is ``None`` if a request has been created,
+    otherwise one of ``'invalid'``, ``'unknown_user'``, ``'pending'`` and
+    ``'in_use'``.
 """
-        delta = datetime.timedelta(seconds=settings.EMAIL_CHANGE_TIMEOUT)
-        expiration_date = datetime.datetime.now() - delta
-        queryset = super(ExpiredEmailChangeManager, self).get_query_set()
-        date = expiration_date.strftime("%Y-%m-%d %H:%M:%S")
-        return queryset.filter(date__lte=date)
+        if site is None and Site._meta.installed:
+            site = Site.objects.get_current()
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            errors = self._bulk_request_batch(batch, lookup, site, mail_queue)
+            for (user, new_email), error in zip(batch, errors):
+                yield user, new_email, error
 
+    def _bulk_request_batch(self, batch, lookup, site, mail_queue):
+        UserModel = get_user_model()
+        using = self._db or router.db_for_write(self.model)
+        errors = [None] * len(batch)
+        normalized = [None] * len(batch)
+        for i, (user, new_email) in enumerate(batch):
+            try:
+                validate_email(new_email)
+            except ValidationError:
+                errors[i] = 'invalid'
+                continue
+            normalized[i] = normalize_email(new_email)
+        keys = set(force_text(user) for (user, new_email), error
+                   in zip(batch, errors) if error is None)
+        users = UserModel._default_manager.using(using)
+        users = users.filter(**{'%s__in' % lookup: keys})
+        users = dict((force_text(key), pk)
+                     for key, pk in users.values_list(lookup, 'pk'))
+        pending = self.using(using).filter(user__in=users.values())
+        pending = set(pending.values_list('user', flat=True))
+        used = set(self.get_used_addresses(normalized, batch, site, using))
+        seen_users = set()
+        objects = []
+        for i, (user, new_email) in enumerate(batch):
+            if errors[i] is not None:
+                continue
+            user_pk = users.get(force_text(user))
+            if user_pk is None:
+                errors[i] = 'unknown_user'
+            elif user_pk in pending or user_pk in seen_users:
+                errors[i] = 'pending'
+            elif normalized[i] in used:
+                errors[i] = 'in_use'
+            else:
+                seen_users.add(user_pk)
+                used.add(normalized[i])
+                objects.append((i, self.model(user_id=user_pk,
+                                              new_email=new_email.strip(),
+                                              normalized_email=normalized[i],
+                                              site=site)))
+        if not objects:
+            return errors
+        # bulk_create() does not call save(), which sets the expiration date.
+        now = timezone.now()
+        for i, obj in objects:
+            obj.expires_at = now + datetime.timedelta(seconds=obj.get_timeout())
+            bloom.add(obj.new_email)
+        try:
+            with transaction.commit_on_success(using=using):
+                self.using(using).bulk_create([obj for i, obj in objects])
+        except IntegrityError:
+            # A concurrent request has taken a user or an address.
+            for i, obj in objects:
+                try:
+                    with transaction.commit_on_success(using=using):
+                        obj.save(force_insert=True, using=using)
+                except IntegrityError:
+                    errors[i] = 'in_use'
+        created = [obj.user_id for i, obj in objects if errors[i] is None]
+        increment('created', len(created))
+        if mail_queue is not None and created:
+            queryset = self.using(using).filter(user__in=created)
+            mail_queue.enqueue_many(queryset.select_related('user'))
+        return errors
 
-class PendingEmailChangeManager(models.Manager):
+    def get_used_addresses(self, normalized, batch, site, using):
+        """
+Returns the normalized addresses of a batch that are used by users or
+pending requests, with one query each.
+"""
+        candidates = set(email for email in normalized if email is not None)
+        if not candidates:
+            return []
+        kwargs = {}
+        if settings.EMAIL_CHANGE_VALIDATE_SITE and site is not None:
+            kwargs['site'] = site
+        pending = self.using(using).filter(normalized_email__in=candidates,
+                                           **kwargs)
+        used = list(pending.values_list('normalized_email', flat=True))
+        UserModel = get_user_model()
+        field = settings.EMAIL_CHANGE_FIELD
+        column = UserModel._meta.get_field(field).column
+        lowered = list(set(new_email.strip().lower()
+                           for (user, new_email), email in zip(batch, normalized)
+                           if email is not None))
+        where = 'LOWER(%s) IN (%s)' % (connections[using].ops.quote_name(column),
+                                       ', '.join(['%s'] * len(lowered)))
+        users = UserModel._default_manager.using(using)
+        if kwargs:
+            users = filter_users_by_site(users, site)
+        users = users.extra(where=[where], params=lowered)
+        used.extend(normalize_email(email)
+                    for email in users.values_list(field, flat=True))
+        return used
+
+
+class ExpiredEmailChangeManager(EmailChangeManager):
     def get_query_set(self):
         """
-Returns all instances that are newer
-than :py:attr:`~password_policies.conf.Settings.EMAIL_CHANGE_TIMEOUT`.
-"""
-        delta = datetime.timedelta(seconds=settings.EMAIL_CHANGE_TIMEOUT)
-        expiration_date = datetime.datetime.now() - delta
-        queryset = super(PendingEmailChangeManager, self).get_query_set()
-        date = expiration_date.strftime("%Y-%m-%d %H:%M:%S")
-        return queryset.filter(date__gt=date)
+Returns all instances whose stored expiration date has passed.
+"""
+        return super(ExpiredEmailChangeManager, self).get_query_set().expired()
+
+
+class PendingEmailChangeManager(EmailChangeManager):
+    def get_query_set(self):
+        """
+Returns all instances whose stored expiration date has not passed yet.
+"""
+        return super(PendingEmailChangeManager, self).get_query_set().pending()
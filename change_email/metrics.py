@@ -0,0 +1,265 @@
+import socket
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import update_wrapper
+
+from django.http import Http404
+from django.http import HttpResponse
+
+from change_email.conf import settings
+from change_email.utils import import_by_path
+
+
+#: The upper bounds in seconds of the buckets of histograms.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_metrics(path=None):
+    """
+Returns the backend recording metrics.
+
+Backends are instantiated once per process so that recorded values and
+sockets are shared between requests.
+
+:kwarg str path: The dotted path to a :class:`BaseMetricsBackend` subclass.
+    Defaults to
+    :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_METRICS_BACKEND`.
+:rtype: :class:`BaseMetricsBackend`
+"""
+    if path is None:
+        path = settings.EMAIL_CHANGE_METRICS_BACKEND
+    with _backends_lock:
+        if path not in _backends:
+            _backends[path] = import_by_path(path)()
+        return _backends[path]
+
+
+def increment(name, value=1, **labels):
+    """
+Increments a counter of the current metrics backend.
+
+:arg str name: The name of the counter.
+:kwarg int value: The value to add.
+"""
+    if settings.EMAIL_CHANGE_METRICS_BACKEND:
+        get_metrics().increment(name, value, labels)
+
+
+def observe(name, seconds, **labels):
+    """
+Records a duration in a histogram of the current metrics backend.
+
+:arg str name: The name of the histogram.
+:arg float seconds: The duration in seconds.
+"""
+    if settings.EMAIL_CHANGE_METRICS_BACKEND:
+        get_metrics().observe(name, seconds, labels)
+
+
+class Timer(object):
+    """
+Measures the time elapsed since it has been created.
+"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.elapsed = None
+
+    def stop(self):
+        self.elapsed = time.time() - self.started
+        return self.elapsed
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+A context manager recording the time spent in its block in a histogram,
+even if an exception is raised. Yields a :class:`Timer` whose ``elapsed``
+attribute is set when the block has been left.
+
+:arg str name: The name of the histogram.
+"""
+    measured = Timer()
+    try:
+        yield measured
+    finally:
+        observe(name, measured.stop(), **labels)
+
+
+def timed_view(view, name):
+    """
+Wraps a view function to record its latency in the ``view_seconds``
+histogram, including the rendering of template responses.
+
+:arg func view: The view function.
+:arg str name: The value of the ``view`` label.
+"""
+    def wrapper(request, *args, **kwargs):
+        measured = Timer()
+        response = view(request, *args, **kwargs)
+
+        def record(response):
+            observe('view_seconds', measured.stop(), view=name)
+        if getattr(response, 'is_rendered', True):
+            record(response)
+        else:
+            response.add_post_render_callback(record)
+        return response
+    return update_wrapper(wrapper, view)
+
+
+class BaseMetricsBackend(object):
+    """
+Base class of all metrics backends.
+"""
+
+    def increment(self, name, value, labels):
+        """
+Increments a counter.
+
+:arg str name: The name of the counter.
+:arg int value: The value to add.
+:arg dict labels: The labels of the counter.
+"""
+        raise NotImplementedError
+
+    def observe(self, name, seconds, labels):
+        """
+Records a duration in a histogram.
+
+:arg str name: The name of the histogram.
+:arg float seconds: The duration in seconds.
+:arg dict labels: The labels of the histogram.
+"""
+        raise NotImplementedError
+
+
+class InMemoryMetricsBackend(BaseMetricsBackend):
+    """
+A metrics backend keeping counters and histograms in memory, private to
+every process. The values can be exposed with :func:`metrics_view`.
+"""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            index = bisect_left(BUCKETS, seconds)
+            if index < len(BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self):
+        """
+Returns all values in the Prometheus text exposition format.
+
+:rtype: str
+"""
+        prefix = settings.EMAIL_CHANGE_METRICS_PREFIX
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(buckets), total, count))
+                                for key, (buckets, total, count)
+                                in self.histograms.items())
+        names = set()
+        for (name, labels), value in counters:
+            name = '%s_%s_total' % (prefix, name)
+            if name not in names:
+                names.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), (buckets, total, count) in histograms:
+            name = '%s_%s' % (prefix, name)
+            if name not in names:
+                names.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for bound, value in zip(BUCKETS, buckets):
+                cumulative += value
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels + (('le', repr(bound)),)),
+                    cumulative))
+            lines.append('%s_bucket%s %d' % (
+                name, format_labels(labels + (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %r' % (name, format_labels(labels), total))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, value) for key, value in labels)
+
+
+class StatsdMetricsBackend(BaseMetricsBackend):
+    """
+A metrics backend sending counters and timings to a statsd compatible
+server over UDP, set by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_STATSD_HOST` and
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_STATSD_PORT`. Label values
+are appended to the metric names. Packets that can not be sent are dropped.
+"""
+
+    def __init__(self):
+        self.address = (settings.EMAIL_CHANGE_STATSD_HOST,
+                        settings.EMAIL_CHANGE_STATSD_PORT)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def get_name(self, name, labels):
+        parts = [settings.EMAIL_CHANGE_METRICS_PREFIX, name]
+        parts.extend(str(value) for key, value in sorted(labels.items()))
+        return '.'.join(parts)
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data.encode('utf-8'), self.address)
+        except socket.error:
+            pass
+
+    def increment(self, name, value, labels):
+        self.send('%s:%d|c' % (self.get_name(name, labels), value))
+
+    def observe(self, name, seconds, labels):
+        self.send('%s:%d|ms' % (self.get_name(name, labels), seconds * 1000))
+
+
+def metrics_view(request):
+    """
+A view exposing the values of the :class:`InMemoryMetricsBackend` in the
+Prometheus text exposition format. Raises ``Http404`` if another backend is
+used.
+
+This view is not included in ``change_email.urls`` and should only be made
+reachable by the monitoring system.
+"""
+    backend = settings.EMAIL_CHANGE_METRICS_BACKEND and get_metrics()
+    if not isinstance(backend, InMemoryMetricsBackend):
+        raise Http404
+    return HttpResponse(backend.render(),
+                        content_type='text/plain; version=0.0.4')
@@ -0,0 +1,34 @@
+from change_email import routers
+from change_email.conf import settings
+
+
+class PinPrimaryDatabaseMiddleware(object):
+    """
+A middleware resetting the database routing of
+:class:`~change_email.routers.EmailChangeRouter` for every request.
+
+Requests with a method other than ``GET``, ``HEAD``, ``OPTIONS`` and
+``TRACE`` read from the primary database. After a request has written to
+it, a cookie pins the following requests of the user to the primary database
+for :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_REPLICATION_LAG`
+seconds, so that e.g. the detail page shown after creating a request does not
+read from a replica that has not received the request yet.
+"""
+    cookie_name = 'change_email_pinned'
+    """The name of the cookie pinning requests to the primary database."""
+
+    safe_methods = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+    def process_request(self, request):
+        routers.unpin()
+        if (request.method not in self.safe_methods or
+                self.cookie_name in request.COOKIES):
+            routers.pin()
+
+    def process_response(self, request, response):
+        if routers.has_written():
+            response.set_cookie(self.cookie_name, '1',
+                                max_age=settings.EMAIL_CHANGE_REPLICATION_LAG,
+                                httponly=True)
+        routers.unpin()
+        return response
@@ -1,21 +1,31 @@
+import time
 from datetime import timedelta
 
-from django.contrib.sites.models import RequestSite
 from django.contrib.sites.models import Site
 from django.core.mail import EmailMultiAlternatives
-from django.core.mail import send_mail
+from django.core.mail import get_connection
 from django.core.urlresolvers import reverse
 from django.db import models
-from django.template.loader import render_to_string
-from django.utils.translation import ugettext_lazy as _
+from django.db import router
+from django.db import transaction
+from django.utils import dateformat
 from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
 
-from django.core.signing import Signer
 from django.core.signing import BadSignature
 
 from change_email.conf import settings
+from change_email.mail import renderer
+from change_email.mail import send_messages
+from change_email.metrics import timer
+from change_email.signing import signer
+from change_email.sites import get_current_site
+from change_email.utils import import_by_path
+from change_email.utils import normalize_email
+from change_email.managers import EmailChangeManager
 from change_email.managers import ExpiredEmailChangeManager
 from change_email.managers import PendingEmailChangeManager
+from change_email.managers import get_expiration_cutoff
 
 
 class EmailChange(models.Model):
@@ -25,17 +35,31 @@ A model to temporarily store an email adress change request.
     new_email = models.EmailField(help_text=_('The new email address that'
                                               ' still needs to be confirmed.'),
                                   verbose_name=_('new email address'),)
+    normalized_email = models.CharField(editable=False,
+                                        max_length=255,
+                                        help_text=_('The normalized form of'
+                                                    ' the new email address'
+                                                    ' used for lookups.'),
+                                        verbose_name=_('normalized email'
+                                                       ' address'),)
     date = models.DateTimeField(auto_now_add=True,
+                                db_index=True,
                                 help_text=_('The date and time the email '
                                             'address change was requested.'),
                                 verbose_name=_('date'),)
+    expires_at = models.DateTimeField(db_index=True,
+                                      editable=False,
+                                      help_text=_('The date and time the'
+                                                  ' email address change'
+                                                  ' request expires.'),
+                                      verbose_name=_('expiration date'),)
     user = models.OneToOneField(settings.AUTH_USER_MODEL,
                                 help_text=_('The user that has requested the'
                                             ' email address change.'),
                                 verbose_name=_('user'),)
     site = models.ForeignKey(Site, blank=True, null=True)
 
-    objects = models.Manager()
+    objects = EmailChangeManager()
     expired_objects = ExpiredEmailChangeManager()
     pending_objects = PendingEmailChangeManager()
 
@@ -43,29 +67,81 @@ A model to temporarily store an email adress change request.
         verbose_name = _('email address change request')
         verbose_name_plural = _('email address change requests')
         get_latest_by = "date"
+        # Addresses may be requested on different sites when
+        # EMAIL_CHANGE_VALIDATE_SITE is set. save() always sets the site, as
+        # rows without one would never collide.
+        unique_together = (('normalized_email', 'site'),)
 
     def __unicode__(self):
         return "%s" % self.user
 
+    def save(self, *args, **kwargs):
+        self.normalized_email = normalize_email(self.new_email)
+        if self.site_id is None and Site._meta.installed:
+            self.site = Site.objects.get_current()
+        if self.expires_at is None:
+            date = self.date or timezone.now()
+            self.expires_at = date + timedelta(seconds=self.get_timeout())
+        return super(EmailChange, self).save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse('change_email_detail', kwargs={'pk': self.pk})
 
+    def get_confirmation_context(self, current_site):
+        """
+Returns the context used to render the confirmation mail.
+
+See :func:`send_confirmation_mail` for the context variables.
+
+:arg obj current_site: An instance of either
+    ``django.contrib.sites.models.Site`` or
+    ``django.contrib.sites.models.RequestSite``.
+:rtype: dict
+"""
+        return {'confirmation_path': self.get_confirmation_path(),
+                'current_site': current_site,
+                'date': self.date,
+                'timeout_date': self.get_expiration_date(),
+                'new_email': self.new_email,
+                'protocol': settings.EMAIL_CHANGE_USE_HTTPS and 'https' or 'http',
+                'signature': self.make_signature(),
+                'user': self.user}
+
+    def get_confirmation_mail(self, current_site):
+        """
+Renders the confirmation mail for the new email address without sending it.
+
+See :func:`send_confirmation_mail` for the templates and the context
+variables used.
+
+:arg obj current_site: An instance of either
+    ``django.contrib.sites.models.Site`` or
+    ``django.contrib.sites.models.RequestSite``.
+:returns: A message ready to be sent.
+:rtype: :py:class:`django.core.mail.EmailMultiAlternatives`
+"""
+        subject, text_message, html_message = renderer.render_confirmation(
+            self, current_site)
+        msg = EmailMultiAlternatives(subject, text_message,
+                                     settings.EMAIL_CHANGE_FROM_EMAIL,
+                                     [self.new_email])
+        if html_message is not None:
+            msg.attach_alternative(html_message, "text/html")
+        return msg
+
     def has_expired(self, seconds=None):
         """
 Checks whether this request has already expired.
 
-:kwarg int seconds: The number of seconds to calculate a
-    :py:class:`datetime.timedelta` object.
-    Defaults to :py:attr:`~password_policies.conf.Settings.EMAIL_CHANGE_TIMEOUT`.
+:kwarg int seconds: The number of seconds after its creation the request
+    expires. Defaults to the stored expiration date.
 :returns: ``True`` if the request has already expired,
     ``False`` otherwise.
 :rtype: bool
 """
-        if not seconds:
-            seconds = settings.EMAIL_CHANGE_TIMEOUT
-        delta = timedelta(seconds=seconds)
-        expiration_date = timezone.now() - delta
-        return expiration_date >= self.date
+        if seconds:
+            return get_expiration_cutoff(seconds) >= self.date
+        return self.get_expiration_date() <= timezone.now()
 
     def check_signature(self, signature):
         """
@@ -85,23 +161,103 @@ Checks if
             return self.verify_signature(signature)
         return False
 
+    def check_token(self, data):
+        """
+Checks if
+
+- the request has not expired by calling :func:`has_expired`.
+- the data loaded from a token by :func:`load_token` belongs to this
+  request and its new email address.
+
+:arg dict data: The data loaded from a token, as returned by
+    :func:`load_token`.
+:returns: ``True`` if the check was successfully completed,
+    ``False`` otherwise.
+:rtype: bool
+"""
+        if data is None or self.has_expired():
+            return False
+        return data.get('id') == self.pk and data.get('email') == self.new_email
+
+    def confirm(self):
+        """
+Saves the new email address to the user and deletes the request in a single
+transaction.
+
+The request is locked with ``SELECT ... FOR UPDATE`` first, so that
+concurrent confirmations of the same request are serialized, and only the
+email address field of the user is written. If the request has been deleted
+or changed in the meantime, e.g. by a duplicate confirmation, nothing is
+changed.
+
+:returns: ``True`` if the new email address has been saved, ``False``
+    otherwise.
+:rtype: bool
+"""
+        using = router.db_for_write(EmailChange, instance=self)
+        field = settings.EMAIL_CHANGE_FIELD
+        with transaction.commit_on_success(using=using):
+            queryset = EmailChange.objects.using(using).select_for_update()
+            try:
+                locked = queryset.get(pk=self.pk)
+            except EmailChange.DoesNotExist:
+                return False
+            if locked.new_email != self.new_email:
+                return False
+            user = self.user
+            setattr(user, field, self.new_email)
+            user.save(update_fields=[field], using=using)
+            locked.delete(using=using)
+        return True
+
+    def get_confirmation_path(self):
+        """
+Returns the path of the URL to confirm the request. The path contains a
+token generated by :func:`make_token` if
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_TIMESTAMPED_TOKENS` is
+``True`` and a signature generated by :func:`make_signature` otherwise.
+
+:rtype: str
+"""
+        if settings.EMAIL_CHANGE_TIMESTAMPED_TOKENS:
+            return reverse('change_email_confirm_token',
+                           kwargs={'token': self.make_token()})
+        return reverse('change_email_confirm',
+                       kwargs={'signature': self.make_signature()})
+
     def get_expiration_date(self, seconds=None):
         """
-Returns the expiration date of an :model:`EmailChange` object by adding
-a given amount of seconds to it.
+Returns the expiration date of an :model:`EmailChange` object, either the
+stored one or the date it has been created plus a given amount of seconds.
 
 :kwarg int seconds: The number of seconds to calculate a
     :py:class:`datetime.timedelta` object.
-    Defaults to :py:attr:`~password_policies.conf.Settings.EMAIL_CHANGE_TIMEOUT`.
+    Defaults to the stored expiration date, or to :func:`get_timeout` if
+    none has been stored yet.
 :returns:  A :py:class:`datetime` object representing the expiration
     date.
 :rtype: :py:obj:`.datetime`
 """
         if not seconds:
-            seconds = settings.EMAIL_CHANGE_TIMEOUT
+            if self.expires_at is not None:
+                return self.expires_at
+            seconds = self.get_timeout()
         delta = timedelta(seconds=seconds)
         return self.date + delta
 
+    def get_timeout(self):
+        """
+Returns the number of seconds after its creation this request expires, as
+returned by the callable set by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_TIMEOUT_CALLABLE` or
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_TIMEOUT`.
+
+:rtype: int
+"""
+        if settings.EMAIL_CHANGE_TIMEOUT_CALLABLE:
+            return import_by_path(settings.EMAIL_CHANGE_TIMEOUT_CALLABLE)(self)
+        return settings.EMAIL_CHANGE_TIMEOUT
+
     def make_signature(self):
         """
 Generates a signature to use in one-time secret URL's
@@ -110,10 +266,47 @@ to confirm the email address change request.
 :returns: A signature.
 :rtype: str
 """
-        signer = Signer()
-        value = signer.sign(self.new_email)
-        email, signature = value.split(':',  1)
-        return signature
+        return signer.signature(self.new_email)
+
+    def make_token(self):
+        """
+Generates a timestamped token to use in one-time secret URL's
+to confirm the email address change request.
+
+Unlike a signature generated by :func:`make_signature`, the token contains
+the primary key of the request, the new email address and its expiration
+date. Tampered and expired tokens are therefore rejected by
+:func:`load_token` without querying the database.
+
+:returns: A token.
+:rtype: str
+"""
+        expires = int(dateformat.format(self.get_expiration_date(), 'U'))
+        data = {'id': self.pk, 'email': self.new_email, 'expires': expires}
+        return signer.dumps(data, compress=True)
+
+    @staticmethod
+    def load_token(token):
+        """
+Loads the data of a token generated by :func:`make_token`.
+
+:arg str token: The token.
+:returns: A dictionary containing the primary key of the request as ``id``
+    and the new email address as ``email``, or ``None`` if the token has been
+    tampered with or the request has expired. Tokens issued without an
+    expiration date expire after
+    :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_TIMEOUT` seconds.
+:rtype: dict
+"""
+        try:
+            data = signer.loads(token)
+            if 'expires' not in data:
+                return signer.loads(token, max_age=settings.EMAIL_CHANGE_TIMEOUT)
+        except BadSignature:
+            return None
+        if data['expires'] <= time.time():
+            return None
+        return data
 
     def send_confirmation_mail(self, request):
         """
@@ -135,6 +328,10 @@ These templates will receive the following context variables:
 ``timeout_date``
     The date whe the request will expire.
 
+``confirmation_path``
+    The path of the URL to confirm the request, as returned by
+    :func:`get_confirmation_path`.
+
 ``current_site``
     An object representing the current site on which the user
     is logged in.  Depending on whether ``django.contrib.sites``
@@ -161,35 +358,64 @@ These templates will receive the following context variables:
 
 :arg obj request: The request object.
 """
-        if Site._meta.installed:
-            current_site = Site.objects.get_current()
-        else:
-            current_site = RequestSite(request)
-        subject = settings.EMAIL_CHANGE_SUBJECT_EMAIL_TEMPLATE
-        body_htm = settings.EMAIL_CHANGE_HTML_EMAIL_TEMPLATE
-        body_txt = settings.EMAIL_CHANGE_TXT_EMAIL_TEMPLATE
-        context = {'current_site': current_site,
-                    'date': self.date,
-                    'timeout_date': self.get_expiration_date(),
-                    'new_email': self.new_email,
-                    'protocol': settings.EMAIL_CHANGE_USE_HTTPS and 'https' or 'http',
-                    'signature': self.make_signature(),
-                    'user': self.user}
-        subject = render_to_string(subject, context)
-        # Email subject *must not* contain newlines
-        subject = ''.join(subject.splitlines())
-        text_message = render_to_string(body_txt, context)
-        if settings.EMAIL_CHANGE_HTML_EMAIL:
-            html_message = render_to_string(body_htm, context)
-            msg = EmailMultiAlternatives(subject, text_message,
-                                         settings.EMAIL_CHANGE_FROM_EMAIL,
-                                         [self.new_email])
-            msg.attach_alternative(html_message, "text/html")
-            msg.send()
-        else:
-            send_mail(subject, text_message,
-                      settings.EMAIL_CHANGE_FROM_EMAIL,
-                      [self.new_email])
+        current_site = get_current_site(request)
+        message = self.get_confirmation_mail(current_site)
+        with timer('mail_send_seconds'):
+            message.send()
+
+    @classmethod
+    def send_confirmation_mails(cls, email_changes, request, batch_size=None,
+                                connection=None):
+        """
+Sends confirmation mails for many :model:`EmailChange` objects through a
+single connection.
+
+The mails are rendered and sent in chunks of ``batch_size`` objects, so that
+only a chunk of rendered mails is kept in memory at a time. A failure to send
+one mail does not prevent the remaining mails from being sent.
+
+:arg email_changes: An iterable of :model:`EmailChange` objects, e.g. a
+    queryset.
+:arg obj request: The request object.
+:kwarg int batch_size: The number of mails rendered at once. Defaults to
+    :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_MAIL_BATCH_SIZE`.
+:kwarg obj connection: An email backend instance, defaults to the one returned
+    by :py:func:`django.core.mail.get_connection`.
+:returns: A tuple of the number of sent mails and a list of
+    ``(email_change, exception)`` tuples for every mail that could not be
+    sent.
+:rtype: tuple
+"""
+        if batch_size is None:
+            batch_size = settings.EMAIL_CHANGE_MAIL_BATCH_SIZE
+        if connection is None:
+            connection = get_connection()
+        current_site = get_current_site(request)
+        failures = []
+
+        def send_chunk(chunk):
+            messages = [email_change.get_confirmation_mail(current_site)
+                        for email_change in chunk]
+            failed = send_messages(messages, connection=connection)
+            for message, e in failed:
+                failures.append((chunk[messages.index(message)], e))
+            return len(chunk) - len(failed)
+
+        sent = 0
+        chunk = []
+        opened = connection.open()
+        try:
+            for email_change in email_changes:
+                chunk.append(email_change)
+                if len(chunk) >= batch_size:
+                    sent += send_chunk(chunk)
+                    chunk = []
+            if chunk:
+                sent += send_chunk(chunk)
+        finally:
+            if opened:
+                connection.close()
+        return sent, failures
 
     def verify_signature(self, signature):
         """
@@ -201,10 +427,55 @@ Checks if the signature has been tampered with.
     ``False`` otherwise.
     :rtype: bool
     """
-        signer = Signer()
-        value = "%s:%s" % (self.new_email, signature)
-        try:
-            signer.unsign(value)
-        except BadSignature:
-            return False
-        return True
+        return signer.verify(self.new_email, signature)
+
+
+class QueuedConfirmationMail(models.Model):
+    """
+A model to store confirmation mails that still need to be sent by
+:class:`~change_email.queues.DatabaseMailQueue`.
+"""
+    email_change = models.ForeignKey(EmailChange,
+                                     help_text=_('The email address change'
+                                                 ' request to confirm.'),
+                                     verbose_name=_('email address change'
+                                                    ' request'),)
+    domain = models.CharField(max_length=100,
+                              help_text=_('The domain used to generate the'
+                                          ' confirmation link if the sites'
+                                          ' framework is not installed.'),
+                              verbose_name=_('domain'),)
+    date = models.DateTimeField(auto_now_add=True,
+                                help_text=_('The date and time the mail'
+                                            ' was queued.'),
+                                verbose_name=_('date'),)
+    attempts = models.PositiveIntegerField(default=0,
+                                           help_text=_('The number of failed'
+                                                       ' attempts to send'
+                                                       ' the mail.'),
+                                           verbose_name=_('attempts'),)
+    last_error = models.TextField(blank=True,
+                                  help_text=_('The error raised by the last'
+                                              ' failed attempt.'),
+                                  verbose_name=_('last error'),)
+    claimed_by = models.CharField(max_length=32,
+                                  blank=True,
+                                  editable=False,
+                                  help_text=_('The worker sending the mail.'),
+                                  verbose_name=_('claimed by'),)
+    claimed_at = models.DateTimeField(blank=True,
+                                      null=True,
+                                      db_index=True,
+                                      editable=False,
+                                      help_text=_('The date and time the mail'
+                                                  ' was last claimed by a'
+                                                  ' worker.'),
+                                      verbose_name=_('claimed at'),)
+
+    class Meta:
+        verbose_name = _('queued confirmation mail')
+        verbose_name_plural = _('queued confirmation mails')
+        ordering = ('pk',)
+
+    def __unicode__(self):
+        return "%s" % self.email_change.new_email
@@ -0,0 +1,244 @@
+import datetime
+import logging
+import threading
+import uuid
+import Queue
+
+from django.contrib.sites.models import Site
+from django.db.models import Q
+from django.utils import timezone
+
+from change_email.conf import settings
+from change_email.mail import send_messages
+from change_email.models import EmailChange
+from change_email.models import QueuedConfirmationMail
+from change_email.sites import get_current_site
+from change_email.sites import get_site_by_domain
+from change_email.utils import import_by_path
+
+
+logger = logging.getLogger(__name__)
+
+_mail_queues = {}
+_mail_queues_lock = threading.Lock()
+
+
+def get_mail_queue(path=None):
+    """
+Returns the mail queue used to send confirmation mails.
+
+Queues are instantiated once per process so that background threads and
+connections can be shared between requests.
+
+:kwarg str path: The dotted path to a :class:`BaseMailQueue` subclass.
+    Defaults to :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_MAIL_QUEUE`.
+:returns: An instance of the mail queue.
+:rtype: :class:`BaseMailQueue`
+"""
+    if path is None:
+        path = settings.EMAIL_CHANGE_MAIL_QUEUE
+    with _mail_queues_lock:
+        if path not in _mail_queues:
+            _mail_queues[path] = import_by_path(path)()
+        return _mail_queues[path]
+
+
+class BaseMailQueue(object):
+    """
+Base class of all mail queues.
+"""
+
+    def enqueue(self, email_change, request):
+        """
+Schedules the confirmation mail of an :model:`EmailChange` object.
+
+:arg obj email_change: An instance of :model:`EmailChange`.
+:arg obj request: The request object.
+"""
+        raise NotImplementedError
+
+    def enqueue_many(self, email_changes, request=None):
+        """
+Schedules the confirmation mails of many :model:`EmailChange` objects, e.g.
+when importing requests with
+:func:`~change_email.managers.EmailChangeManager.bulk_request`.
+
+:arg email_changes: An iterable of :model:`EmailChange` objects.
+:kwarg obj request: The request object, if any. Without a request the site
+    set by ``SITE_ID`` is used.
+"""
+        raise NotImplementedError
+
+
+class SynchronousMailQueue(BaseMailQueue):
+    """
+A mail queue that sends confirmation mails immediately.
+"""
+
+    def enqueue(self, email_change, request):
+        email_change.send_confirmation_mail(request)
+
+    def enqueue_many(self, email_changes, request=None):
+        sent, failures = EmailChange.send_confirmation_mails(email_changes,
+                                                             request)
+        for email_change, e in failures:
+            logger.error('Confirmation mail to %s could not be sent: %s',
+                         email_change.new_email, e)
+
+
+class ThreadPoolMailQueue(BaseMailQueue):
+    """
+A mail queue that renders confirmation mails while processing the request
+and sends them from a pool of background threads.
+
+The number of threads can be set with
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_MAIL_QUEUE_THREADS`.
+Each thread sends up to
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_MAIL_BATCH_SIZE`
+waiting mails through a single connection.
+"""
+
+    def __init__(self, threads=None, batch_size=None):
+        self.threads = threads or settings.EMAIL_CHANGE_MAIL_QUEUE_THREADS
+        self.batch_size = batch_size or settings.EMAIL_CHANGE_MAIL_BATCH_SIZE
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def enqueue(self, email_change, request):
+        message = email_change.get_confirmation_mail(get_current_site(request))
+        self.start()
+        self.queue.put(message)
+
+    def enqueue_many(self, email_changes, request=None):
+        current_site = get_current_site(request)
+        self.start()
+        for email_change in email_changes:
+            self.queue.put(email_change.get_confirmation_mail(current_site))
+
+    def join(self):
+        """
+Blocks until all queued mails have been processed.
+"""
+        self.queue.join()
+
+    def start(self):
+        """
+Starts the worker threads unless they are already running.
+"""
+        with self.lock:
+            while len(self.workers) < self.threads:
+                worker = threading.Thread(target=self.work,
+                                          name='change-email-mail-%d' % len(self.workers))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def work(self):
+        while True:
+            messages = [self.queue.get()]
+            while len(messages) < self.batch_size:
+                try:
+                    messages.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                for message, e in send_messages(messages):
+                    logger.error('Confirmation mail to %s could not be sent: %s',
+                                 ', '.join(message.to), e)
+            except Exception:
+                logger.exception('Confirmation mails could not be sent.')
+            finally:
+                for message in messages:
+                    self.queue.task_done()
+
+
+class DatabaseMailQueue(BaseMailQueue):
+    """
+A mail queue that stores confirmation mails in the database.
+
+Queued mails are sent by the :command:`processemailchangequeue` management
+command.
+"""
+
+    def enqueue(self, email_change, request):
+        QueuedConfirmationMail.objects.create(email_change=email_change,
+                                              domain=request.get_host())
+
+    def enqueue_many(self, email_changes, request=None):
+        if request is not None:
+            domain = request.get_host()
+        else:
+            domain = get_current_site().domain
+        QueuedConfirmationMail.objects.bulk_create([
+            QueuedConfirmationMail(email_change=email_change, domain=domain)
+            for email_change in email_changes])
+
+    def get_site(self, domain):
+        """
+Returns the site used to render a queued mail.
+
+:arg str domain: The host of the request that created the mail.
+"""
+        if not Site._meta.installed:
+            return Site(domain=domain, name=domain)
+        if settings.EMAIL_CHANGE_SITE_FROM_REQUEST:
+            site = get_site_by_domain(domain)
+            if site is not None:
+                return site
+        return Site.objects.get_current()
+
+    def process(self, batch_size=None):
+        """
+Sends a batch of queued mails through a single connection.
+
+The mails are claimed first, so that concurrent workers never send the same
+mail. Mails that have been sent are removed from the queue. Mails that could
+not be sent keep their claim and are retried once it has expired after
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_MAIL_QUEUE_CLAIM_TIMEOUT`
+seconds, until they have failed
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_MAIL_QUEUE_MAX_ATTEMPTS`
+times. Claims of workers that died while sending expire the same way.
+
+:kwarg int batch_size: The maximum number of mails to send. Defaults to
+    :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_MAIL_BATCH_SIZE`.
+:returns: A tuple of the number of sent and failed mails.
+:rtype: tuple
+"""
+        if batch_size is None:
+            batch_size = settings.EMAIL_CHANGE_MAIL_BATCH_SIZE
+        max_attempts = settings.EMAIL_CHANGE_MAIL_QUEUE_MAX_ATTEMPTS
+        now = timezone.now()
+        expired = now - datetime.timedelta(
+            seconds=settings.EMAIL_CHANGE_MAIL_QUEUE_CLAIM_TIMEOUT)
+        available = QueuedConfirmationMail.objects.filter(attempts__lt=max_attempts)
+        available = available.filter(Q(claimed_at__isnull=True) |
+                                     Q(claimed_at__lt=expired))
+        pks = list(available.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return 0, 0
+        owner = uuid.uuid4().hex
+        # The UPDATE checks the claim again, so that rows claimed by another
+        # worker since they have been selected are skipped.
+        available.filter(pk__in=pks).update(claimed_by=owner, claimed_at=now)
+        queryset = QueuedConfirmationMail.objects.filter(claimed_by=owner)
+        jobs = list(queryset.select_related('email_change__user'))
+        if not jobs:
+            return 0, 0
+        messages = []
+        for job in jobs:
+            current_site = self.get_site(job.domain)
+            messages.append(job.email_change.get_confirmation_mail(current_site))
+        failures = send_messages(messages)
+        failed = set()
+        for message, e in failures:
+            job = jobs[messages.index(message)]
+            logger.error('Confirmation mail to %s could not be sent: %s',
+                         job.email_change.new_email, e)
+            job.attempts += 1
+            job.last_error = u"%s" % e
+            job.save()
+            failed.add(job.pk)
+        sent = [job.pk for job in jobs if job.pk not in failed]
+        queryset.filter(pk__in=sent).delete()
+        return len(sent), len(failures)
@@ -0,0 +1,105 @@
+import random
+import threading
+
+from django.contrib.auth import get_user_model
+
+from change_email.conf import settings
+
+
+_local = threading.local()
+
+
+def pin():
+    """
+Sends the reads of the current thread to the primary database set by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_PRIMARY_DATABASE` until
+:func:`unpin` is called.
+"""
+    _local.pinned = True
+
+
+def unpin():
+    """
+Resets the routing state of the current thread, e.g. at the end of a request.
+"""
+    _local.__dict__.clear()
+
+
+def is_pinned():
+    return getattr(_local, 'pinned', False)
+
+
+def has_written():
+    """
+Checks if the current thread has written to the primary database since
+:func:`unpin` was last called.
+
+:rtype: bool
+"""
+    return getattr(_local, 'written', False)
+
+
+def get_read_database():
+    """
+Returns the database alias to read email address change requests from, or
+``None`` if :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_REPLICA_DATABASES`
+is empty.
+
+The primary database is returned if the current thread is pinned to it.
+Otherwise a replica is picked at random once per thread, so that all reads
+of a request, including subqueries, go to the same replica.
+"""
+    replicas = settings.EMAIL_CHANGE_REPLICA_DATABASES
+    if not replicas:
+        return None
+    if is_pinned():
+        return settings.EMAIL_CHANGE_PRIMARY_DATABASE
+    replica = getattr(_local, 'replica', None)
+    if replica not in replicas:
+        replica = _local.replica = random.choice(replicas)
+    return replica
+
+
+class EmailChangeRouter(object):
+    """
+A database router sending reads of the models of ``change_email`` to the
+replicas set by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_REPLICA_DATABASES` and
+their writes to the primary database set by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_PRIMARY_DATABASE`.
+
+Once a thread writes to these models or to the user model, its reads are
+pinned to the primary database (see :func:`pin`), so that it never reads
+stale data from a lagging replica. Use
+:class:`~change_email.middleware.PinPrimaryDatabaseMiddleware` to reset the
+pinning for every request and to keep it for the following requests of the
+user.
+"""
+    app_label = 'change_email'
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != self.app_label:
+            return None
+        return get_read_database()
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            pin()
+            _local.written = True
+            return settings.EMAIL_CHANGE_PRIMARY_DATABASE
+        if model is get_user_model():
+            pin()
+            _local.written = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = set(settings.EMAIL_CHANGE_REPLICA_DATABASES)
+        databases.add(settings.EMAIL_CHANGE_PRIMARY_DATABASE)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if model._meta.app_label != self.app_label:
+            return None
+        return db not in settings.EMAIL_CHANGE_REPLICA_DATABASES
@@ -2,10 +2,17 @@ from django.dispatch import Signal
 
 
 # A user has completed a change of email address.
-email_change_confirmed = Signal(providing_args=["request"])
+email_change_confirmed = Signal(providing_args=["request", "duration"])
 
 # A user has requested a change of email address.
-email_change_created = Signal(providing_args=["request"])
+email_change_created = Signal(providing_args=["request", "duration"])
 
 # A user has deleted a change of email address.
-email_change_deleted = Signal(providing_args=["request"])
+email_change_deleted = Signal(providing_args=["request", "duration"])
+
+# A user has changed the new email address of a pending change of email
+# address.
+email_change_updated = Signal(providing_args=["request", "duration"])
+
+# A batch of expired changes of email address has been deleted.
+email_change_expired = Signal(providing_args=["pks", "duration"])
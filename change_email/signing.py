@@ -0,0 +1,161 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+import zlib
+
+from django.conf import settings as django_settings
+from django.core.signing import BadSignature
+from django.core.signing import SignatureExpired
+from django.core.signing import b64_decode
+from django.core.signing import b64_encode
+from django.utils import baseconv
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_bytes
+from django.utils.encoding import force_text
+
+from change_email.conf import settings
+
+
+class SigningService(object):
+    """
+Signs values and timestamped tokens with HMAC-SHA1.
+
+The keyed HMAC objects are derived once per process from the secret keys and
+salts set by
+
+* :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_SECRET_KEY`
+* :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_SECRET_KEY_FALLBACKS`
+* :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_SIGNING_SALT`
+* :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_SIGNING_SALT_FALLBACKS`
+
+and copied for every signature. New signatures are always made with the
+first key and salt, signatures are verified against every combination of keys
+and salts so that keys can be rotated without invalidating outstanding links.
+Keys are derived like :class:`django.core.signing.Signer` does, so
+signatures made by earlier versions of django-change-email remain valid as
+long as its default salt is listed in the salt fallbacks.
+"""
+
+    def __init__(self):
+        self.config = None
+        self.hmacs = {}
+        self.lock = threading.Lock()
+
+    def get_config(self):
+        secret_key = settings.EMAIL_CHANGE_SECRET_KEY or django_settings.SECRET_KEY
+        keys = (secret_key,) + tuple(settings.EMAIL_CHANGE_SECRET_KEY_FALLBACKS)
+        salts = ((settings.EMAIL_CHANGE_SIGNING_SALT,) +
+                 tuple(settings.EMAIL_CHANGE_SIGNING_SALT_FALLBACKS))
+        return keys, salts
+
+    def get_hmacs(self, purpose):
+        """
+Returns the keyed HMAC objects for a purpose, the one used to sign first.
+
+:arg str purpose: Either ``'signer'`` for signatures or ``'token'`` for
+    timestamped tokens.
+:rtype: list
+"""
+        config = self.get_config()
+        if config != self.config:
+            with self.lock:
+                self.config = config
+                self.hmacs = {}
+        hmacs = self.hmacs.get(purpose)
+        if hmacs is None:
+            keys, salts = config
+            hmacs = []
+            for salt in salts:
+                for key in keys:
+                    key_salt = force_bytes(salt + purpose)
+                    derived = hashlib.sha1(key_salt + force_bytes(key)).digest()
+                    hmacs.append(hmac.new(derived, digestmod=hashlib.sha1))
+            self.hmacs[purpose] = hmacs
+        return hmacs
+
+    def signature(self, value, purpose='signer'):
+        """
+Returns the signature of a value.
+
+:arg str value: The value to sign.
+:rtype: str
+"""
+        signer = self.get_hmacs(purpose)[0].copy()
+        signer.update(force_bytes(value))
+        return force_text(b64_encode(signer.digest()))
+
+    def verify(self, value, signature, purpose='signer'):
+        """
+Checks a signature of a value against all keys and salts.
+
+:arg str value: The signed value.
+:arg str signature: The signature to check.
+:returns: ``True`` if the signature is valid, ``False`` otherwise.
+:rtype: bool
+"""
+        value = force_bytes(value)
+        signature = force_bytes(signature)
+        valid = False
+        for base in self.get_hmacs(purpose):
+            signer = base.copy()
+            signer.update(value)
+            if constant_time_compare(b64_encode(signer.digest()), signature):
+                valid = True
+        return valid
+
+    def dumps(self, obj, compress=False):
+        """
+Returns a timestamped and signed token containing a JSON-serializable
+object. The token has the same format as the tokens generated by
+:func:`django.core.signing.dumps`.
+
+:arg obj obj: The object.
+:kwarg bool compress: Whether to compress the data with zlib if it is
+    shorter.
+:rtype: str
+"""
+        data = force_bytes(json.dumps(obj, separators=(',', ':')))
+        is_compressed = False
+        if compress:
+            compressed = zlib.compress(data)
+            if len(compressed) < (len(data) - 1):
+                data = compressed
+                is_compressed = True
+        base64d = force_text(b64_encode(data))
+        if is_compressed:
+            base64d = '.' + base64d
+        value = '%s:%s' % (base64d, baseconv.base62.encode(int(time.time())))
+        return '%s:%s' % (value, self.signature(value, purpose='token'))
+
+    def loads(self, token, max_age=None):
+        """
+Returns the object contained in a token generated by :func:`dumps`.
+
+:arg str token: The token.
+:kwarg int max_age: The maximum age of the token in seconds.
+:raises: :py:exc:`django.core.signing.BadSignature` if the token has been
+    tampered with and :py:exc:`django.core.signing.SignatureExpired` if it
+    is older than ``max_age``.
+"""
+        token = force_text(token)
+        if token.count(':') != 2:
+            raise BadSignature('Malformed token "%s"' % token)
+        value, signature = token.rsplit(':', 1)
+        if not self.verify(value, signature, purpose='token'):
+            raise BadSignature('Signature "%s" does not match' % signature)
+        base64d, timestamp = value.split(':')
+        if max_age is not None:
+            age = time.time() - baseconv.base62.decode(timestamp)
+            if age > max_age:
+                raise SignatureExpired('Signature age %s > %s seconds' %
+                                       (age, max_age))
+        is_compressed = base64d.startswith('.')
+        data = b64_decode(force_bytes(base64d.lstrip('.')))
+        if is_compressed:
+            data = zlib.decompress(data)
+        return json.loads(force_text(data))
+
+
+signer = SigningService()
@@ -0,0 +1,90 @@
+import threading
+
+from django.contrib.sites.models import RequestSite
+from django.contrib.sites.models import Site
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+from change_email.conf import settings
+
+
+_sites_by_domain = None
+_sites_lock = threading.Lock()
+
+
+def clear_site_cache(sender=None, **kwargs):
+    """
+Clears the cache of sites by domain. Connected to the ``post_save`` and
+``post_delete`` signals of ``django.contrib.sites.models.Site``.
+"""
+    global _sites_by_domain
+    with _sites_lock:
+        _sites_by_domain = None
+post_save.connect(clear_site_cache, sender=Site)
+post_delete.connect(clear_site_cache, sender=Site)
+
+
+def get_site_by_domain(domain):
+    """
+Returns the site with the given domain, or ``None`` if there is none.
+
+All sites are loaded with a single query the first time this function is
+called and kept in memory until a site is saved or deleted. A port included
+in the domain is ignored if no site matches the domain with the port.
+
+:arg str domain: A domain, e.g. as returned by ``request.get_host()``.
+:rtype: ``django.contrib.sites.models.Site``
+"""
+    global _sites_by_domain
+    sites = _sites_by_domain
+    if sites is None:
+        sites = dict((site.domain.lower(), site)
+                     for site in Site.objects.all())
+        with _sites_lock:
+            _sites_by_domain = sites
+    domain = domain.lower()
+    site = sites.get(domain)
+    if site is None and ':' in domain:
+        site = sites.get(domain.rsplit(':', 1)[0])
+    return site
+
+
+def get_current_site(request=None):
+    """
+Returns the current site.
+
+If ``django.contrib.sites`` is not installed, an instance of
+``django.contrib.sites.models.RequestSite`` is returned. Otherwise, if
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_SITE_FROM_REQUEST` is
+``True`` and a request is given, the site matching the requested host is
+returned by :func:`get_site_by_domain`. In all other cases the site set by
+the ``SITE_ID`` setting is returned by
+``Site.objects.get_current()``, which is cached by Django.
+
+:kwarg obj request: The request object.
+:rtype: ``django.contrib.sites.models.Site`` or
+    ``django.contrib.sites.models.RequestSite``
+"""
+    if not Site._meta.installed:
+        return RequestSite(request)
+    if request is not None and settings.EMAIL_CHANGE_SITE_FROM_REQUEST:
+        site = get_site_by_domain(request.get_host())
+        if site is not None:
+            return site
+    return Site.objects.get_current()
+
+
+def filter_users_by_site(queryset, site):
+    """
+Filters a queryset of users by their ``site`` field, if the user model has
+one. Users of models without a site are used on all sites.
+
+:arg queryset: A queryset of the user model.
+:arg obj site: A site.
+"""
+    try:
+        queryset.model._meta.get_field('site')
+    except FieldDoesNotExist:
+        return queryset
+    return queryset.filter(site=site)
@@ -0,0 +1,351 @@
+import datetime
+import hashlib
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.contrib.sites.models import Site
+from django.core.cache import get_cache
+from django.db import IntegrityError
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+
+from change_email import bloom
+from change_email.conf import settings
+from change_email.models import EmailChange
+from change_email.utils import import_by_path
+from change_email.utils import normalize_email
+
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage(path=None):
+    """
+Returns the storage of pending email address change requests.
+
+Storages are instantiated once per process.
+
+:kwarg str path: The dotted path to a :class:`BaseStorage` subclass.
+    Defaults to :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_STORAGE`.
+:rtype: :class:`BaseStorage`
+"""
+    if path is None:
+        path = settings.EMAIL_CHANGE_STORAGE
+    with _storages_lock:
+        if path not in _storages:
+            _storages[path] = import_by_path(path)()
+        return _storages[path]
+
+
+class BaseStorage(object):
+    """
+Base class of all storages of pending email address change requests.
+
+Storages hand out :model:`EmailChange` instances, so that checking
+signatures and tokens and sending confirmation mails work the same way with
+every storage.
+"""
+    in_database = False
+    """
+Determines if the requests are kept in the :model:`EmailChange` table, and
+their addresses are therefore included in the Bloom filter of
+:mod:`change_email.bloom`.
+"""
+
+    def get_for_user(self, user):
+        """
+Returns the pending request of a user, or ``None``.
+
+:arg obj user: The user.
+:rtype: :model:`EmailChange`
+"""
+        raise NotImplementedError
+
+    def create(self, email_change):
+        """
+Stores a new request.
+
+:arg obj email_change: An unsaved instance of :model:`EmailChange` with its
+    user and new email address set.
+:raises: :py:exc:`django.db.IntegrityError` if the user already has a
+    pending request or the address is used by one.
+"""
+        raise NotImplementedError
+
+    def update(self, email_change):
+        """
+Replaces the new email address of a pending request with the one set on
+``email_change`` and restarts its expiration, so that links sent for the
+previous address can no longer be used to confirm it.
+
+:arg obj email_change: An instance of :model:`EmailChange` returned by
+    :func:`get_for_user`, with its new email address changed.
+:returns: ``True`` if the request has been updated, ``False`` if it has been
+    deleted or confirmed in the meantime.
+:raises: :py:exc:`django.db.IntegrityError` if the address is used by
+    another pending request.
+:rtype: bool
+"""
+        raise NotImplementedError
+
+    def delete(self, email_change):
+        """
+Deletes a request.
+
+:arg obj email_change: An instance of :model:`EmailChange`.
+"""
+        raise NotImplementedError
+
+    def confirm(self, email_change):
+        """
+Saves the new email address to the user and deletes the request.
+
+:arg obj email_change: An instance of :model:`EmailChange`.
+:returns: ``True`` if the new email address has been saved, ``False`` if the
+    request has been deleted or changed in the meantime.
+:rtype: bool
+"""
+        raise NotImplementedError
+
+    def get_pending_lookup(self, normalized_email, site=None):
+        """
+Returns a queryset of the pending requests for an address, checked in the
+same query as the users by :validator:`EmailNotUsedValidator`. Storages
+keeping requests outside the database return ``True`` if they have found a
+request themselves and ``None`` otherwise.
+
+:arg str normalized_email: The address, as returned by
+    :func:`~change_email.utils.normalize_email`.
+:kwarg obj site: Only consider requests made on this site.
+"""
+        raise NotImplementedError
+
+
+class DatabaseStorage(BaseStorage):
+    """
+A storage keeping requests in the :model:`EmailChange` table.
+
+Expired requests need to be deleted with the
+:command:`cleanupemailchangerequests` management command.
+"""
+    in_database = True
+
+    def get_for_user(self, user):
+        queryset = EmailChange.objects.select_related('user', 'site')
+        try:
+            return queryset.get(user=user)
+        except EmailChange.DoesNotExist:
+            return None
+
+    def create(self, email_change):
+        email_change.save(force_insert=True)
+
+    def update(self, email_change):
+        date = timezone.now()
+        values = {
+            'new_email': email_change.new_email,
+            'normalized_email': normalize_email(email_change.new_email),
+            'date': date,
+            'expires_at': date + datetime.timedelta(
+                seconds=email_change.get_timeout()),
+        }
+        queryset = EmailChange.objects.filter(pk=email_change.pk)
+        if not queryset.update(**values):
+            return False
+        bloom.add(email_change.new_email)
+        for name, value in values.items():
+            setattr(email_change, name, value)
+        return True
+
+    def delete(self, email_change):
+        email_change.delete()
+
+    def confirm(self, email_change):
+        return email_change.confirm()
+
+    def get_pending_lookup(self, normalized_email, site=None):
+        queryset = EmailChange.objects.filter(normalized_email=normalized_email)
+        if site is not None:
+            queryset = queryset.filter(site=site)
+        return queryset
+
+
+class CacheStorage(BaseStorage):
+    """
+A storage keeping requests in the cache set by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_STORAGE_CACHE`.
+
+Requests expire with the cache entries at their expiration date, so no clean
+up is needed. A second entry per request maps its normalized address to
+its user, to check if an address is used by a pending request. The cache must
+be shared by all processes and should not evict entries early, e.g. Redis
+without an eviction policy.
+
+Updates and confirmations of a request hold a lock entry added with
+``cache.add()``, so that a request can not be confirmed twice and an update
+racing a confirmation can not store the confirmed request again.
+
+Requests kept in the cache can not be managed in the admin interface,
+imported with :command:`bulkemailchange`, exported or queued by
+:class:`~change_email.queues.DatabaseMailQueue`, as these rely on the
+:model:`EmailChange` table.
+"""
+    prefix = 'change_email.request'
+
+    lock_timeout = 10
+    """The number of seconds after which a lock held by a dead process
+expires."""
+
+    lock_attempts = 20
+    """The number of attempts to take a lock, 50 milliseconds apart."""
+
+    def __init__(self):
+        self.cache = get_cache(settings.EMAIL_CHANGE_STORAGE_CACHE)
+
+    def get_user_key(self, user_id):
+        return '%s.user.%s' % (self.prefix, user_id)
+
+    def get_email_key(self, normalized_email, site_id=None):
+        """
+Returns the key of the entry mapping an address to the user requesting it.
+
+The key includes the site if
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_VALIDATE_SITE` is set, so
+that an address can be requested once per site, as in the
+:model:`EmailChange` table.
+"""
+        digest = hashlib.md5(force_bytes(normalized_email)).hexdigest()
+        if settings.EMAIL_CHANGE_VALIDATE_SITE:
+            return '%s.email.%s.%s' % (self.prefix, site_id, digest)
+        return '%s.email.%s' % (self.prefix, digest)
+
+    def get_lock_key(self, user_id):
+        return '%s.lock.%s' % (self.prefix, user_id)
+
+    @contextmanager
+    def lock(self, user_id):
+        """
+Holds the lock of the request of a user.
+
+:arg int user_id: The primary key of the user.
+:returns: A context manager returning ``True`` if the lock has been taken,
+    ``False`` if it is still held by another process after
+    :py:attr:`lock_attempts` attempts.
+"""
+        key = self.get_lock_key(user_id)
+        for attempt in range(self.lock_attempts):
+            if self.cache.add(key, 1, self.lock_timeout):
+                break
+            time.sleep(0.05)
+        else:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self.cache.delete(key)
+
+    def get_timeout(self, email_change):
+        remaining = email_change.expires_at - timezone.now()
+        return max(int(remaining.total_seconds()), 1)
+
+    def get_for_user(self, user):
+        data = self.cache.get(self.get_user_key(user.pk))
+        if data is None:
+            return None
+        email_change = EmailChange(**data)
+        email_change.user = user
+        return email_change
+
+    def create(self, email_change):
+        email_change.date = timezone.now()
+        email_change.expires_at = email_change.date + datetime.timedelta(
+            seconds=email_change.get_timeout())
+        email_change.normalized_email = normalize_email(email_change.new_email)
+        email_change.pk = random.SystemRandom().randint(1, 2 ** 52)
+        if email_change.site_id is None and Site._meta.installed:
+            email_change.site = Site.objects.get_current()
+        timeout = self.get_timeout(email_change)
+        email_key = self.get_email_key(email_change.normalized_email,
+                                       email_change.site_id)
+        if not self.cache.add(email_key, email_change.user_id, timeout):
+            raise IntegrityError('The email address is used by a pending'
+                                 ' request.')
+        data = {
+            'id': email_change.pk,
+            'user_id': email_change.user_id,
+            'new_email': email_change.new_email,
+            'normalized_email': email_change.normalized_email,
+            'date': email_change.date,
+            'expires_at': email_change.expires_at,
+            'site_id': email_change.site_id,
+        }
+        if not self.cache.add(self.get_user_key(email_change.user_id), data,
+                              timeout):
+            self.cache.delete(email_key)
+            raise IntegrityError('The user has a pending request.')
+
+    def update(self, email_change):
+        with self.lock(email_change.user_id) as locked:
+            if not locked:
+                return False
+            user_key = self.get_user_key(email_change.user_id)
+            data = self.cache.get(user_key)
+            if data is None or data['id'] != email_change.pk:
+                return False
+            email_change.normalized_email = normalize_email(email_change.new_email)
+            email_change.date = timezone.now()
+            email_change.expires_at = email_change.date + datetime.timedelta(
+                seconds=email_change.get_timeout())
+            timeout = self.get_timeout(email_change)
+            old_email_key = self.get_email_key(data['normalized_email'],
+                                               data['site_id'])
+            email_key = self.get_email_key(email_change.normalized_email,
+                                           data['site_id'])
+            if email_key == old_email_key:
+                self.cache.set(email_key, email_change.user_id, timeout)
+            elif not self.cache.add(email_key, email_change.user_id, timeout):
+                raise IntegrityError('The email address is used by a pending'
+                                     ' request.')
+            data.update({
+                'new_email': email_change.new_email,
+                'normalized_email': email_change.normalized_email,
+                'date': email_change.date,
+                'expires_at': email_change.expires_at,
+            })
+            self.cache.set(user_key, data, timeout)
+            if email_key != old_email_key:
+                self.cache.delete(old_email_key)
+            return True
+
+    def delete(self, email_change):
+        self.cache.delete_many([self.get_user_key(email_change.user_id),
+                                self.get_email_key(email_change.normalized_email,
+                                                   email_change.site_id)])
+
+    def confirm(self, email_change):
+        user_key = self.get_user_key(email_change.user_id)
+        with self.lock(email_change.user_id) as locked:
+            if not locked:
+                return False
+            data = self.cache.get(user_key)
+            if data is None or data['id'] != email_change.pk:
+                return False
+            # The request is kept if the user can not be saved.
+            field = settings.EMAIL_CHANGE_FIELD
+            user = email_change.user
+            setattr(user, field, data['new_email'])
+            user.save(update_fields=[field])
+            self.cache.delete_many([user_key,
+                                    self.get_email_key(data['normalized_email'],
+                                                       data['site_id'])])
+        return True
+
+    def get_pending_lookup(self, normalized_email, site=None):
+        site_id = site.pk if site is not None else None
+        if self.cache.get(self.get_email_key(normalized_email, site_id)) is None:
+            return None
+        return True
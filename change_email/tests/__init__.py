@@ -1,3 +1,15 @@
 from change_email.tests.models import *
 from change_email.tests.forms import *
 from change_email.tests.views import *
+from change_email.tests.queues import *
+from change_email.tests.mail import *
+from change_email.tests.benchmarks import *
+from change_email.tests.sites import *
+from change_email.tests.signing import *
+from change_email.tests.throttle import *
+from change_email.tests.metrics import *
+from change_email.tests.export import *
+from change_email.tests.admin import *
+from change_email.tests.storage import *
+from change_email.tests.bloom import *
+from change_email.tests.routers import *
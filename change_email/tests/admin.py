@@ -0,0 +1,126 @@
+import datetime
+
+from django.contrib import messages
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+
+from change_email import admin
+from change_email.conf import settings
+from change_email.models import EmailChange
+from change_email.tests.lib import BaseTest
+from change_email.throttle import clear_counter
+
+
+class EmailChangeAdminTestCase(BaseTest):
+
+    fixtures = ['django_change_email_test_views_fixtures.json']
+
+    def setUp(self):
+        output = super(EmailChangeAdminTestCase, self).setUp()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.url = reverse('admin:change_email_emailchange_changelist')
+        for i in range(5):
+            user = User.objects.create_user('user%d' % i)
+            EmailChange.objects.create(new_email='User%d@example.com' % i,
+                                       user=user)
+        self.expired = EmailChange.objects.get(user__username='user0')
+        self.expired.date -= datetime.timedelta(seconds=settings.EMAIL_CHANGE_TIMEOUT + 1)
+        self.expired.expires_at -= datetime.timedelta(seconds=settings.EMAIL_CHANGE_TIMEOUT + 1)
+        self.expired.save()
+        return output
+
+    def get_results(self, data=None):
+        response = self.client.get(self.url, data or {})
+        self.assertEqual(response.status_code, 200)
+        return sorted(object.user.username
+                      for object in response.context['cl'].result_list)
+
+    def test_changelist_queries(self):
+        """
+        The users are fetched together with the requests.
+
+        """
+        self.client.get(self.url)
+        with self.assertNumQueries(4):
+            self.assertEqual(len(self.get_results()), 5)
+
+    def test_changelist_search(self):
+        """
+        Requests are searched by the prefix or the normalized form of their
+        address, the username or the primary key.
+
+        """
+        self.assertEqual(self.get_results({'q': 'USER1@'}), ['user1'])
+        self.assertEqual(self.get_results({'q': 'user1@example.com'}), ['user1'])
+        self.assertEqual(self.get_results({'q': 'user2'}), ['user2'])
+        self.assertEqual(self.get_results({'q': str(self.expired.pk)}), ['user0'])
+        self.assertEqual(self.get_results({'q': 'example.com'}), [])
+
+    def test_changelist_filters(self):
+        """
+        Requests are filtered by their expiration.
+
+        """
+        self.assertEqual(self.get_results({'status': 'expired'}), ['user0'])
+        self.assertEqual(len(self.get_results({'status': 'pending'})), 4)
+
+    def test_estimated_count(self):
+        """
+        Unfiltered querysets are counted from the estimate of the database
+        if it exceeds the threshold.
+
+        """
+        estimate_count = admin.estimate_count
+        admin.estimate_count = lambda model, using: 1000
+        try:
+            queryset = EmailChange.objects.all()._clone(klass=admin.EstimatedCountQuerySet)
+            settings.EMAIL_CHANGE_ADMIN_ESTIMATED_COUNT_THRESHOLD = 10
+            self.assertEqual(queryset.count(), 1000)
+            self.assertEqual(queryset.pending().count(), 4)
+            settings.EMAIL_CHANGE_ADMIN_ESTIMATED_COUNT_THRESHOLD = 10000
+            self.assertEqual(queryset.count(), 5)
+        finally:
+            admin.estimate_count = estimate_count
+        self.assertEqual(admin.estimate_count(EmailChange, 'default'), None)
+
+    def resend_confirmation(self, *usernames):
+        pks = EmailChange.objects.filter(user__username__in=usernames).values_list('pk', flat=True)
+        response = self.client.post(self.url, {
+            'action': 'resend_confirmation',
+            '_selected_action': [str(pk) for pk in pks],
+        }, follow=True)
+        self.assertEqual(response.status_code, 200)
+        return [(message.level, message.message)
+                for message in response.context['messages']]
+
+    def test_resend_confirmation(self):
+        """
+        Confirmation mails are resent to the selected addresses, except to
+        throttled ones, and failures are reported.
+
+        """
+        cache.clear()
+        clear_counter()
+        settings.EMAIL_CHANGE_THROTTLE_RATES = {'resend.email': '1/h'}
+        try:
+            self.assertEqual(self.resend_confirmation('user2'),
+                             [(messages.INFO, 'Resent 1 confirmation email.')])
+            self.assertEqual([message.to for message in mail.outbox],
+                             [['User2@example.com']])
+            settings.EMAIL_BACKEND = 'change_email.tests.models.FailingEmailBackend'
+            EmailChange.objects.filter(user__username='user1').update(new_email='alice2@example.com')
+            self.assertEqual(self.resend_confirmation('user1', 'user2', 'user3'), [
+                (messages.INFO, 'Resent 1 confirmation email.'),
+                (messages.ERROR, 'Could not resend confirmation emails to:'
+                                 ' alice2@example.com'),
+                (messages.WARNING, 'Too many confirmation emails have been'
+                                   ' sent to: User2@example.com'),
+            ])
+            self.assertEqual([message.to for message in mail.outbox],
+                             [['User2@example.com'], ['User3@example.com']])
+        finally:
+            cache.clear()
+            clear_counter()
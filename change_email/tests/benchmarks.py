@@ -0,0 +1,18 @@
+from change_email.benchmarks import EmailChangeBenchmark
+from change_email.benchmarks import STEPS
+from change_email.benchmarks import check_thresholds
+from change_email.tests.lib import BaseTest
+
+
+class EmailChangeBenchmarkTestCase(BaseTest):
+
+    def test_email_change_benchmark(self):
+        """
+        The email address change flow does not exceed the query thresholds.
+
+        """
+        results = EmailChangeBenchmark(users=10, iterations=2).run()
+        self.assertEqual(sorted(results), sorted(STEPS))
+        self.assertEqual(check_thresholds(results), [])
+        self.assertEqual(results['create']['mail_time']['total'] > 0, True)
+        self.assertEqual(results['detail']['templates']['max'] > 0, True)
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core import management
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import CommandError
+
+from change_email import bloom
+from change_email.conf import settings
+from change_email.forms import EmailChangeForm
+from change_email.models import EmailChange
+from change_email.storage import get_storage
+from change_email.tests.lib import BaseTest
+
+
+class BloomFilterTestCase(BaseTest):
+
+    fixtures = ['django_change_email_test_views_fixtures.json']
+
+    def setUp(self):
+        output = super(BloomFilterTestCase, self).setUp()
+        bloom.clear_filter()
+        settings.EMAIL_CHANGE_BLOOM_FILTER = True
+        settings.EMAIL_CHANGE_BLOOM_FILTER_CAPACITY = 1000
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'emails.bloom')
+        settings.EMAIL_CHANGE_BLOOM_FILTER_PATH = self.path
+        self.alice = User.objects.get(username='alice')
+        self.bob = User.objects.get(username='bob')
+        return output
+
+    def tearDown(self):
+        bloom.clear_filter()
+        shutil.rmtree(self.directory)
+        return super(BloomFilterTestCase, self).tearDown()
+
+    def test_dimensions(self):
+        """
+        Filters are sized from their capacity and rate of false positives.
+
+        """
+        self.assertEqual(bloom.get_dimensions(1000, 0.01), (9586, 7))
+        self.assertEqual(bloom.get_dimensions(1000000, 0.001), (14377588, 10))
+
+    def test_filter(self):
+        """
+        Added values are always found, and cells set in another filter since
+        a snapshot are merged.
+
+        """
+        size, hashes = bloom.get_dimensions(1000, 0.01)
+        first = bloom.BloomFilter(size, hashes)
+        snapshot = first.read()
+        first.update(['alice@example.com', 'bob@example.com'])
+        self.assertTrue('alice@example.com' in first)
+        self.assertFalse('carol@example.com' in first)
+        second = bloom.BloomFilter(size, hashes)
+        second.merge(first, snapshot)
+        self.assertTrue('bob@example.com' in second)
+        self.assertEqual(second.read(), first.read())
+
+    def test_validator(self):
+        """
+        Addresses missing from the filter are accepted without a query.
+
+        """
+        bloom.rebuild()
+        self.assertTrue(bloom.might_be_used('ALICE@example.com'))
+        self.assertFalse(bloom.might_be_used('carol@example.com'))
+        with self.assertNumQueries(0):
+            self.assertTrue(EmailChangeForm(data={'new_email': 'carol@example.com'}).is_valid())
+        with self.assertNumQueries(1):
+            self.assertFalse(EmailChangeForm(data={'new_email': 'alice@example.com'}).is_valid())
+
+    def test_hooks(self):
+        """
+        Addresses of saved users and requests are added to the filter.
+
+        """
+        bloom.rebuild()
+        User.objects.create_user('carol', 'carol@example.com')
+        self.assertTrue(bloom.might_be_used('carol@example.com'))
+        request = EmailChange.objects.create(new_email='Bob2@example.com',
+                                             user=self.bob)
+        self.assertTrue(bloom.might_be_used('bob2@example.com'))
+        self.assertFalse(EmailChangeForm(data={'new_email': 'bob2@example.com'}).is_valid())
+        request.new_email = 'bob3@example.com'
+        get_storage().update(request)
+        self.assertTrue(bloom.might_be_used('bob3@example.com'))
+        self.assertFalse(EmailChangeForm(data={'new_email': 'bob3@example.com'}).is_valid())
+        list(EmailChange.objects.bulk_request([('alice', 'alice2@example.com')],
+                                              lookup='username'))
+        self.assertTrue(bloom.might_be_used('alice2@example.com'))
+
+    def test_cache_storage(self):
+        """
+        Requests kept in the cache are checked even if the filter does not
+        contain their address.
+
+        """
+        cache.clear()
+        settings.EMAIL_CHANGE_STORAGE = 'change_email.storage.CacheStorage'
+        try:
+            get_storage().create(EmailChange(user=self.alice,
+                                             new_email='alice2@example.com'))
+            bloom.rebuild()
+            self.assertFalse(bloom.might_be_used('alice2@example.com'))
+            self.assertFalse(EmailChangeForm(data={'new_email': 'alice2@example.com'}).is_valid())
+        finally:
+            cache.clear()
+
+    def test_file(self):
+        """
+        The filter file is built by the management command and mapped again
+        once it has been replaced.
+
+        """
+        self.assertEqual(bloom.get_filter(), None)
+        self.assertTrue(bloom.might_be_used('carol@example.com'))
+        management.call_command('rebuildemailbloomfilter', verbosity=0)
+        bloom.clear_filter()
+        first = bloom.get_filter()
+        self.assertEqual(first.size, os.path.getsize(self.path) - bloom.HEADER.size)
+        self.assertTrue(bloom.might_be_used('alice@example.com'))
+        self.assertFalse(bloom.might_be_used('carol@example.com'))
+        User.objects.create_user('carol', 'carol@example.com')
+        self.assertTrue('carol@example.com' in bloom.BloomFilter.open(self.path))
+        bloom.clear_filter()
+        bloom.rebuild()
+        second = bloom.get_filter()
+        self.assertNotEqual(second.identity, first.identity)
+        self.assertTrue(bloom.might_be_used('carol@example.com'))
+        self.assertEqual(os.listdir(self.directory), ['emails.bloom'])
+
+    def test_other_process(self):
+        """
+        Addresses added through another mapping of the file, as by another
+        process, are seen by this process.
+
+        """
+        bloom.rebuild()
+        self.assertFalse(bloom.might_be_used('carol@example.com'))
+        bloom.BloomFilter.open(self.path).add('carol@example.com')
+        self.assertTrue(bloom.might_be_used('carol@example.com'))
+
+    def test_no_path(self):
+        """
+        Without a shared file the filter is not used.
+
+        """
+        settings.EMAIL_CHANGE_BLOOM_FILTER_PATH = None
+        self.assertEqual(bloom.get_filter(), None)
+        self.assertTrue(bloom.might_be_used('carol@example.com'))
+        self.assertRaises(ImproperlyConfigured, bloom.rebuild)
+        self.assertRaises(CommandError, management.call_command,
+                          'rebuildemailbloomfilter', verbosity=0)
@@ -0,0 +1,93 @@
+import datetime
+import json
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core import management
+from django.core.urlresolvers import reverse
+
+from change_email.conf import settings
+from change_email.export import export
+from change_email.export import iter_rows
+from change_email.models import EmailChange
+from change_email.tests.lib import BaseTest
+
+
+class ExportTestCase(BaseTest):
+
+    fixtures = ['django_change_email_test_views_fixtures.json']
+
+    def setUp(self):
+        output = super(ExportTestCase, self).setUp()
+        self.alice = User.objects.get(username='alice')
+        self.bob = User.objects.get(username='bob')
+        self.pending = EmailChange.objects.create(new_email='Bob2@example.com',
+                                                  user=self.bob)
+        self.expired = EmailChange.objects.create(new_email='alice2@example.com',
+                                                  user=self.alice)
+        self.expired.date -= datetime.timedelta(seconds=settings.EMAIL_CHANGE_TIMEOUT + 1)
+        self.expired.expires_at -= datetime.timedelta(seconds=settings.EMAIL_CHANGE_TIMEOUT + 1)
+        self.expired.save()
+        return output
+
+    def test_iter_rows(self):
+        """
+        Requests are fetched in keyset-paginated chunks.
+
+        """
+        with self.assertNumQueries(3):
+            rows = list(iter_rows(chunk_size=1))
+        self.assertEqual([row[0] for row in rows],
+                         [self.pending.pk, self.expired.pk])
+        self.assertEqual([row[0] for row in iter_rows('pending')],
+                         [self.pending.pk])
+        self.assertEqual([row[0] for row in iter_rows('expired')],
+                         [self.expired.pk])
+
+    def test_export_formats(self):
+        """
+        Requests are exported as CSV with a header or as JSON Lines.
+
+        """
+        lines = list(export(state='pending'))
+        self.assertEqual(lines[0], 'id,user,new_email,normalized_email,date,expires_at,site\r\n')
+        self.assertEqual(lines[1].split(',')[:4],
+                         [str(self.pending.pk), str(self.bob.pk),
+                          'Bob2@example.com', 'bob2@example.com'])
+        lines = list(export(state='expired', format='jsonl'))
+        self.assertEqual(len(lines), 1)
+        data = json.loads(lines[0])
+        self.assertEqual(data['id'], self.expired.pk)
+        self.assertEqual(data['user'], self.alice.pk)
+        self.assertEqual(data['date'], self.expired.date.isoformat())
+
+    def test_management_command(self):
+        """
+        The management command writes the export to standard output.
+
+        """
+        stdout = StringIO()
+        management.call_command('exportemailchanges', format='jsonl',
+                                stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines],
+                         [self.pending.pk, self.expired.pk])
+
+    def test_view(self):
+        """
+        The export view streams requests to staff members only.
+
+        """
+        url = reverse('change_email_export')
+        self.client.login(username='bob', password='Oor0ohf4bi-')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'admin/login.html')
+        User.objects.filter(pk=self.bob.pk).update(is_staff=True)
+        response = self.client.get(url, {'state': 'pending'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 2)
+        response = self.client.get(url, {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
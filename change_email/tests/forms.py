@@ -34,6 +34,9 @@ class EmailChangeFormTestCase(BaseTest):
             # Existing email address change request.
             {'data': {'new_email': 'bob2@example.com'},
             'error': ('new_email', [msg])},
+            # Existing email address change request, different case.
+            {'data': {'new_email': 'BOB2@Example.com'},
+            'error': ('new_email', [msg])},
             ]
 
         for invalid_dict in invalid_data_dicts:
@@ -43,3 +46,16 @@ class EmailChangeFormTestCase(BaseTest):
                              invalid_dict['error'][1])
         form = forms.EmailChangeForm(data={'new_email': 'alice2@example.com'})
         self.failUnless(form.is_valid())
+
+    def test_change_email_form_queries(self):
+        """
+        Test that ``EmailChangeForm`` checks an email address against the
+        users and the pending requests with a single query.
+
+        """
+        form = forms.EmailChangeForm(data={'new_email': 'alice2@example.com'})
+        with self.assertNumQueries(1):
+            self.failUnless(form.is_valid())
+        form = forms.EmailChangeForm(data={'new_email': 'ALICE@example.com'})
+        with self.assertNumQueries(1):
+            self.failIf(form.is_valid())
@@ -0,0 +1,43 @@
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.test.utils import override_settings
+
+from change_email.conf import settings
+from change_email.mail import renderer
+from change_email.models import EmailChange
+from change_email.tests.lib import BaseTest
+
+
+class ConfirmationMailRendererTestCase(BaseTest):
+
+    fixtures = ['django_change_email_test_models_fixtures.json']
+
+    def setUp(self):
+        output = super(ConfirmationMailRendererTestCase, self).setUp()
+        renderer.clear()
+        self.bob = User.objects.get(username='bob')
+        self.site = Site.objects.get_current()
+        return output
+
+    def test_render_confirmation(self):
+        """
+        The subject and the bodies of a confirmation mail are rendered in one
+        pass and the compiled templates are reused.
+
+        """
+        email_change = EmailChange.objects.create(new_email='bob2@example.com',
+                                                  user=self.bob)
+        subject, text, html = renderer.render_confirmation(email_change,
+                                                           self.site)
+        self.assertEqual(subject, u"Custom email change request on ")
+        self.failUnless(email_change.make_signature() in text)
+        self.assertEqual(html, None)
+        templates = renderer.get_templates()
+        self.failUnless(renderer.get_templates() is templates)
+        settings.EMAIL_CHANGE_HTML_EMAIL = True
+        subject, text, html = renderer.render_confirmation(email_change,
+                                                           self.site)
+        self.failUnless(u"content..." in html)
+        self.assertEqual(len(renderer.templates), 2)
+        with override_settings(TEMPLATE_DIRS=()):
+            self.assertEqual(renderer.templates, {})
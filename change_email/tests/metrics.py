@@ -0,0 +1,113 @@
+import socket
+
+from django.core.urlresolvers import reverse
+from django.http import Http404
+from django.test.client import RequestFactory
+
+from change_email.conf import settings
+from change_email.metrics import StatsdMetricsBackend
+from change_email.metrics import get_metrics
+from change_email.metrics import metrics_view
+from change_email.metrics import observe
+from change_email.models import EmailChange
+from change_email.signals import email_change_created
+from change_email.tests.lib import BaseTest
+
+
+class MetricsTestCase(BaseTest):
+
+    fixtures = ['django_change_email_test_views_fixtures.json']
+
+    def setUp(self):
+        output = super(MetricsTestCase, self).setUp()
+        self.metrics = get_metrics()
+        self.metrics.clear()
+        self.client.login(username='bob', password='Oor0ohf4bi-')
+        return output
+
+    def get_counter(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        return self.metrics.counters.get(key, 0)
+
+    def get_count(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        return self.metrics.histograms.get(key, [None, 0, 0])[2]
+
+    def test_flow(self):
+        """
+        Requests, mails and validations are counted and timed, and the
+        signals carry the time spent.
+
+        """
+        durations = []
+
+        def receiver(sender, duration, **kwargs):
+            durations.append(duration)
+        email_change_created.connect(receiver)
+        try:
+            self.client.post(reverse('change_email_create'),
+                             data={'new_email': 'bob2@example.com'})
+        finally:
+            email_change_created.disconnect(receiver)
+        self.assertEqual(len(durations), 1)
+        self.assertTrue(durations[0] >= 0)
+        object = EmailChange.objects.get()
+        self.client.get(reverse('change_email_confirm', args=['foo']))
+        self.client.post(reverse('change_email_delete', args=[object.pk]))
+        self.assertEqual(self.get_counter('created'), 1)
+        self.assertEqual(self.get_counter('confirmation_failed'), 1)
+        self.assertEqual(self.get_counter('deleted'), 1)
+        self.assertEqual(self.get_count('validator_seconds'), 1)
+        self.assertEqual(self.get_count('mail_render_seconds'), 1)
+        self.assertEqual(self.get_count('mail_send_seconds'), 1)
+        for view in ('create', 'confirm', 'delete'):
+            self.assertEqual(self.get_count('view_seconds', view=view), 1)
+
+    def test_render(self):
+        """
+        Values are exposed in the Prometheus text exposition format.
+
+        """
+        self.metrics.increment('created', 2, {})
+        observe('view_seconds', 0.003, view='index')
+        request = RequestFactory().get('/')
+        response = metrics_view(request)
+        lines = response.content.splitlines()
+        self.assertTrue('# TYPE change_email_created_total counter' in lines)
+        self.assertTrue('change_email_created_total 2' in lines)
+        self.assertTrue('# TYPE change_email_view_seconds histogram' in lines)
+        self.assertTrue('change_email_view_seconds_bucket{view="index",le="0.0025"} 0' in lines)
+        self.assertTrue('change_email_view_seconds_bucket{view="index",le="0.005"} 1' in lines)
+        self.assertTrue('change_email_view_seconds_bucket{view="index",le="+Inf"} 1' in lines)
+        self.assertTrue('change_email_view_seconds_count{view="index"} 1' in lines)
+        settings.EMAIL_CHANGE_METRICS_BACKEND = None
+        self.assertRaises(Http404, metrics_view, request)
+
+    def test_disabled(self):
+        """
+        Nothing is recorded if metrics are disabled.
+
+        """
+        settings.EMAIL_CHANGE_METRICS_BACKEND = None
+        self.client.get(reverse('change_email_index'))
+        self.assertEqual(self.metrics.histograms, {})
+
+    def test_statsd(self):
+        """
+        The statsd backend sends counters and timings over UDP.
+
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        settings.EMAIL_CHANGE_STATSD_HOST = '127.0.0.1'
+        settings.EMAIL_CHANGE_STATSD_PORT = server.getsockname()[1]
+        try:
+            backend = StatsdMetricsBackend()
+            backend.increment('created', 1, {})
+            self.assertEqual(server.recv(512), 'change_email.created:1|c')
+            backend.observe('view_seconds', 0.25, {'view': 'index'})
+            self.assertEqual(server.recv(512),
+                             'change_email.view_seconds.index:250|ms')
+        finally:
+            server.close()
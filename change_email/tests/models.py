@@ -1,14 +1,48 @@
+import os
+import tempfile
 import time
 import datetime
 
 from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core import mail
 from django.core import management
+from django.core.mail.backends.locmem import EmailBackend
+from django.db import IntegrityError
+from django.test.client import RequestFactory
+from django.utils import timezone
 
 from change_email.conf import settings
+from change_email.management.commands.emailchangesweeper import Command as SweeperCommand
 from change_email.models import EmailChange
+from change_email.models import QueuedConfirmationMail
+from change_email.queues import get_mail_queue
+from change_email.signals import email_change_expired
 from change_email.tests.lib import BaseTest
 
 
+class FailingEmailBackend(EmailBackend):
+    """
+    An email backend that fails to send mails to alice.
+
+    """
+    def send_messages(self, messages):
+        for message in messages:
+            if 'alice2@example.com' in message.to:
+                raise IOError('Connection refused')
+        return super(FailingEmailBackend, self).send_messages(messages)
+
+
+def get_timeout(email_change):
+    """
+    Returns a timeout of one hour for requests of alice.
+
+    """
+    if email_change.user.username == 'alice':
+        return 3600
+    return settings.EMAIL_CHANGE_TIMEOUT
+
+
 class EmailChangeModelTestCase(BaseTest):
 
     fixtures = ['django_change_email_test_models_fixtures.json']
@@ -32,6 +66,51 @@ class EmailChangeModelTestCase(BaseTest):
         self.failIf(request.has_expired())
         request.delete()
 
+    def test_email_address_change_normalized_email(self):
+        """
+        Saving an email address change request stores the normalized email
+        address.
+
+        """
+        request = EmailChange.objects.create(new_email=u'Bob2@B\xfccher.Example',
+                                             user=self.bob)
+        self.assertEqual(request.normalized_email, u'bob2@xn--bcher-kva.example')
+        settings.EMAIL_CHANGE_CANONICALIZE_EMAIL = 'change_email.utils.canonicalize_gmail_address'
+        request.new_email = 'Bo.b+changes@googlemail.com'
+        request.save()
+        self.assertEqual(request.normalized_email, u'bob@gmail.com')
+
+    def test_email_address_change_normalized_email_per_site(self):
+        """
+        A normalized email address can be requested once per site.
+
+        """
+        settings.EMAIL_CHANGE_VALIDATE_SITE = True
+        site1 = Site.objects.get_current()
+        site2 = Site.objects.create(domain='example.org', name='example.org')
+        EmailChange.objects.create(new_email='carol@example.com',
+                                   user=self.bob, site=site1)
+        EmailChange.objects.create(new_email='Carol@example.com',
+                                   user=self.alice, site=site2)
+        self.assertEqual(EmailChange.objects.filter(normalized_email='carol@example.com').count(), 2)
+        self.bob.emailchange.delete()
+        self.assertRaises(IntegrityError, EmailChange.objects.create,
+                          new_email='carol@example.com', user=self.bob,
+                          site=site2)
+
+    def test_email_address_change_normalized_email_without_site(self):
+        """
+        Requests created without a site get the current one, so that their
+        normalized email addresses are unique.
+
+        """
+        request = EmailChange.objects.create(new_email='carol@example.com',
+                                             user=self.bob, site=None)
+        self.assertEqual(request.site, Site.objects.get_current())
+        self.assertRaises(IntegrityError, EmailChange.objects.create,
+                          new_email='Carol@example.com', user=self.alice,
+                          site=None)
+
     def test_email_address_change_has_expired(self):
         """
         Testing the model's token methods.
@@ -41,6 +120,7 @@ class EmailChangeModelTestCase(BaseTest):
                                               user=self.bob)
         time.sleep(2)
         self.failUnless(request1.has_expired(seconds=1))
+        self.assertTrue(request1.get_expiration_date(60) < request1.expires_at)
         self.failIf(request1.has_expired(seconds=1000))
 
 
@@ -60,11 +140,12 @@ class EmailChangeModelTestCase(BaseTest):
         self.assertEqual(request2.new_email, 'alice2@example.com')
         self.failIf(request2.has_expired())
         request2.date -= datetime.timedelta(days=self.timeout_days + 1)
+        request2.expires_at -= datetime.timedelta(days=self.timeout_days + 1)
         request2.save()
         new = 'alice2@example.com'
         request2 = EmailChange.objects.filter(new_email=new).get()
         self.failUnless(request2.has_expired())
-        management.call_command('cleanupemailchangerequests')
+        management.call_command('cleanupemailchangerequests', verbosity=0)
         self.assertEqual(EmailChange.objects.count(), 1)
         self.assertEqual(EmailChange.objects.filter(new_email=new).count(), 0)
         new = 'bob2@example.com'
@@ -88,11 +169,189 @@ class EmailChangeModelTestCase(BaseTest):
         self.assertEqual(request2.new_email, 'alice2@example.com')
         self.failIf(request2.has_expired())
         request2.date -= datetime.timedelta(days=self.timeout_days + 1)
+        request2.expires_at -= datetime.timedelta(days=self.timeout_days + 1)
         request2.save()
         new_email = 'alice2@example.com'
         request2 = EmailChange.objects.filter(new_email=new_email).get()
         self.failUnless(request2.has_expired())
         self.assertEqual(EmailChange.expired_objects.count(), 1)
         self.assertEqual(EmailChange.pending_objects.count(), 1)
+        self.assertEqual(EmailChange.objects.expired().get(), request2)
+        self.assertEqual(EmailChange.objects.pending().get(), request1)
+        self.assertEqual(EmailChange.objects.filter(user=self.bob).pending().count(), 1)
+        self.assertEqual(EmailChange.objects.filter(user=self.bob).expired().count(), 0)
+        self.assertEqual(EmailChange.objects.expiring_within(60).count(), 0)
+        seconds = self.timeout_days + 60
+        self.assertEqual(EmailChange.objects.expiring_within(seconds).get(), request1)
         request1.delete()
         request2.delete()
+
+    def test_email_address_change_expiration_date(self):
+        """
+        The expiration date is stored when a request is created.
+
+        """
+        settings.EMAIL_CHANGE_TIMEOUT_CALLABLE = 'change_email.tests.models.get_timeout'
+        request1 = EmailChange.objects.create(new_email='bob2@example.com',
+                                              user=self.bob)
+        request2 = EmailChange.objects.create(new_email='alice2@example.com',
+                                              user=self.alice)
+        delta = request1.expires_at - request1.date
+        self.assertAlmostEqual(delta.total_seconds(), self.timeout_days, places=2)
+        delta = request2.expires_at - request2.date
+        self.assertAlmostEqual(delta.total_seconds(), 3600, places=2)
+        self.assertEqual(EmailChange.objects.expiring_within(3660).get(), request2)
+        settings.EMAIL_CHANGE_TIMEOUT = 60
+        settings.EMAIL_CHANGE_TIMEOUT_CALLABLE = None
+        request1 = EmailChange.objects.get(pk=request1.pk)
+        request1.save()
+        self.failIf(request1.has_expired())
+        self.assertTrue(request1.get_expiration_date(60) < request1.expires_at)
+        self.assertEqual(EmailChange.pending_objects.count(), 2)
+
+    def test_email_address_change_send_confirmation_mails(self):
+        """
+        Testing sending confirmation mails in bulk.
+
+        """
+        request = RequestFactory().get('/')
+        EmailChange.objects.create(new_email='bob2@example.com',
+                                   user=self.bob)
+        EmailChange.objects.create(new_email='alice2@example.com',
+                                   user=self.alice)
+        queryset = EmailChange.objects.order_by('pk')
+        sent, failures = EmailChange.send_confirmation_mails(queryset, request,
+                                                             batch_size=1)
+        self.assertEqual(sent, 2)
+        self.assertEqual(failures, [])
+        self.assertEqual(len(mail.outbox), 2)
+        mail.outbox = []
+        connection = FailingEmailBackend()
+        sent, failures = EmailChange.send_confirmation_mails(queryset, request,
+                                                             connection=connection)
+        self.assertEqual(sent, 1)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0][0].new_email, 'alice2@example.com')
+        self.assertEqual(mail.outbox[0].to, ['bob2@example.com'])
+
+    def test_email_address_change_management_command_chunks(self):
+        """
+        Testing the management command deleting in chunks.
+
+        """
+        for user in (self.alice, self.bob):
+            request = EmailChange.objects.create(new_email='%s2@example.com' % user.username,
+                                                 user=user)
+            request.date -= datetime.timedelta(days=self.timeout_days + 1)
+            request.expires_at -= datetime.timedelta(days=self.timeout_days + 1)
+            request.save()
+            QueuedConfirmationMail.objects.create(email_change=request,
+                                                  domain='example.com')
+        management.call_command('cleanupemailchangerequests', batch_size=1,
+                                verbosity=0)
+        self.assertEqual(EmailChange.objects.count(), 0)
+        self.assertEqual(QueuedConfirmationMail.objects.count(), 0)
+
+    def test_email_address_change_bulk_request(self):
+        """
+        Testing creating requests in bulk with set-based checks.
+
+        """
+        carol = User.objects.create_user('carol', 'carol@example.com')
+        User.objects.create_user('dave', 'dave@example.com')
+        EmailChange.objects.create(new_email='taken@example.com',
+                                   user=carol)
+        rows = [
+            ('alice', 'alice2@example.com'),
+            ('bob', 'ALICE2@example.com'),
+            ('carol', 'carol2@example.com'),
+            ('dave', 'Bob@Example.com'),
+            ('dave', 'Taken@example.com'),
+            ('eve', 'eve@example.com'),
+            ('dave', 'not an address'),
+            ('bob', 'bob2@example.com'),
+            ('dave', 'dave2@example.com'),
+        ]
+        Site.objects.clear_cache()
+        with self.assertNumQueries(13):
+            results = list(EmailChange.objects.bulk_request(
+                rows, lookup='username', batch_size=5,
+                mail_queue=get_mail_queue()))
+        self.assertEqual([error for user, new_email, error in results],
+                         [None, 'in_use', 'pending', 'in_use', 'in_use',
+                          'unknown_user', 'invalid', None, None])
+        self.assertEqual(EmailChange.objects.count(), 4)
+        object = EmailChange.objects.get(user=self.alice)
+        self.assertEqual(object.normalized_email, 'alice2@example.com')
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['alice2@example.com', 'bob2@example.com',
+                          'dave2@example.com'])
+
+    def test_email_address_change_bulk_management_command(self):
+        """
+        Testing the management command creating requests from a file.
+
+        """
+        settings.EMAIL_CHANGE_MAIL_QUEUE = 'change_email.queues.DatabaseMailQueue'
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(handle, 'w') as f:
+            f.write('{"user": "alice", "new_email": "alice2@example.com"}\n\n')
+            f.write('{"user": "bob", "new_email": "alice2@example.com"}\n')
+        try:
+            management.call_command('bulkemailchange', path, verbosity=0)
+        finally:
+            os.remove(path)
+        self.assertEqual(EmailChange.objects.get().user, self.alice)
+        self.assertEqual(QueuedConfirmationMail.objects.get().domain,
+                         'example.com')
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as f:
+            f.write('user,new_email\n%d,bob2@example.com\n' % self.bob.pk)
+        try:
+            management.call_command('bulkemailchange', path, lookup='pk',
+                                    mail=False, verbosity=0)
+        finally:
+            os.remove(path)
+        self.assertEqual(EmailChange.objects.get(user=self.bob).new_email,
+                         'bob2@example.com')
+        self.assertEqual(QueuedConfirmationMail.objects.count(), 1)
+
+    def test_email_address_change_sweeper(self):
+        """
+        Testing the management command deleting requests as they expire.
+
+        """
+        carol = User.objects.create_user('carol', 'carol@example.com')
+        for user, days in ((self.alice, 2), (self.bob, 1), (carol, 0)):
+            request = EmailChange.objects.create(new_email='%s2@example.com' % user.username,
+                                                 user=user)
+            delta = datetime.timedelta(seconds=self.timeout_days, days=days,
+                                       minutes=1)
+            request.date -= delta
+            request.expires_at -= delta
+            request.save()
+        batches = []
+
+        def receiver(sender, pks, **kwargs):
+            batches.append(pks)
+        email_change_expired.connect(receiver)
+        try:
+            command = SweeperCommand()
+            command.execute(batch_size=1, lookahead=120, max_scheduled=10000,
+                            max_sleep=60, once=True, verbosity=0)
+        finally:
+            email_change_expired.disconnect(receiver)
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(EmailChange.objects.count(), 0)
+        EmailChange.objects.create(new_email='bob2@example.com', user=self.bob)
+        request = EmailChange.objects.create(new_email='carol2@example.com',
+                                             user=carol)
+        date = timezone.now() - datetime.timedelta(seconds=self.timeout_days - 30)
+        expires_at = date + datetime.timedelta(seconds=self.timeout_days)
+        EmailChange.objects.filter(pk=request.pk).update(date=date,
+                                                         expires_at=expires_at)
+        now = timezone.now()
+        command.refill(now)
+        self.assertEqual(command.sweep(now), 0)
+        self.assertTrue(0 < command.get_delay(now) <= 30)
+        self.assertEqual(command.sweep(now + datetime.timedelta(seconds=31)), 1)
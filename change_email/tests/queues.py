@@ -0,0 +1,107 @@
+import datetime
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core import management
+from django.core.urlresolvers import reverse
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from change_email.conf import settings
+from change_email.models import EmailChange
+from change_email.models import QueuedConfirmationMail
+from change_email.queues import DatabaseMailQueue
+from change_email.queues import ThreadPoolMailQueue
+from change_email.tests.lib import BaseTest
+
+
+class MailQueueTestCase(BaseTest):
+
+    fixtures = ['django_change_email_test_views_fixtures.json']
+
+    def setUp(self):
+        output = super(MailQueueTestCase, self).setUp()
+        self.bob = User.objects.get(username='bob')
+        self.client.login(username='bob', password='Oor0ohf4bi-')
+        return output
+
+    def test_database_mail_queue(self):
+        """
+        Confirmation mails are stored in the database and sent by the
+        ``processemailchangequeue`` management command.
+
+        """
+        settings.EMAIL_CHANGE_MAIL_QUEUE = 'change_email.queues.DatabaseMailQueue'
+        self.client.post(reverse('change_email_create'),
+                         data={'new_email': 'bob2@example.com'})
+        self.assertEqual(EmailChange.objects.count(), 1)
+        self.assertEqual(QueuedConfirmationMail.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+        management.call_command('processemailchangequeue')
+        self.assertEqual(QueuedConfirmationMail.objects.count(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['bob2@example.com'])
+
+    def test_database_mail_queue_batches(self):
+        """
+        The management command keeps sending full batches of mails until
+        the queue is empty.
+
+        """
+        alice = User.objects.get(username='alice')
+        for user in (alice, self.bob):
+            email_change = EmailChange.objects.create(new_email='%s2@example.com' % user.username,
+                                                      user=user)
+            QueuedConfirmationMail.objects.create(email_change=email_change,
+                                                  domain='example.com')
+        management.call_command('processemailchangequeue', batch_size=1,
+                                verbosity=0)
+        self.assertEqual(QueuedConfirmationMail.objects.count(), 0)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['alice2@example.com', 'bob2@example.com'])
+
+    def test_database_mail_queue_claims(self):
+        """
+        Mails claimed by another worker are skipped until their claim has
+        expired, and failed mails keep their claim until they are retried.
+
+        """
+        email_change = EmailChange.objects.create(new_email='bob2@example.com',
+                                                  user=self.bob)
+        job = QueuedConfirmationMail.objects.create(email_change=email_change,
+                                                    domain='example.com',
+                                                    claimed_by='other',
+                                                    claimed_at=timezone.now())
+        queue = DatabaseMailQueue()
+        self.assertEqual(queue.process(), (0, 0))
+        self.assertEqual(len(mail.outbox), 0)
+        expired = timezone.now() - datetime.timedelta(
+            seconds=settings.EMAIL_CHANGE_MAIL_QUEUE_CLAIM_TIMEOUT + 1)
+        QueuedConfirmationMail.objects.filter(pk=job.pk).update(claimed_at=expired)
+        settings.EMAIL_BACKEND = 'change_email.tests.models.FailingEmailBackend'
+        email_change.new_email = 'alice2@example.com'
+        email_change.save()
+        self.assertEqual(queue.process(), (0, 1))
+        job = QueuedConfirmationMail.objects.get()
+        self.assertEqual(job.attempts, 1)
+        self.assertNotEqual(job.claimed_by, 'other')
+        self.assertEqual(queue.process(), (0, 0))
+        QueuedConfirmationMail.objects.update(claimed_at=expired)
+        settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+        self.assertEqual(queue.process(), (1, 0))
+        self.assertEqual(QueuedConfirmationMail.objects.count(), 0)
+        self.assertEqual(mail.outbox[0].to, ['alice2@example.com'])
+
+    def test_thread_pool_mail_queue(self):
+        """
+        Confirmation mails are sent from background threads.
+
+        """
+        request = RequestFactory().get('/')
+        email_change = EmailChange.objects.create(new_email='bob2@example.com',
+                                                  user=self.bob)
+        queue = ThreadPoolMailQueue(threads=1)
+        queue.enqueue(email_change, request)
+        queue.join()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['bob2@example.com'])
@@ -0,0 +1,83 @@
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+
+from change_email import routers
+from change_email.conf import settings
+from change_email.middleware import PinPrimaryDatabaseMiddleware
+from change_email.models import EmailChange
+from change_email.tests.lib import BaseTest
+
+
+class EmailChangeRouterTestCase(BaseTest):
+
+    def setUp(self):
+        output = super(EmailChangeRouterTestCase, self).setUp()
+        routers.unpin()
+        settings.EMAIL_CHANGE_REPLICA_DATABASES = ('replica',)
+        self.router = routers.EmailChangeRouter()
+        return output
+
+    def tearDown(self):
+        routers.unpin()
+        return super(EmailChangeRouterTestCase, self).tearDown()
+
+    def test_reads(self):
+        """
+        Reads of email address change requests go to a replica until the
+        thread is pinned to the primary database.
+
+        """
+        self.assertEqual(EmailChange.objects.all().db, 'replica')
+        self.assertEqual(EmailChange.pending_objects.all().db, 'replica')
+        self.assertEqual(User.objects.all().db, 'default')
+        routers.pin()
+        self.assertEqual(EmailChange.objects.all().db, 'default')
+        routers.unpin()
+        settings.EMAIL_CHANGE_REPLICA_DATABASES = ()
+        self.assertEqual(self.router.db_for_read(EmailChange), None)
+
+    def test_writes(self):
+        """
+        Writes go to the primary database and pin the thread to it.
+
+        """
+        self.assertEqual(self.router.db_for_write(Site), None)
+        self.assertFalse(routers.has_written())
+        self.assertEqual(self.router.db_for_write(User), None)
+        self.assertTrue(routers.has_written())
+        routers.unpin()
+        self.assertEqual(self.router.db_for_write(EmailChange), 'default')
+        self.assertTrue(routers.has_written())
+        self.assertEqual(self.router.db_for_read(EmailChange), 'default')
+        self.assertFalse(self.router.allow_syncdb('replica', EmailChange))
+        self.assertTrue(self.router.allow_syncdb('default', EmailChange))
+        self.assertEqual(self.router.allow_syncdb('replica', User), None)
+
+    def test_middleware(self):
+        """
+        Requests are pinned to the primary database for unsafe methods and
+        after a write, with a cookie.
+
+        """
+        middleware = PinPrimaryDatabaseMiddleware()
+        factory = RequestFactory()
+        request = factory.get('/')
+        middleware.process_request(request)
+        self.assertEqual(routers.get_read_database(), 'replica')
+        response = middleware.process_response(request, HttpResponse())
+        self.assertFalse(middleware.cookie_name in response.cookies)
+        request = factory.post('/')
+        middleware.process_request(request)
+        self.assertEqual(routers.get_read_database(), 'default')
+        self.router.db_for_write(EmailChange)
+        response = middleware.process_response(request, HttpResponse())
+        cookie = response.cookies[middleware.cookie_name]
+        self.assertEqual(cookie['max-age'], settings.EMAIL_CHANGE_REPLICATION_LAG)
+        self.assertFalse(routers.is_pinned())
+        request = factory.get('/')
+        request.COOKIES[middleware.cookie_name] = '1'
+        middleware.process_request(request)
+        self.assertEqual(routers.get_read_database(), 'default')
+        middleware.process_response(request, HttpResponse())
@@ -15,6 +15,8 @@ DATABASES = {
     },
 }
 
+DATABASE_ROUTERS = ['change_email.routers.EmailChangeRouter']
+
 DEBUG = False
 
 LANGUAGES = (
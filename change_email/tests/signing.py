@@ -0,0 +1,40 @@
+from django.core.signing import BadSignature
+from django.core.signing import SignatureExpired
+from django.core.signing import Signer
+
+from change_email.conf import settings
+from change_email.signing import signer
+from change_email.tests.lib import BaseTest
+
+
+class SigningServiceTestCase(BaseTest):
+
+    def test_signature(self):
+        """
+        Signatures are verified against the current and the fallback keys
+        and salts.
+
+        """
+        signature = signer.signature('bob2@example.com')
+        self.failUnless(signer.verify('bob2@example.com', signature))
+        self.failIf(signer.verify('bob3@example.com', signature))
+        legacy = Signer().signature('bob2@example.com')
+        self.failUnless(signer.verify('bob2@example.com', legacy))
+        settings.EMAIL_CHANGE_SECRET_KEY = 'new secret'
+        self.failIf(signer.verify('bob2@example.com', signature))
+        self.assertNotEqual(signer.signature('bob2@example.com'), signature)
+        settings.EMAIL_CHANGE_SECRET_KEY_FALLBACKS = ('secret',)
+        self.failUnless(signer.verify('bob2@example.com', signature))
+
+    def test_token(self):
+        """
+        Tokens are rejected if they have been tampered with or have expired.
+
+        """
+        token = signer.dumps({'id': 1, 'email': 'bob2@example.com'},
+                             compress=True)
+        self.assertEqual(signer.loads(token, max_age=60),
+                         {'id': 1, 'email': 'bob2@example.com'})
+        self.assertRaises(BadSignature, signer.loads, token[1:])
+        self.assertRaises(BadSignature, signer.loads, token + 'a')
+        self.assertRaises(SignatureExpired, signer.loads, token, max_age=-1)
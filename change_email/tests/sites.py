@@ -0,0 +1,33 @@
+from django.contrib.sites.models import Site
+from django.test.client import RequestFactory
+
+from change_email.conf import settings
+from change_email.sites import clear_site_cache
+from change_email.sites import get_current_site
+from change_email.tests.lib import BaseTest
+
+
+class SitesTestCase(BaseTest):
+
+    def setUp(self):
+        output = super(SitesTestCase, self).setUp()
+        clear_site_cache()
+        self.other = Site.objects.create(domain='other.example.com',
+                                         name='other')
+        return output
+
+    def test_get_current_site(self):
+        """
+        The current site is looked up by the requested host without a query
+        once all sites have been loaded.
+
+        """
+        request = RequestFactory().get('/', HTTP_HOST='other.example.com:8000')
+        self.assertEqual(get_current_site(request), Site.objects.get_current())
+        settings.EMAIL_CHANGE_SITE_FROM_REQUEST = True
+        self.assertEqual(get_current_site(request), self.other)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_current_site(request), self.other)
+        self.other.domain = 'another.example.com'
+        self.other.save()
+        self.assertEqual(get_current_site(request), Site.objects.get_current())
@@ -0,0 +1,170 @@
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import DatabaseError
+from django.db import IntegrityError
+
+from change_email.conf import settings
+from change_email.forms import EmailChangeForm
+from change_email.models import EmailChange
+from change_email.storage import get_storage
+from change_email.tests.lib import BaseTest
+
+
+class CacheStorageTestCase(BaseTest):
+
+    fixtures = ['django_change_email_test_views_fixtures.json']
+
+    def setUp(self):
+        output = super(CacheStorageTestCase, self).setUp()
+        cache.clear()
+        settings.EMAIL_CHANGE_STORAGE = 'change_email.storage.CacheStorage'
+        self.alice = User.objects.get(username='alice')
+        self.bob = User.objects.get(username='bob')
+        self.client.login(username='bob', password='Oor0ohf4bi-')
+        return output
+
+    def tearDown(self):
+        cache.clear()
+        return super(CacheStorageTestCase, self).tearDown()
+
+    def test_flow(self):
+        """
+        Requests are created, displayed, deleted and confirmed without
+        touching the request table.
+
+        """
+        response = self.client.post(reverse('change_email_create'),
+                                    data={'new_email': 'Bob2@example.com'})
+        object = get_storage().get_for_user(self.bob)
+        self.assertEqual(object.normalized_email, 'bob2@example.com')
+        self.assertRedirects(response, reverse('change_email_detail',
+                                               args=[object.pk]))
+        self.assertEqual(EmailChange.objects.count(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+        response = self.client.get(reverse('change_email_detail',
+                                           args=[object.pk]))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(reverse('change_email_delete',
+                                            args=[object.pk]))
+        self.assertEqual(get_storage().get_for_user(self.bob), None)
+        self.client.post(reverse('change_email_create'),
+                         data={'new_email': 'bob3@example.com'})
+        object = get_storage().get_for_user(self.bob)
+        response = self.client.get(reverse('change_email_confirm',
+                                           args=[object.make_signature()]))
+        self.assertTrue(response.context['confirmed'])
+        self.assertEqual(User.objects.get(pk=self.bob.pk).email,
+                         'bob3@example.com')
+        self.assertEqual(get_storage().get_for_user(self.bob), None)
+        self.failUnless(EmailChangeForm(data={'new_email': 'bob2@example.com'}).is_valid())
+
+    def test_address_in_use(self):
+        """
+        Addresses used by pending requests are rejected by the validator and
+        the storage.
+
+        """
+        storage = get_storage()
+        storage.create(EmailChange(user=self.alice,
+                                   new_email='alice2@example.com'))
+        form = EmailChangeForm(data={'new_email': 'ALICE2@example.com'})
+        with self.assertNumQueries(0):
+            self.assertFalse(form.is_valid())
+        self.assertRaises(IntegrityError, storage.create,
+                          EmailChange(user=self.bob,
+                                      new_email='alice2@example.com'))
+        self.assertRaises(IntegrityError, storage.create,
+                          EmailChange(user=self.alice,
+                                      new_email='alice3@example.com'))
+        self.failUnless(EmailChangeForm(data={'new_email': 'alice3@example.com'}).is_valid())
+
+    def test_confirm_twice(self):
+        """
+        A request is confirmed once, and can not be confirmed or updated
+        while another process holds its lock or after it has been confirmed.
+
+        """
+        storage = get_storage()
+        storage.create(EmailChange(user=self.bob, new_email='bob2@example.com'))
+        object = storage.get_for_user(self.bob)
+        other = storage.get_for_user(self.bob)
+        key = storage.get_lock_key(self.bob.pk)
+        storage.cache.add(key, 1)
+        storage.lock_attempts = 1
+        try:
+            self.assertFalse(storage.confirm(object))
+            object.new_email = 'bob3@example.com'
+            self.assertFalse(storage.update(object))
+        finally:
+            del storage.lock_attempts
+            storage.cache.delete(key)
+        self.assertTrue(storage.confirm(other))
+        self.assertFalse(storage.confirm(object))
+        self.assertFalse(storage.update(object))
+        self.assertEqual(storage.get_for_user(self.bob), None)
+        self.assertEqual(User.objects.get(pk=self.bob.pk).email,
+                         'bob2@example.com')
+        self.failUnless(EmailChangeForm(data={'new_email': 'bob3@example.com'}).is_valid())
+
+    def test_address_in_use_per_site(self):
+        """
+        Addresses are unique per site if sites are validated.
+
+        """
+        settings.EMAIL_CHANGE_VALIDATE_SITE = True
+        storage = get_storage()
+        site2 = Site.objects.create(domain='example.org', name='example.org')
+        storage.create(EmailChange(user=self.alice,
+                                   new_email='carol@example.com'))
+        self.assertRaises(IntegrityError, storage.create,
+                          EmailChange(user=self.bob, new_email='carol@example.com'))
+        storage.create(EmailChange(user=self.bob, new_email='carol@example.com',
+                                   site=site2))
+        self.assertEqual(storage.get_for_user(self.bob).site_id, site2.pk)
+
+    def test_confirm_failure(self):
+        """
+        A request is kept if the user can not be saved while confirming it.
+
+        """
+        storage = get_storage()
+        storage.create(EmailChange(user=self.bob, new_email='bob2@example.com'))
+        object = storage.get_for_user(self.bob)
+
+        def save(*args, **kwargs):
+            raise DatabaseError('The user could not be saved.')
+        object.user.save = save
+        self.assertRaises(DatabaseError, storage.confirm, object)
+        self.assertEqual(storage.get_for_user(self.bob).new_email,
+                         'bob2@example.com')
+        self.assertFalse(EmailChangeForm(data={'new_email': 'bob2@example.com'}).is_valid())
+        self.assertEqual(User.objects.get(pk=self.bob.pk).email, 'bob@example.com')
+        object = storage.get_for_user(User.objects.get(pk=self.bob.pk))
+        self.assertTrue(storage.confirm(object))
+        self.assertEqual(User.objects.get(pk=self.bob.pk).email,
+                         'bob2@example.com')
+
+    def test_update(self):
+        """
+        Updating a request moves the reverse entry of its address.
+
+        """
+        storage = get_storage()
+        storage.create(EmailChange(user=self.bob, new_email='bob2@example.com'))
+        object = storage.get_for_user(self.bob)
+        object.new_email = 'Bob3@example.com'
+        self.assertTrue(storage.update(object))
+        object = storage.get_for_user(self.bob)
+        self.assertEqual(object.normalized_email, 'bob3@example.com')
+        self.failUnless(EmailChangeForm(data={'new_email': 'bob2@example.com'}).is_valid())
+        self.assertFalse(EmailChangeForm(data={'new_email': 'bob3@example.com'}).is_valid())
+        storage.create(EmailChange(user=self.alice,
+                                   new_email='alice2@example.com'))
+        object.new_email = 'alice2@example.com'
+        self.assertRaises(IntegrityError, storage.update, object)
+        storage.delete(storage.get_for_user(self.bob))
+        object.new_email = 'bob4@example.com'
+        self.assertFalse(storage.update(object))
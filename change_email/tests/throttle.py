@@ -0,0 +1,170 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test.client import RequestFactory
+
+from change_email.conf import settings
+from change_email.models import EmailChange
+from change_email.tests.lib import BaseTest
+from change_email.throttle import LRUCache
+from change_email.throttle import SlidingWindowCounter
+from change_email.throttle import allow
+from change_email.throttle import clear_counter
+from change_email.throttle import parse_rate
+
+
+class ThrottleTestCase(BaseTest):
+
+    fixtures = ['django_change_email_test_views_fixtures.json']
+
+    def setUp(self):
+        output = super(ThrottleTestCase, self).setUp()
+        cache.clear()
+        clear_counter()
+        self.bob = User.objects.get(username='bob')
+        self.client.login(username='bob', password='Oor0ohf4bi-')
+        return output
+
+    def tearDown(self):
+        cache.clear()
+        clear_counter()
+        return super(ThrottleTestCase, self).tearDown()
+
+    def test_parse_rate(self):
+        """
+        Rates are parsed into the number of hits and the period in seconds.
+
+        """
+        self.assertEqual(parse_rate('5/h'), (5, 3600))
+        self.assertEqual(parse_rate('30/minute'), (30, 60))
+        self.assertEqual(parse_rate('3/day'), (3, 86400))
+
+    def test_sliding_window_counter(self):
+        """
+        Hits of the previous window are weighted by their overlap with the
+        sliding window.
+
+        """
+        counter = SlidingWindowCounter(LRUCache())
+        for i in range(2):
+            self.assertTrue(counter.hit('key', 2, 60, now=0))
+        self.assertFalse(counter.hit('key', 2, 60, now=30))
+        self.assertFalse(counter.hit('key', 2, 60, now=60))
+        self.assertTrue(counter.hit('key', 2, 60, now=90))
+        self.assertFalse(counter.hit('key', 2, 60, now=90))
+        self.assertTrue(counter.hit('other', 2, 60, now=90))
+
+    def test_lru_cache(self):
+        """
+        The in-memory cache evicts the least recently used keys.
+
+        """
+        lru = LRUCache(max_entries=2)
+        lru.add('a', 1, 60)
+        lru.add('b', 1, 60)
+        lru.incr('a')
+        lru.add('c', 1, 60)
+        self.assertEqual(lru.get_many(['a', 'b', 'c']), {'a': 2, 'c': 1})
+        self.assertRaises(ValueError, lru.incr, 'b')
+
+    def test_lru_cache_fallback(self):
+        """
+        Hits are counted in memory if the throttle cache is not configured.
+
+        """
+        settings.EMAIL_CHANGE_THROTTLE_CACHE = 'missing'
+        settings.EMAIL_CHANGE_THROTTLE_RATES = {'confirm.ip': '1/m'}
+        request = RequestFactory().get('/')
+        request.user = self.bob
+        self.assertTrue(allow('confirm', request))
+        self.assertFalse(allow('confirm', request))
+        self.assertTrue(allow('create', request))
+
+    def test_throttling_disabled(self):
+        """
+        Requests are not throttled by default.
+
+        """
+        request = RequestFactory().get('/')
+        request.user = self.bob
+        for i in range(10):
+            self.assertTrue(allow('confirm', request))
+
+    def test_rejected_requests_not_counted(self):
+        """
+        Requests rejected by the rate of one kind do not count towards the
+        rates of the other kinds.
+
+        """
+        settings.EMAIL_CHANGE_THROTTLE_RATES = {'confirm.user': '3/m',
+                                                'confirm.ip': '1/m'}
+        factory = RequestFactory()
+        request = factory.get('/', REMOTE_ADDR='10.0.0.1')
+        request.user = self.bob
+        self.assertTrue(allow('confirm', request))
+        self.assertFalse(allow('confirm', request))
+        self.assertFalse(allow('confirm', request))
+        request = factory.get('/', REMOTE_ADDR='10.0.0.2')
+        request.user = self.bob
+        self.assertTrue(allow('confirm', request))
+        request = factory.get('/', REMOTE_ADDR='10.0.0.3')
+        request.user = self.bob
+        self.assertTrue(allow('confirm', request))
+        request = factory.get('/', REMOTE_ADDR='10.0.0.4')
+        request.user = self.bob
+        self.assertFalse(allow('confirm', request))
+
+    def test_availability_throttled_by_user(self):
+        """
+        ``GET`` requests to the ``change_email_availability`` view exceeding
+        the rate for the user are rejected.
+
+        """
+        settings.EMAIL_CHANGE_THROTTLE_RATES = {'availability.user': '2/m'}
+        url = reverse('change_email_availability')
+        for email in ('bob2@example.com', 'bob3@example.com'):
+            response = self.client.get(url, {'email': email})
+            self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, {'email': 'bob4@example.com'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.content), {
+            'email': 'bob4@example.com',
+            'available': False,
+            'reason': 'throttled',
+        })
+
+    def test_create_throttled_by_email(self):
+        """
+        A ``POST`` to the ``change_email_create`` view exceeding the rate for
+        the target address is rejected without sending a mail.
+
+        """
+        settings.EMAIL_CHANGE_THROTTLE_RATES = {'create.email': '1/h'}
+        url = reverse('change_email_create')
+        response = self.client.post(url, data={'new_email': 'bob2@example.com'})
+        self.assertEqual(response.status_code, 302)
+        EmailChange.objects.all().delete()
+        response = self.client.post(url, data={'new_email': 'BOB2@example.com'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(EmailChange.objects.count(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+        response = self.client.post(url, data={'new_email': 'bob3@example.com'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_confirm_throttled_by_user(self):
+        """
+        A ``GET`` to the ``change_email_confirm`` view exceeding the rate for
+        the user is rejected without querying the database.
+
+        """
+        settings.EMAIL_CHANGE_THROTTLE_RATES = {'confirm.user': '2/m'}
+        url = reverse('change_email_confirm', args=['foo'])
+        for i in range(2):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 429)
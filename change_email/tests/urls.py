@@ -1,5 +1,9 @@
 from django.conf.urls.defaults import *
+from django.contrib import admin
+
+admin.autodiscover()
 
 urlpatterns = patterns('',
     url(r'^account/', include('change_email.urls')),
+    url(r'^admin/', include(admin.site.urls)),
 )
@@ -1,10 +1,19 @@
+import datetime
+import json
+
 from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
 from django.core import mail
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.utils import timezone
 
+from change_email.conf import settings
 from change_email.forms import EmailChangeForm
 from change_email.models import EmailChange
+from change_email.sites import clear_site_cache
 from change_email.tests.lib import BaseTest
+from change_email.validators import validate_email_not_used
 
 
 class EmailChangeViewsTestCase(BaseTest):
@@ -158,6 +167,127 @@ class EmailChangeViewsTestCase(BaseTest):
         self.assertEqual(EmailChange.objects.filter(new_email='bob2@example.com').count(), 0)
         request.delete()
 
+    def test_email_address_change_update(self):
+        """
+        A ``POST`` to the ``change_email_update`` view replaces the new email
+        address in place, invalidates the previous link and sends a new one.
+
+        """
+        request = EmailChange.objects.create(new_email='bob2@example.com',
+                                             user=self.bob)
+        old_signature = request.make_signature()
+        old_token = request.make_token()
+        url = reverse('change_email_update', args=[request.pk])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response,
+                                'change_email/emailchange_form.html')
+        response = self.client.post(url, data={'new_email': 'Bob3@example.com'})
+        self.assertRedirects(response, reverse('change_email_detail',
+                                               args=[request.pk]))
+        object = EmailChange.objects.get()
+        self.assertEqual(object.pk, request.pk)
+        self.assertEqual(object.new_email, 'Bob3@example.com')
+        self.assertEqual(object.normalized_email, 'bob3@example.com')
+        self.assertTrue(object.expires_at >= request.expires_at)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['Bob3@example.com'])
+        response = self.client.get(reverse('change_email_confirm',
+                                           args=[old_signature]))
+        self.assertFalse(response.context['confirmed'])
+        response = self.client.get(reverse('change_email_confirm_token',
+                                           args=[old_token]))
+        self.assertFalse(response.context['confirmed'])
+        self.assertEqual(EmailChange.objects.count(), 1)
+        response = self.client.get(reverse('change_email_confirm',
+                                           args=[object.make_signature()]))
+        self.assertTrue(response.context['confirmed'])
+        self.assertEqual(User.objects.get(pk=self.bob.pk).email,
+                         'Bob3@example.com')
+
+    def test_email_address_change_update_failure(self):
+        """
+        A ``POST`` to the ``change_email_update`` view with an address in use
+        fails, and redirects to the ``change_email_create`` view if no pending
+        request exists.
+
+        """
+        request = EmailChange.objects.create(new_email='bob2@example.com',
+                                             user=self.bob)
+        url = reverse('change_email_update', args=[request.pk])
+        response = self.client.post(url, data={'new_email': 'alice@example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.failIf(response.context['form'].is_valid())
+        self.assertEqual(EmailChange.objects.get().new_email, 'bob2@example.com')
+        self.assertEqual(len(mail.outbox), 0)
+        request.delete()
+        response = self.client.post(url, data={'new_email': 'bob3@example.com'})
+        self.assertRedirects(response,
+                             'http://testserver%s' % reverse('change_email_create'))
+        self.assertEqual(EmailChange.objects.count(), 0)
+
+    def test_email_address_change_concurrent_address(self):
+        """
+        An address taken by a concurrent request after the form has been
+        validated is reported as a form error by the ``change_email_create``
+        and ``change_email_update`` views.
+
+        """
+        alice = User.objects.get(username='alice')
+        EmailChange.objects.create(new_email='carol@example.com', user=alice)
+        validate_email_not_used.is_used = lambda value, site=None: False
+        try:
+            response = self.client.post(reverse('change_email_create'),
+                                        data={'new_email': 'carol@example.com'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['form'].errors['new_email'],
+                             [validate_email_not_used.msg])
+            self.assertEqual(EmailChange.objects.count(), 1)
+            request = EmailChange.objects.create(new_email='bob2@example.com',
+                                                 user=self.bob)
+            url = reverse('change_email_update', args=[request.pk])
+            response = self.client.post(url, data={'new_email': 'Carol@example.com'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['form'].errors['new_email'],
+                             [validate_email_not_used.msg])
+        finally:
+            del validate_email_not_used.is_used
+        self.assertEqual(EmailChange.objects.get(user=self.bob).new_email,
+                         'bob2@example.com')
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_email_address_change_site_from_request(self):
+        """
+        Addresses are checked on the site of the requested host by the
+        ``change_email_create`` and ``change_email_availability`` views.
+
+        """
+        cache.clear()
+        clear_site_cache()
+        settings.EMAIL_CHANGE_SITE_FROM_REQUEST = True
+        settings.EMAIL_CHANGE_VALIDATE_SITE = True
+        other = Site.objects.create(domain='other.example.com', name='other')
+        alice = User.objects.get(username='alice')
+        EmailChange.objects.create(new_email='carol@example.com', user=alice,
+                                   site=other)
+        url = reverse('change_email_availability')
+        response = self.client.get(url, {'email': 'carol@example.com'},
+                                   HTTP_HOST='other.example.com')
+        self.assertFalse(json.loads(response.content)['available'])
+        response = self.client.get(url, {'email': 'carol@example.com'})
+        self.assertTrue(json.loads(response.content)['available'])
+        response = self.client.post(reverse('change_email_create'),
+                                    data={'new_email': 'carol@example.com'},
+                                    HTTP_HOST='other.example.com')
+        self.assertEqual(response.status_code, 200)
+        self.failIf(response.context['form'].is_valid())
+        response = self.client.post(reverse('change_email_create'),
+                                    data={'new_email': 'carol@example.com'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(EmailChange.objects.get(user=self.bob).site,
+                         Site.objects.get_current())
+        cache.clear()
+
     def test_email_address_change_detail(self):
         """
         A ``GET`` to the ``change_email_detail`` view with valid data works.
@@ -178,3 +308,154 @@ class EmailChangeViewsTestCase(BaseTest):
         response = self.client.get(reverse('change_email_detail', args=[1000]))
         self.assertRedirects(response,
                              'http://testserver%s' % reverse('change_email_create'))
+
+    def test_email_address_change_queries(self):
+        """
+        The ``change_email_index``, ``change_email_detail`` and
+        ``change_email_delete`` views look up the pending request of the user
+        with a single query, besides loading the session and the user.
+
+        """
+        request = EmailChange.objects.create(new_email='bob2@example.com', user=self.bob)
+        with self.assertNumQueries(3):
+            self.client.get(reverse('change_email_index'))
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('change_email_detail', args=[request.id,]))
+        self.assertEqual(response.context['object'], request)
+        with self.assertNumQueries(3):
+            self.client.get(reverse('change_email_delete', args=[request.id,]))
+        with self.assertNumQueries(3):
+            self.client.post(reverse('change_email_create'),
+                             data={'new_email': 'bob3@example.com'})
+        request.delete()
+
+    def test_email_address_change_detail_other_user(self):
+        """
+        A ``GET`` to the ``change_email_detail`` view of a request of another
+        user is not found.
+
+        """
+        EmailChange.objects.create(new_email='bob2@example.com', user=self.bob)
+        request = EmailChange.objects.create(new_email='alice2@example.com', user=self.alice)
+        response = self.client.get(reverse('change_email_detail', args=[request.id,]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_email_address_change_confirmation_token(self):
+        """
+        A ``GET`` to the ``change_email_confirm_token`` view with a valid
+        token works.
+
+        """
+        settings.EMAIL_CHANGE_TIMESTAMPED_TOKENS = True
+        self.client.post(reverse('change_email_create'),
+                         data={'new_email': 'bob2@example.com'})
+        request = EmailChange.objects.get()
+        path = request.get_confirmation_path()
+        self.failUnless(path in mail.outbox[0].body)
+        response = self.client.get(path)
+        self.assertTrue(response.context['confirmed'])
+        bob = User.objects.filter(username='bob').get()
+        self.assertEqual(bob.email, 'bob2@example.com')
+        self.assertEqual(EmailChange.objects.count(), 0)
+
+    def test_email_address_change_confirmation_token_failure(self):
+        """
+        A ``GET`` to the ``change_email_confirm_token`` view with a tampered
+        token is rejected without looking up the request.
+
+        """
+        request = EmailChange.objects.create(new_email='bob2@example.com',
+                                             user=self.bob)
+        token = request.make_token()
+        token = token[:-1] + (token[-1] == 'a' and 'b' or 'a')
+        url = reverse('change_email_confirm_token', args=[token])
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertFalse(response.context['confirmed'])
+        self.assertEqual(EmailChange.objects.count(), 1)
+        request.delete()
+
+    def test_email_address_change_confirmation_token_expired(self):
+        """
+        A ``GET`` to the ``change_email_confirm_token`` view with a token of an
+        expired request is rejected without looking up the request.
+
+        """
+        request = EmailChange.objects.create(new_email='bob2@example.com',
+                                             user=self.bob)
+        request.expires_at = timezone.now() - datetime.timedelta(seconds=1)
+        url = reverse('change_email_confirm_token', args=[request.make_token()])
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertFalse(response.context['confirmed'])
+        self.assertEqual(EmailChange.objects.count(), 1)
+        request.delete()
+
+    def test_email_address_change_confirmation_twice(self):
+        """
+        Following a confirmation link twice reports the request as confirmed
+        both times.
+
+        """
+        request = EmailChange.objects.create(new_email='bob2@example.com',
+                                             user=self.bob)
+        url = reverse('change_email_confirm', args=[request.make_signature()])
+        for i in range(2):
+            response = self.client.get(url)
+            self.assertTrue(response.context['confirmed'])
+        self.assertEqual(User.objects.get(pk=self.bob.pk).email,
+                         'bob2@example.com')
+        url = reverse('change_email_confirm',
+                      args=[EmailChange(new_email='bob3@example.com').make_signature()])
+        response = self.client.get(url)
+        self.assertFalse(response.context['confirmed'])
+
+    def test_email_address_change_confirm(self):
+        """
+        Confirming a request writes the email address field only and
+        does nothing if the request has been confirmed concurrently.
+
+        """
+        request = EmailChange.objects.create(new_email='bob2@example.com',
+                                             user=self.bob)
+        duplicate = EmailChange.objects.get(pk=request.pk)
+        User.objects.filter(pk=self.bob.pk).update(first_name='Robert')
+        self.assertTrue(request.confirm())
+        bob = User.objects.get(pk=self.bob.pk)
+        self.assertEqual(bob.email, 'bob2@example.com')
+        self.assertEqual(bob.first_name, 'Robert')
+        self.assertEqual(EmailChange.objects.count(), 0)
+        self.assertFalse(duplicate.confirm())
+
+    def test_email_address_change_availability(self):
+        """
+        A ``GET`` to the ``change_email_availability`` view tells if an email
+        address can be requested and caches whether it is used.
+
+        """
+        cache.clear()
+        url = reverse('change_email_availability')
+        response = self.client.get(url, {'email': 'bob2@example.com'})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.content),
+                         {'email': 'bob2@example.com', 'available': True})
+        EmailChange.objects.create(new_email='bob2@example.com', user=self.bob)
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'email': 'BOB2@example.com'})
+        self.assertTrue(json.loads(response.content)['available'])
+        cache.clear()
+        response = self.client.get(url, {'email': 'bob2@example.com'})
+        self.assertEqual(json.loads(response.content)['reason'], 'in_use')
+        response = self.client.get(url, {'email': 'alice@example.com'})
+        self.assertEqual(json.loads(response.content)['reason'], 'in_use')
+        response = self.client.get(url, {'email': 'alice'})
+        self.assertEqual(json.loads(response.content),
+                         {'email': 'alice', 'available': False,
+                          'reason': 'invalid'})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 400)
+        settings.EMAIL_CHANGE_AVAILABILITY_CACHE_TIMEOUT = 0
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {'email': 'bob3@example.com'})
+        self.assertTrue(json.loads(response.content)['available'])
+        cache.clear()
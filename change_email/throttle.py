@@ -0,0 +1,251 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import InvalidCacheBackendError
+from django.core.cache import get_cache
+from django.utils.encoding import force_bytes
+
+from change_email.conf import settings
+from change_email.utils import normalize_email
+
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24}
+
+
+def parse_rate(rate):
+    """
+Parses a rate like ``'5/h'`` or ``'100/day'``.
+
+:arg str rate: The number of allowed hits, a slash and a period, either
+    ``s``, ``m``, ``h`` or ``d`` or any word starting with these letters.
+:returns: A tuple of the number of allowed hits and the period in seconds.
+:rtype: tuple
+"""
+    limit, period = rate.split('/')
+    return int(limit), PERIODS[period[0]]
+
+
+class LRUCache(object):
+    """
+A minimal thread-safe in-memory cache evicting the least recently used keys.
+
+Implements the subset of the Django cache API used by
+:class:`SlidingWindowCounter`.
+"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, key):
+        value, expires = self.data.pop(key)
+        if expires < time.time():
+            raise KeyError(key)
+        self.data[key] = (value, expires)
+        return value
+
+    def _set(self, key, value, timeout):
+        self.data.pop(key, None)
+        self.data[key] = (value, time.time() + timeout)
+        while len(self.data) > self.max_entries:
+            self.data.popitem(last=False)
+
+    def add(self, key, value, timeout):
+        with self.lock:
+            try:
+                self._get(key)
+            except KeyError:
+                self._set(key, value, timeout)
+                return True
+            return False
+
+    def get_many(self, keys):
+        values = {}
+        with self.lock:
+            for key in keys:
+                try:
+                    values[key] = self._get(key)
+                except KeyError:
+                    pass
+        return values
+
+    def incr(self, key, delta=1):
+        with self.lock:
+            try:
+                value = self._get(key) + delta
+            except KeyError:
+                raise ValueError("Key '%s' not found" % key)
+            self.data[key] = (value, self.data[key][1])
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class SlidingWindowCounter(object):
+    """
+Counts hits per key in a sliding window.
+
+The sliding window is approximated by weighting the count of the previous
+fixed window by the part of it that still overlaps the sliding window, so
+only two counters per key need to be stored.
+
+:arg obj cache: A Django cache or a :class:`LRUCache`.
+"""
+    prefix = 'change_email.throttle'
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get_key(self, key, period, window):
+        return '%s:%s:%d:%d' % (self.prefix, key, period, window)
+
+    def check(self, key, limit, period, now=None):
+        """
+Checks if a hit would be allowed, without counting it.
+
+:arg str key: The key to count hits for.
+:arg int limit: The number of hits allowed in the period.
+:arg int period: The length of the sliding window in seconds.
+:returns: ``True`` if the hit is allowed, ``False`` otherwise.
+:rtype: bool
+"""
+        if now is None:
+            now = time.time()
+        window = int(now // period)
+        current_key = self.get_key(key, period, window)
+        previous_key = self.get_key(key, period, window - 1)
+        counts = self.cache.get_many([current_key, previous_key])
+        overlap = 1 - (now % period) / float(period)
+        count = counts.get(current_key, 0) + counts.get(previous_key, 0) * overlap
+        return count < limit
+
+    def count(self, key, period, now=None):
+        """
+Counts a hit.
+
+:arg str key: The key to count hits for.
+:arg int period: The length of the sliding window in seconds.
+"""
+        if now is None:
+            now = time.time()
+        current_key = self.get_key(key, period, int(now // period))
+        if not self.cache.add(current_key, 1, period * 2):
+            try:
+                self.cache.incr(current_key)
+            except ValueError:
+                self.cache.add(current_key, 1, period * 2)
+
+    def hit(self, key, limit, period, now=None):
+        """
+Counts a hit unless the limit has been reached.
+
+:arg str key: The key to count hits for.
+:arg int limit: The number of hits allowed in the period.
+:arg int period: The length of the sliding window in seconds.
+:returns: ``True`` if the hit is allowed, ``False`` otherwise.
+:rtype: bool
+"""
+        if now is None:
+            now = time.time()
+        if not self.check(key, limit, period, now):
+            return False
+        self.count(key, period, now)
+        return True
+
+
+_counter = None
+_counter_lock = threading.Lock()
+
+
+def get_counter():
+    """
+Returns the :class:`SlidingWindowCounter` storing hits in the cache set by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_THROTTLE_CACHE`, or in an
+in-memory :class:`LRUCache` if that setting is ``None`` or the cache is not
+configured.
+"""
+    global _counter
+    with _counter_lock:
+        if _counter is None:
+            cache = None
+            if settings.EMAIL_CHANGE_THROTTLE_CACHE is not None:
+                try:
+                    cache = get_cache(settings.EMAIL_CHANGE_THROTTLE_CACHE)
+                except InvalidCacheBackendError:
+                    pass
+            if cache is None:
+                cache = LRUCache(settings.EMAIL_CHANGE_THROTTLE_LRU_SIZE)
+            _counter = SlidingWindowCounter(cache)
+        return _counter
+
+
+def clear_counter():
+    """
+Discards the counter returned by :func:`get_counter`, e.g. after changing
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_THROTTLE_CACHE`. Hits
+already stored in a Django cache are kept.
+"""
+    global _counter
+    with _counter_lock:
+        _counter = None
+
+
+def get_identifiers(request, email=None):
+    """
+Returns the identifiers of a request that hits are counted for.
+
+:arg obj request: The request object.
+:kwarg str email: The email address the request targets.
+:returns: A list of ``(kind, identifier)`` tuples, ``kind`` being one of
+    ``user``, ``ip`` and ``email``.
+:rtype: list
+"""
+    identifiers = []
+    if request.user.is_authenticated():
+        identifiers.append(('user', str(request.user.pk)))
+    ip = request.META.get('REMOTE_ADDR')
+    if ip:
+        identifiers.append(('ip', ip))
+    if email:
+        digest = hashlib.md5(force_bytes(normalize_email(email))).hexdigest()
+        identifiers.append(('email', digest))
+    return identifiers
+
+
+def allow(scope, request, email=None):
+    """
+Checks whether a request is allowed by the rates set for a scope in
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_THROTTLE_RATES` and
+counts it. The request is only counted if all rates allow it.
+
+:arg str scope: The scope, e.g. ``create``, ``confirm`` or ``resend``.
+:arg obj request: The request object.
+:kwarg str email: The email address the request targets.
+:returns: ``True`` if the request is allowed, ``False`` otherwise.
+:rtype: bool
+"""
+    rates = settings.EMAIL_CHANGE_THROTTLE_RATES
+    if not rates:
+        return True
+    counter = get_counter()
+    now = time.time()
+    hits = []
+    for kind, identifier in get_identifiers(request, email):
+        rate = rates.get('%s.%s' % (scope, kind))
+        if rate is None:
+            continue
+        limit, period = parse_rate(rate)
+        key = '%s:%s:%s' % (scope, kind, identifier)
+        if not counter.check(key, limit, period, now):
+            return False
+        hits.append((key, period))
+    # Only count requests allowed by all rates, so that a request rejected
+    # by one rate does not use up the others.
+    for key, period in hits:
+        counter.count(key, period, now)
+    return True
@@ -3,25 +3,40 @@ try:
 except ImportError:
     from django.conf.urls import patterns, url
 
+from change_email.views import EmailChangeAvailabilityView
 from change_email.views import EmailChangeConfirmView
 from change_email.views import EmailChangeCreateView
 from change_email.views import EmailChangeDeleteView
 from change_email.views import EmailChangeDetailView
+from change_email.views import EmailChangeExportView
 from change_email.views import EmailChangeIndexView
+from change_email.views import EmailChangeUpdateView
 
 urlpatterns = patterns('',
                        url(r'^change/$',
                            EmailChangeIndexView.as_view(),
                            name='change_email_index'),
+                       url(r'^change/availability/$',
+                           EmailChangeAvailabilityView.as_view(),
+                           name='change_email_availability'),
                        url(r'^change/confirm/(?P<signature>[0-9A-Za-z-_=]{1,40})/$',
                            EmailChangeConfirmView.as_view(),
                            name='change_email_confirm'),
+                       url(r'^change/confirm/token/(?P<token>[0-9A-Za-z-_:.]+)/$',
+                           EmailChangeConfirmView.as_view(),
+                           name='change_email_confirm_token'),
                        url(r'^change/create/$',
                            EmailChangeCreateView.as_view(),
                            name='change_email_create'),
                        url(r'^change/delete/(?P<pk>\d+)/$',
                            EmailChangeDeleteView.as_view(),
                            name='change_email_delete'),
+                       url(r'^change/update/(?P<pk>\d+)/$',
+                           EmailChangeUpdateView.as_view(),
+                           name='change_email_update'),
+                       url(r'^change/export/$',
+                           EmailChangeExportView.as_view(),
+                           name='change_email_export'),
                        url(r'^change/(?P<pk>\d+)/$',
                            EmailChangeDetailView.as_view(),
                            name='change_email_detail'),
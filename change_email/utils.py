@@ -0,0 +1,60 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from change_email.conf import settings
+
+
+def import_by_path(path):
+    """
+Imports a dotted module path and returns the attribute designated by the last
+name in the path.
+
+:arg str path: A dotted path, e.g. ``'change_email.utils.normalize_email'``.
+:raises: :py:exc:`~django.core.exceptions.ImproperlyConfigured` if the
+    import fails.
+"""
+    module, attr = path.rsplit('.', 1)
+    try:
+        return getattr(import_module(module), attr)
+    except (ImportError, AttributeError), e:
+        msg = 'Error importing %s: "%s"' % (path, e)
+        raise ImproperlyConfigured(msg)
+
+
+def canonicalize_gmail_address(email):
+    """
+Canonicalizes a normalized Gmail address by removing dots and everything after
+a plus sign from the local part. Other addresses are returned unchanged.
+
+Can be used as
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_CANONICALIZE_EMAIL`.
+"""
+    local, sep, domain = email.rpartition('@')
+    if domain in ('gmail.com', 'googlemail.com'):
+        local = local.split('+', 1)[0].replace('.', '')
+        return u'%s@gmail.com' % local
+    return email
+
+
+def normalize_email(email):
+    """
+Returns the normalized form of an email address that is used for lookups.
+
+The address is lower-cased and its domain is IDNA-encoded. If
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_CANONICALIZE_EMAIL` is set,
+the result is passed on to the configured callable.
+
+:arg str email: An email address.
+:rtype: unicode
+"""
+    email = email.strip().lower()
+    local, sep, domain = email.rpartition('@')
+    if sep:
+        try:
+            domain = domain.encode('idna').decode('ascii')
+        except UnicodeError:
+            pass
+        email = u'%s@%s' % (local, domain)
+    if settings.EMAIL_CHANGE_CANONICALIZE_EMAIL:
+        email = import_by_path(settings.EMAIL_CHANGE_CANONICALIZE_EMAIL)(email)
+    return email
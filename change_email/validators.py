@@ -1,33 +1,101 @@
 from django.contrib.auth import get_user_model
-from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.db import router
 from django.utils.translation import ugettext_lazy as _
 
+from change_email import bloom
 from change_email.conf import settings
+from change_email.metrics import timer
 from change_email.models import EmailChange
+from change_email.sites import filter_users_by_site
+from change_email.sites import get_current_site
+from change_email.storage import get_storage
+from change_email.utils import normalize_email
+
+
+def exists(querysets, using):
+    """
+Checks if any of the given querysets matches a row, with a single
+``SELECT EXISTS (...) OR EXISTS (...)`` query.
+
+:arg list querysets: The querysets, all on the database ``using``.
+:arg str using: The alias of the database to query.
+:rtype: bool
+"""
+    clauses = []
+    params = []
+    for queryset in querysets:
+        compiler = queryset.values('pk').query.get_compiler(using=using)
+        sql, sql_params = compiler.as_sql()
+        clauses.append('EXISTS (%s)' % sql)
+        params.extend(sql_params)
+    cursor = connections[using].cursor()
+    cursor.execute('SELECT %s' % ' OR '.join(clauses), params)
+    return bool(cursor.fetchone()[0])
 
 
 class EmailNotUsedValidator(object):
     """
 A validator to check if a given email address is already taken.
+
+The users and the pending email address change requests are checked with a
+single query OR-ing two ``EXISTS`` subqueries, so that each can use its own
+index: users are looked up by the lower-cased address, like
+:func:`~change_email.managers.EmailChangeManager.bulk_request` does, and
+requests by the indexed normalized form of the address, as returned by
+:func:`~change_email.utils.normalize_email`, with the queryset returned by
+:func:`~change_email.storage.BaseStorage.get_pending_lookup`.
+
+If :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_BLOOM_FILTER` is
+``True`` and the Bloom filter of :mod:`change_email.bloom` does not contain
+the address, the query is skipped. Requests kept outside the
+:model:`EmailChange` table are still checked with their storage.
 """
     code = "email_in_use"
     msg = _("This email address is already in use."
             " Please supply a different email address.")
 
-    def __call__(self, value):
-        UserModel = get_user_model()
-        key = '%s__iexact' % settings.EMAIL_CHANGE_FIELD
-        kwargs = {key: value}
-        if settings.EMAIL_CHANGE_VALIDATE_SITE:
-            site = Site.objects.get_current()
-            kwargs['site'] = site
-        if UserModel.objects.filter(**kwargs).count():
-            raise ValidationError(self.msg, code=self.code)
-            return
-        del kwargs[key]
-        kwargs['new_email__iexact'] = value
-        if EmailChange.objects.filter(**kwargs).count():
+    def __call__(self, value, site=None):
+        if self.is_used(value, site=site):
             raise ValidationError(self.msg, code=self.code)
 
+    def is_used(self, value, site=None):
+        """
+Checks if an email address is used by a user or a pending request.
+
+:arg str value: An email address.
+:kwarg obj site: The site checked if
+    :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_VALIDATE_SITE` is
+    ``True``, e.g. as returned by
+    :func:`~change_email.sites.get_current_site` for the request. Defaults to
+    the site set by ``SITE_ID``.
+:rtype: bool
+"""
+        if not settings.EMAIL_CHANGE_VALIDATE_SITE:
+            site = None
+        elif site is None:
+            site = get_current_site()
+        pending = get_storage().get_pending_lookup(normalize_email(value),
+                                                   site=site)
+        if pending is True:
+            return True
+        if not bloom.might_be_used(value):
+            return False
+        # Query the users on the database the pending requests are read from.
+        using = router.db_for_read(EmailChange) or DEFAULT_DB_ALIAS
+        UserModel = get_user_model()
+        column = UserModel._meta.get_field(settings.EMAIL_CHANGE_FIELD).column
+        users = UserModel._default_manager.using(using)
+        if site is not None:
+            users = filter_users_by_site(users, site)
+        users = users.extra(where=['LOWER(%s) = %%s' % connections[using].ops.quote_name(column)],
+                            params=[value.strip().lower()])
+        querysets = [users]
+        if pending is not None:
+            querysets.append(pending.using(using))
+        with timer('validator_seconds'):
+            return exists(querysets, using)
+
 validate_email_not_used = EmailNotUsedValidator()
@@ -1,11 +1,25 @@
+import hashlib
+import json
 import logging
 
 from django.core.urlresolvers import reverse_lazy
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
+from django.contrib.sites.models import Site
+from django.core.cache import get_cache
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError
 from django.db import transaction
+from django.http import Http404
+from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
 from django.http import HttpResponseRedirect
+from django.http import StreamingHttpResponse
 from django.utils.decorators import method_decorator
+from django.utils.encoding import force_bytes
 from django.utils.translation import ugettext_lazy as _
 
 from django.views.generic import CreateView
@@ -13,19 +27,126 @@ from django.views.generic import DeleteView
 from django.views.generic import DetailView
 from django.views.generic import RedirectView
 from django.views.generic import TemplateView
+from django.views.generic import UpdateView
+from django.views.generic import View
 
 from change_email.conf import settings
+from change_email.export import CONTENT_TYPES
+from change_email.export import STATES
+from change_email.export import export
 from change_email.forms import EmailChangeForm
+from change_email.metrics import Timer
+from change_email.metrics import increment
+from change_email.metrics import timed_view
 from change_email.models import EmailChange
+from change_email.queues import get_mail_queue
+from change_email.routers import pin
+from change_email.signing import signer
 from change_email.signals import email_change_confirmed
 from change_email.signals import email_change_created
 from change_email.signals import email_change_deleted
+from change_email.signals import email_change_updated
+from change_email.sites import get_current_site
+from change_email.storage import get_storage
+from change_email.throttle import allow
+from change_email.utils import normalize_email
+from change_email.validators import validate_email_not_used
 
 
 logger = logging.getLogger(__name__)
 
 
-class EmailChangeConfirmView(TemplateView):
+class EmailChangeObjectMixin(object):
+    """
+A mixin to look up the :model:`EmailChange` object created by the current
+user once per request.
+
+The object is fetched from the storage returned by
+:func:`~change_email.storage.get_storage` and cached on the request, so that
+``dispatch``, ``get_object`` and the templates share a single lookup.
+"""
+
+    def get_email_change(self):
+        """
+Returns the :model:`EmailChange` object created by the current user, or
+``None`` if the user has not requested an email address change.
+"""
+        request = self.request
+        if not hasattr(request, '_email_change_cache'):
+            request._email_change_cache = get_storage().get_for_user(request.user)
+        return request._email_change_cache
+
+    def get_object(self, queryset=None):
+        """
+Returns the :model:`EmailChange` object created by the current user if its
+primary key matches the one given in the URL.
+"""
+        object = self.get_email_change()
+        pk = self.kwargs.get('pk')
+        if object is None or (pk is not None and str(object.pk) != pk):
+            raise Http404(_("No email address change request found."))
+        return object
+
+    def address_used(self, form):
+        """
+Renders a form again with the error of :validator:`EmailNotUsedValidator`,
+for addresses taken by a concurrent request after the form was validated.
+"""
+        logger.error('Email address taken by a concurrent request.')
+        form._errors['new_email'] = form.error_class([validate_email_not_used.msg])
+        return self.form_invalid(form)
+
+
+class MetricsMixin(object):
+    """
+A mixin to record the latency of a view in the ``view_seconds`` histogram of
+the :ref:`metrics backend <api-metrics>`.
+"""
+    metrics_name = None
+    """The value of the ``view`` label of the recorded latencies."""
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super(MetricsMixin, cls).as_view(**initkwargs)
+        return timed_view(view, cls.metrics_name)
+
+
+class ThrottleMixin(object):
+    """
+A mixin to reject requests exceeding the rates set by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_THROTTLE_RATES`.
+"""
+    throttle_scope = None
+    """The scope of the rates applied to this view."""
+
+    def is_allowed(self, email=None):
+        """
+Returns ``True`` if the request is allowed by the rates of
+:attr:`throttle_scope` and counts it.
+
+:kwarg str email: The email address the request targets.
+:rtype: bool
+"""
+        return allow(self.throttle_scope, self.request, email=email)
+
+    def log_throttled(self):
+        """
+Logs and counts a throttled request.
+"""
+        logger.warning('Email address change request throttled.')
+        increment('throttled', scope=self.throttle_scope)
+
+    def throttled(self):
+        """
+Returns a HTTP 429 (Too Many Requests) response.
+"""
+        self.log_throttled()
+        msg = _("Too many requests. Please try again later.")
+        return HttpResponse(msg, status=429, content_type='text/plain')
+
+
+class EmailChangeConfirmView(MetricsMixin, ThrottleMixin,
+                             EmailChangeObjectMixin, TemplateView):
     """
 A view to confirm an email address change request.
 """
@@ -35,6 +156,16 @@ A view to confirm an email address change request.
     object = None
     """An instance of :model:`EmailChange`, if found."""
 
+    confirmed = False
+    """Determines if the request has been confirmed."""
+
+    token_data = None
+    """The data loaded from a timestamped token, if given and valid."""
+
+    metrics_name = 'confirm'
+
+    throttle_scope = 'confirm'
+
     def __init__(self, *args, **kwargs):
         super(EmailChangeConfirmView, self).__init__(*args, **kwargs)
 
@@ -44,24 +175,59 @@ A view to confirm an email address change request.
 If an :model:`EmailChange` object that
 has been created by the user is not found, the user will be
 redirected to :view:`EmailChangeCreateView`.
+
+Requests exceeding the ``confirm`` rates are rejected before the database is
+queried. A timestamped token given instead of a signature is loaded by
+:func:`~change_email.models.EmailChange.load_token` first. If it has expired
+or has been tampered with, the request is rejected without looking up the
+:model:`EmailChange` object. As confirming writes to the database, the object
+is read from the primary database (see :func:`~change_email.routers.pin`).
 """
-        try:
-            object = EmailChange.objects.filter(user=request.user).get()
-        except EmailChange.DoesNotExist:
-            msg = _("No email address change request was found. Either an old "
-                    "one has expired or a new one has not been requested.")
-            messages.add_message(request,
-                                 messages.ERROR,
-                                 msg,
-                                 fail_silently=True)
-            logger.error('No email address change request found.')
-            #return HttpResponseRedirect(reverse_lazy('change_email_create'))
-            object = None
-        self.object = object
+        if not self.is_allowed():
+            return self.throttled()
+        pin()
+        if 'token' in kwargs:
+            self.token_data = EmailChange.load_token(kwargs['token'])
+            if self.token_data is None:
+                logger.error('Invalid email address change token.')
+                return super(EmailChangeConfirmView, self).dispatch(request,
+                                                                    *args,
+                                                                    **kwargs)
+        self.object = self.get_email_change()
         return super(EmailChangeConfirmView, self).dispatch(request,
                                                             *args,
                                                             **kwargs)
 
+    def get(self, request, *args, **kwargs):
+        """
+Confirms the :model:`EmailChange` object if the signature or the
+timestamped token given in the URL matches it.
+
+If the object is not found or has been confirmed by a concurrent request,
+the link may have been followed twice. The request is then reported as
+confirmed if the user's email address already is the one the link has been
+sent to, see :func:`check_confirmed`.
+"""
+        if 'token' not in kwargs or self.token_data is not None:
+            if self.object is not None and self.check_object():
+                self.confirmed = self.save()
+                if not self.confirmed:
+                    self.confirmed = self.check_confirmed()
+            elif self.object is None:
+                self.confirmed = self.check_confirmed()
+                if not self.confirmed:
+                    msg = _("No email address change request was found. "
+                            "Either an old one has expired or a new one has "
+                            "not been requested.")
+                    messages.add_message(request,
+                                         messages.ERROR,
+                                         msg,
+                                         fail_silently=True)
+                    logger.error('No email address change request found.')
+        return super(EmailChangeConfirmView, self).get(request,
+                                                       *args,
+                                                       **kwargs)
+
     def get_context_data(self, **kwargs):
         """
 Inserts following variables into the context:
@@ -74,10 +240,7 @@ Inserts following variables into the context:
     succesfully.
 """
         kwargs['object'] = self.object
-        kwargs['confirmed'] = False
-        if self.object and self.object.check_signature(self.kwargs['signature']):
-            kwargs['confirmed'] = True
-            self.save()
+        kwargs['confirmed'] = self.confirmed
         if kwargs['confirmed']:
             msg = _("The email address change was confirmed. Your new email"
                     " address will be used as primary address.")
@@ -93,22 +256,61 @@ Inserts following variables into the context:
                                  msg,
                                  fail_silently=True)
             logger.error('Email address change request was not confirmed.')
+            increment('confirmation_failed')
         return super(EmailChangeConfirmView, self).get_context_data(**kwargs)
 
+    def check_object(self):
+        """
+Checks the signature or the timestamped token given in the URL against
+the :model:`EmailChange` object.
+
+:rtype: bool
+"""
+        if 'token' in self.kwargs:
+            return self.object.check_token(self.token_data)
+        return self.object.check_signature(self.kwargs['signature'])
+
+    def check_confirmed(self):
+        """
+Checks if the user's current email address is the one signed by the
+signature or the timestamped token given in the URL, i.e. if the request has
+already been confirmed.
+
+:rtype: bool
+"""
+        UserModel = get_user_model()
+        field = settings.EMAIL_CHANGE_FIELD
+        emails = UserModel._default_manager.filter(pk=self.request.user.pk)
+        emails = list(emails.values_list(field, flat=True))
+        if not emails:
+            return False
+        if 'token' in self.kwargs:
+            return self.token_data.get('email') == emails[0]
+        return signer.verify(emails[0], self.kwargs['signature'])
+
     def save(self):
         """
-Saves the new email address to :class:`django.contrib.auth.models.User` and
-send a :signal:`email_change_confirmed` signal.
+Confirms the :model:`EmailChange` object by calling
+:func:`~change_email.storage.BaseStorage.confirm` and sends a
+:signal:`email_change_confirmed` signal.
+
+:returns: ``True`` if the new email address has been saved, ``False`` if a
+    concurrent request got there first.
+:rtype: bool
 """
+        measured = Timer()
+        if not get_storage().confirm(self.object):
+            return False
         setattr(self.request.user, settings.EMAIL_CHANGE_FIELD,
                 self.object.new_email)
-        #self.request.user.email = self.object.new_email
-        self.request.user.save()
-        self.object.delete()
-        email_change_confirmed.send(sender=self, request=self.request)
+        increment('confirmed')
+        email_change_confirmed.send(sender=self, request=self.request,
+                                    duration=measured.stop())
+        return True
 
 
-class EmailChangeCreateView(CreateView):
+class EmailChangeCreateView(MetricsMixin, ThrottleMixin, EmailChangeObjectMixin,
+                            CreateView):
     """
 A view to create an :model:`EmailChange` object.
 """
@@ -116,6 +318,10 @@ A view to create an :model:`EmailChange` object.
 
     form_class = EmailChangeForm
 
+    metrics_name = 'create'
+
+    throttle_scope = 'create'
+
     @method_decorator(login_required)
     def dispatch(self, request, *args, **kwargs):
         """
@@ -123,7 +329,8 @@ If an :model:`EmailChange` object that
 has been created by the user is found, the user will be
 redirected to :view:`EmailChangeDetailView`.
 """
-        if EmailChange.objects.filter(user=request.user).count():
+        object = self.get_email_change()
+        if object is not None:
             msg = _("An email address change request was found. It must"
                     " be deleted before a new one can be requested.")
             messages.add_message(request,
@@ -131,38 +338,196 @@ redirected to :view:`EmailChangeDetailView`.
                                  msg,
                                  fail_silently=True)
             logger.error('Pending email address change request found.')
-            object = EmailChange.objects.filter(user=request.user).get()
             return HttpResponseRedirect(reverse_lazy('change_email_detail',
                                                      args=[object.pk]))
         return super(EmailChangeCreateView, self).dispatch(request,
                                                            *args,
                                                            **kwargs)
 
+    def post(self, request, *args, **kwargs):
+        """
+Rejects requests exceeding the ``create`` rates for the user, the client's
+IP address or the submitted email address before the form is validated.
+"""
+        if not self.is_allowed(email=request.POST.get('new_email')):
+            return self.throttled()
+        return super(EmailChangeCreateView, self).post(request, *args, **kwargs)
+
+    def get_form_kwargs(self):
+        kwargs = super(EmailChangeCreateView, self).get_form_kwargs()
+        kwargs['request'] = self.request
+        return kwargs
+
     def form_valid(self, form):
         """
-Saves the email address change request, sends an email to confirm the
-request, adds a success message for the user and redirects to
-:view:`EmailChangeDetailView`.
+Saves the email address change request, schedules an email to confirm the
+request by passing it to the mail queue returned by
+:func:`~change_email.queues.get_mail_queue`, adds a success message for the
+user and redirects to :view:`EmailChangeDetailView`.
+
+The confirmation email is scheduled after the transaction saving the
+request has been committed.
 """
         form.instance.user = self.request.user
-        instance = super(EmailChangeCreateView, self).form_valid(form)
+        if Site._meta.installed:
+            form.instance.site = get_current_site(self.request)
+        instance = self.save(form)
+        if instance is None:
+            return self.address_used(form)
+        self.request._email_change_cache = form.instance
+        get_mail_queue().enqueue(form.instance, self.request)
+        return instance
+
+    def save(self, form):
+        """
+Saves the email address change request to the storage, adds a success
+message for the user and sends a :signal:`email_change_created` signal.
+
+:returns: The redirect to :view:`EmailChangeDetailView`, or ``None`` if the
+    address has been taken in the meantime.
+"""
+        measured = Timer()
+        self.object = form.instance
+        sid = transaction.savepoint()
+        try:
+            get_storage().create(self.object)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return None
+        transaction.savepoint_commit(sid)
+        instance = HttpResponseRedirect(self.get_success_url())
         msg = _("The email address change request was processed.")
         messages.add_message(self.request,
                              messages.INFO,
                              msg,
                              fail_silently=True)
-        email_change_created.send(sender=self, request=self.request)
-        form.instance.send_confirmation_mail(self.request)
+        increment('created')
+        email_change_created.send(sender=self, request=self.request,
+                                  duration=measured.stop())
         return instance
-    form_valid = transaction.commit_on_success(form_valid)
+    save = transaction.commit_on_success(save)
+
+
+class EmailChangeUpdateView(MetricsMixin, ThrottleMixin, EmailChangeObjectMixin,
+                            UpdateView):
+    """
+A view to replace the new email address of the :model:`EmailChange` object
+created by the current user, e.g. to correct a typo, without deleting it and
+creating a new one.
+
+The request is rewritten in place by
+:func:`~change_email.storage.BaseStorage.update`, with a single ``UPDATE``
+query for :class:`~change_email.storage.DatabaseStorage`. Links sent for the
+previous address are invalidated, as they sign the previous address, and a
+new confirmation mail is sent. Requests count towards the ``create`` rates.
+"""
+    model = EmailChange
+
+    form_class = EmailChangeForm
+
+    metrics_name = 'update'
+
+    throttle_scope = 'create'
+
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        """
+If an :model:`EmailChange` object that
+has been created by the user is not found, the user will be
+redirected to :view:`EmailChangeCreateView`.
+"""
+        if self.get_email_change() is None:
+            msg = _("No email address change request was found. Either an "
+                    "old one has expired or a new one has not been requested.")
+            messages.add_message(request,
+                                 messages.ERROR,
+                                 msg,
+                                 fail_silently=True)
+            logger.error('No email address change request found.')
+            return HttpResponseRedirect(reverse_lazy('change_email_create'))
+        return super(EmailChangeUpdateView, self).dispatch(request,
+                                                           *args,
+                                                           **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        """
+Rejects requests exceeding the ``create`` rates for the user, the client's
+IP address or the submitted email address before the form is validated.
+"""
+        if not self.is_allowed(email=request.POST.get('new_email')):
+            return self.throttled()
+        return super(EmailChangeUpdateView, self).post(request, *args, **kwargs)
 
+    def get_form_kwargs(self):
+        kwargs = super(EmailChangeUpdateView, self).get_form_kwargs()
+        kwargs['request'] = self.request
+        return kwargs
 
-class EmailChangeDeleteView(DeleteView):
+    def form_valid(self, form):
+        """
+Updates the email address change request, schedules an email to confirm the
+new address by passing it to the mail queue returned by
+:func:`~change_email.queues.get_mail_queue` and redirects to
+:view:`EmailChangeDetailView`.
+
+If the request has been deleted or confirmed in the meantime, the user is
+redirected to :view:`EmailChangeCreateView` instead. If the address has been
+taken in the meantime, the form is rendered again with an error.
+"""
+        updated = self.save(form)
+        if updated is None:
+            return self.address_used(form)
+        if not updated:
+            msg = _("No email address change request was found. Either an "
+                    "old one has expired or a new one has not been requested.")
+            messages.add_message(self.request,
+                                 messages.ERROR,
+                                 msg,
+                                 fail_silently=True)
+            logger.error('No email address change request found.')
+            return HttpResponseRedirect(reverse_lazy('change_email_create'))
+        get_mail_queue().enqueue(self.object, self.request)
+        return HttpResponseRedirect(self.get_success_url())
+
+    def save(self, form):
+        """
+Updates the email address change request in the storage, adds a success
+message for the user and sends a :signal:`email_change_updated` signal.
+
+:returns: ``True`` if the request has been updated, ``False`` if it has been
+    deleted or confirmed and ``None`` if the address has been taken in the
+    meantime.
+"""
+        measured = Timer()
+        sid = transaction.savepoint()
+        try:
+            updated = get_storage().update(self.object)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return None
+        transaction.savepoint_commit(sid)
+        if not updated:
+            return False
+        msg = _("The email address change request was updated.")
+        messages.add_message(self.request,
+                             messages.INFO,
+                             msg,
+                             fail_silently=True)
+        increment('updated')
+        email_change_updated.send(sender=self, request=self.request,
+                                  duration=measured.stop())
+        return True
+    save = transaction.commit_on_success(save)
+
+
+class EmailChangeDeleteView(MetricsMixin, EmailChangeObjectMixin, DeleteView):
     """
 A view to delete an :model:`EmailChange` object.
 """
     model = EmailChange
 
+    metrics_name = 'delete'
+
     @method_decorator(login_required)
     def dispatch(self, request, *args, **kwargs):
         """
@@ -170,7 +535,7 @@ If an :model:`EmailChange` object that
 has been created by the user is not found, the user will be
 redirected to :view:`EmailChangeCreateView`.
 """
-        if not EmailChange.objects.filter(user=request.user).count():
+        if self.get_email_change() is None:
             msg = _("No email address change request was found. Either an "
                     "old one has expired or a new one has not been requested.")
             messages.add_message(request,
@@ -183,6 +548,20 @@ redirected to :view:`EmailChangeCreateView`.
                                                            *args,
                                                            **kwargs)
 
+    def delete(self, request, *args, **kwargs):
+        """
+Deletes the email address change request from the storage and sends a
+:signal:`email_change_deleted` signal.
+"""
+        measured = Timer()
+        self.object = self.get_object()
+        response = HttpResponseRedirect(self.get_success_url())
+        get_storage().delete(self.object)
+        increment('deleted')
+        email_change_deleted.send(sender=self, request=request,
+                                  duration=measured.stop())
+        return response
+
     def get_success_url(self, **kwargs):
         """
 Returns the URL to redirect to after an email address change request has
@@ -194,23 +573,24 @@ been deleted by an user. The URL to redirect to can be customized by setting
                              messages.INFO,
                              msg,
                              fail_silently=True)
-        email_change_deleted.send(sender=self, request=self.request)
         return reverse_lazy('change_email_create')
 
 
-class EmailChangeDetailView(DetailView):
+class EmailChangeDetailView(MetricsMixin, EmailChangeObjectMixin, DetailView):
     """
 A view to display an :model:`EmailChange` object.
 """
     model = EmailChange
 
+    metrics_name = 'detail'
+
     @method_decorator(login_required)
     def dispatch(self, request, *args, **kwargs):
         """
 If an :model:`EmailChange` object that has been created by the user is not
 found, the user will be redirected to :view:`EmailChangeCreateView`.
 """
-        if not EmailChange.objects.filter(user=request.user).count():
+        if self.get_email_change() is None:
             msg = _("No email address change request was found. Either an "
                     "old one has expired or a new one has not been requested.")
             messages.add_message(request,
@@ -224,10 +604,12 @@ found, the user will be redirected to :view:`EmailChangeCreateView`.
                                                            **kwargs)
 
 
-class EmailChangeIndexView(RedirectView):
+class EmailChangeIndexView(MetricsMixin, EmailChangeObjectMixin, RedirectView):
     """
 A view to redirect users to other views.
 """
+    metrics_name = 'index'
+
     permanent = False
     """
 Determines that this view will always issue a HTTP 307 (Temporary
@@ -248,9 +630,141 @@ has been created by the user, the user will be redirected to
 object is not found the user will be redirected
 to :view:`EmailChangeCreateView`.
 """
-        user = self.request.user
-        try:
-            object = EmailChange.objects.filter(user=user).get()
+        object = self.get_email_change()
+        if object is not None:
             return reverse_lazy('change_email_detail', args=[object.pk])
-        except EmailChange.DoesNotExist:
-            return reverse_lazy('change_email_create')
+        return reverse_lazy('change_email_create')
+
+
+class EmailChangeAvailabilityView(MetricsMixin, ThrottleMixin, View):
+    """
+A view telling if the email address given by the ``email`` query string
+parameter can be requested, e.g. to validate addresses while users type
+them. Responds with JSON like::
+
+    {"available": false, "email": "alice@example.com", "reason": "in_use"}
+
+``reason`` is either ``invalid``, ``in_use`` or ``throttled`` and only given
+if the address is not available. Throttled requests get the ``throttled``
+reason with a HTTP 429 status. Whether an address is used is checked by
+:validator:`EmailNotUsedValidator` and cached for
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_AVAILABILITY_CACHE_TIMEOUT`
+seconds, so that the answer may be briefly outdated; the address is checked
+again when the request is created. No templates are rendered and no messages
+are added. Requests count towards the ``availability`` rates.
+"""
+    metrics_name = 'availability'
+
+    throttle_scope = 'availability'
+
+    cache_prefix = 'change_email.availability'
+
+    _caches = {}
+
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        return super(EmailChangeAvailabilityView, self).dispatch(request,
+                                                                 *args,
+                                                                 **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        if not self.is_allowed():
+            return self.throttled()
+        email = request.GET.get('email', '').strip()
+        if not email:
+            return HttpResponseBadRequest()
+        data = {'email': email, 'available': True}
+        try:
+            validate_email(email)
+        except ValidationError:
+            data.update(available=False, reason='invalid')
+        else:
+            if self.is_used(email):
+                data.update(available=False, reason='in_use')
+        return self.render_json(data)
+
+    def render_json(self, data, status=200):
+        return HttpResponse(json.dumps(data, sort_keys=True), status=status,
+                            content_type='application/json')
+
+    def throttled(self):
+        """
+Returns a HTTP 429 (Too Many Requests) response with the ``throttled``
+reason, as the address has not been checked.
+"""
+        self.log_throttled()
+        data = {
+            'email': self.request.GET.get('email', '').strip(),
+            'available': False,
+            'reason': 'throttled',
+        }
+        return self.render_json(data, status=429)
+
+    def is_used(self, email):
+        """
+Checks if an email address is used, with the result cached in the cache
+set by :py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_AVAILABILITY_CACHE`.
+
+:arg str email: A valid email address.
+:rtype: bool
+"""
+        site = None
+        if settings.EMAIL_CHANGE_VALIDATE_SITE:
+            site = get_current_site(self.request)
+        timeout = settings.EMAIL_CHANGE_AVAILABILITY_CACHE_TIMEOUT
+        if not timeout:
+            return validate_email_not_used.is_used(email, site=site)
+        key = hashlib.md5(force_bytes(normalize_email(email))).hexdigest()
+        key = '%s.%s' % (self.cache_prefix, key)
+        if site is not None:
+            key = '%s.%s' % (key, site.pk)
+        cache = self.get_result_cache()
+        used = cache.get(key)
+        if used is None:
+            used = validate_email_not_used.is_used(email, site=site)
+            cache.set(key, used, timeout)
+        return used
+
+    def get_result_cache(self):
+        """
+Returns the cache set by
+:py:attr:`~change_email.conf.Settings.EMAIL_CHANGE_AVAILABILITY_CACHE`,
+instantiated once per process.
+"""
+        alias = settings.EMAIL_CHANGE_AVAILABILITY_CACHE
+        cache = self._caches.get(alias)
+        if cache is None:
+            cache = self._caches[alias] = get_cache(alias)
+        return cache
+
+
+class EmailChangeExportView(View):
+    """
+A view to download email address change requests as CSV or JSON Lines,
+streamed in constant memory by :func:`~change_email.export.export`. Only
+accessible to staff members.
+
+The query string parameters ``state`` (``all``, ``pending`` or ``expired``)
+and ``format`` (``csv`` or ``jsonl``) select the exported requests and the
+format, defaulting to all requests as CSV.
+"""
+    chunk_size = 1000
+    """The number of rows fetched per query."""
+
+    @method_decorator(staff_member_required)
+    def dispatch(self, request, *args, **kwargs):
+        return super(EmailChangeExportView, self).dispatch(request,
+                                                           *args,
+                                                           **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        state = request.GET.get('state', 'all')
+        format = request.GET.get('format', 'csv')
+        if state not in STATES or format not in CONTENT_TYPES:
+            return HttpResponseBadRequest()
+        response = StreamingHttpResponse(export(state=state, format=format,
+                                                chunk_size=self.chunk_size),
+                                         content_type=CONTENT_TYPES[format])
+        response['Content-Disposition'] = (
+            'attachment; filename="email-changes-%s.%s"' % (state, format))
+        return response